@@ -9,19 +9,34 @@ print(">>> FICHIER APP.PY VERSION AVEC RAPPELS PERSONNALISÉS <<<")
 print(">>> SI VOUS VOYEZ CE MESSAGE AU DÉMARRAGE, C'EST LE BON FICHIER <<<")
 print("=" * 80)
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file, session, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 from sqlalchemy import func
+from sqlalchemy import event as sa_event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session as SaSession
+from sqlalchemy.sql import operators as sa_operators
+from sqlalchemy.types import TypeDecorator
+from decimal import Decimal, ROUND_HALF_UP
 import os
 import json
+import base64
+import hashlib
+import re
 import shutil
 import sys
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
 
 import subprocess
 import requests
+import click
 import pytz
 from pathlib import Path
 
@@ -29,8 +44,8 @@ from pathlib import Path
 try:
     from google.auth.transport.requests import Request
     from google.oauth2.credentials import Credentials
-    from google_auth_oauthlib.flow import InstalledAppFlow, Flow
-    from googleapiclient.discovery import build
+    from google_auth_oauthlib.flow import Flow
+    from googleapiclient.discovery import build_from_document
     from googleapiclient.errors import HttpError
     GOOGLE_CALENDAR_AVAILABLE = True
 except ImportError:
@@ -86,9 +101,9 @@ if getattr(sys, 'frozen', False):
     print(">> Mode executable: Base de donnees = {db_path}")
     print(">> Verification base de donnees: {'EXISTE' if os.path.exists(db_path) else 'INEXISTANTE'}")
 else:
-    # Mode développement Python normal
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///gestion_entreprise.db'
-    print(">> Mode developpement: Base de donnees = sqlite:///gestion_entreprise.db")
+    # Mode développement Python normal (SQLALCHEMY_DATABASE_URI : autre base, ex. pour les tests)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SQLALCHEMY_DATABASE_URI', 'sqlite:///gestion_entreprise.db')
+    print(f">> Mode developpement: Base de donnees = {app.config['SQLALCHEMY_DATABASE_URI']}")
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -101,8 +116,129 @@ app.config['BACKUP_FOLDER'] = 'Sauvegardes'
 app.config['GDRIVE_BACKUP_PATH'] = r'G:\Mon Drive\Sauvegardes App'
 os.makedirs(app.config['BACKUP_FOLDER'], exist_ok=True)
 
+# Profil de performance SQLite (appliqué à chaque nouvelle connexion)
+# Surchargeable par variables d'environnement (ex: SQLITE_BUSY_TIMEOUT=10000)
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),  # Lecteurs non bloqués par l'écriture
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),  # Sûr en WAL, moins de fsync
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),  # Attente (ms) si la base est verrouillée
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -20000)),  # Négatif = en Ko (~20 Mo)
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 268435456)),  # 256 Mo lus via mmap
+    'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'MEMORY'),
+}
+app.config['SQLITE_REESSAIS_VERROU'] = int(os.environ.get('SQLITE_REESSAIS_VERROU', 3))
+
 db = SQLAlchemy(app)
 
+
+def appliquer_profil_sqlite(dbapi_connection, connection_record):
+    """Applique les PRAGMA du profil SQLite à une nouvelle connexion"""
+    curseur = dbapi_connection.cursor()
+    try:
+        for pragma, valeur in app.config['SQLITE_PRAGMAS'].items():
+            curseur.execute(f"PRAGMA {pragma}={valeur}")
+    finally:
+        curseur.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        sa_event.listen(db.engine, 'connect', appliquer_profil_sqlite)
+
+
+def copier_base_sqlite(source, destination):
+    """
+    Copie cohérente d'une base SQLite via l'API de sauvegarde
+    (en mode WAL, une simple copie du fichier .db peut manquer les dernières transactions)
+    """
+    import sqlite3
+    src = sqlite3.connect(source, timeout=app.config['SQLITE_PRAGMAS']['busy_timeout'] / 1000)
+    dst = sqlite3.connect(destination)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def restaurer_base_sqlite(sauvegarde, db_actuelle):
+    """Remplace la base active par une sauvegarde (connexions du pool fermées, fichiers WAL écartés)"""
+    db.session.remove()
+    db.engine.dispose()
+    _sequences_synchronisees.clear()  # Les compteurs de la base restaurée sont à réaligner
+    for suffixe in ('-wal', '-shm'):
+        if os.path.exists(db_actuelle + suffixe):
+            os.remove(db_actuelle + suffixe)
+    shutil.copy2(sauvegarde, db_actuelle)
+
+
+def est_erreur_verrou(erreur):
+    """True si l'exception correspond à 'database is locked' (SQLITE_BUSY)"""
+    return isinstance(erreur, OperationalError) and 'database is locked' in str(erreur)
+
+
+def reessayer_si_verrouille(f):
+    """
+    Décorateur : ré-exécute l'unité de travail si la base est verrouillée
+    (rollback puis nouvelle tentative avec attente croissante)
+    À réserver aux fonctions rejouables sans effet de bord externe
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        tentatives = max(1, app.config['SQLITE_REESSAIS_VERROU'])
+        for tentative in range(1, tentatives + 1):
+            try:
+                return f(*args, **kwargs)
+            except Exception as e:
+                if not est_erreur_verrou(e) or tentative == tentatives:
+                    raise
+                db.session.rollback()
+                print(f"⚠️ Base verrouillée ({f.__name__}), nouvelle tentative {tentative + 1}/{tentatives}")
+                time.sleep(0.2 * (2 ** (tentative - 1)))
+    return wrapper
+
+# ============================================================================
+# MONTANTS EN CENTIMES (sommes exactes en SQL, pas de dérive d'arrondi)
+# ============================================================================
+
+def en_centimes(montant):
+    """Montant en euros (float, str, Decimal) -> centimes entiers, arrondi commercial au centime"""
+    if montant is None or montant == '':
+        return 0
+    return int((Decimal(str(montant)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+class Montant(TypeDecorator):
+    """
+    Montant en euros stocké en centimes entiers (colonne INTEGER)
+    Côté Python la valeur reste un float en euros (arrondi au centime) ;
+    SUM/soustractions se font en entiers dans SQLite, donc exactement
+    """
+    impl = db.Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else en_centimes(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else round(value) / 100
+
+    OPERATEURS_FACTEUR = (sa_operators.mul, sa_operators.truediv)
+
+    class comparator_factory(db.Integer.Comparator):
+        def _adapt_expression(self, op, other_comparator):
+            # montant * facteur reste un montant (en centimes) : même conversion en lecture
+            if op in Montant.OPERATEURS_FACTEUR and not isinstance(other_comparator.type, Montant):
+                return op, self.type
+            return super()._adapt_expression(op, other_comparator)
+
+    def coerce_compared_value(self, op, value):
+        # montant * 1.2 : le facteur n'est pas un montant, il ne doit pas être converti en centimes
+        if op in self.OPERATEURS_FACTEUR:
+            return db.Float()
+        return self
+
+
 # ============================================================================
 # MODÈLES DE BASE DE DONNÉES
 # ============================================================================
@@ -145,6 +281,8 @@ class Client(db.Model):
     calendrier_google = db.Column(db.String(500))  # ID du calendrier Google dédié à ce client
     statut_client = db.Column(db.String(50), default='Client')  # 'Prospect' ou 'Client'
     date_conversion = db.Column(db.DateTime)  # Date de conversion d'un prospect en client
+    latitude = db.Column(db.Float)  # Coordonnées de l'adresse, renseignées à l'enregistrement
+    longitude = db.Column(db.Float)
 
     # Relations
     prestations = db.relationship('Prestation', backref='client', lazy=True, cascade='all, delete-orphan')
@@ -171,7 +309,7 @@ class Contact(db.Model):
     __tablename__ = 'contacts'
 
     id = db.Column(db.Integer, primary_key=True)
-    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=False, index=True)
 
     nom = db.Column(db.String(100), nullable=False)
     prenom = db.Column(db.String(100))
@@ -199,6 +337,24 @@ class Contact(db.Model):
             'actif': self.actif
         }
 
+# Lignes de détail (déplacement, fourniture, prestation) : table unique lignes_document,
+# exposée sur chaque document par une relation en lecture seule et des vues par section
+def _relation_lignes_document(nature, modele):
+    """Toutes les lignes d'un document, chargées en une requête indexée (section puis ordre de saisie)"""
+    return db.relationship(
+        'LigneDocument',
+        primaryjoin=f"and_(LigneDocument.nature_document == '{nature}', foreign(LigneDocument.document_id) == {modele}.id)",
+        order_by='[LigneDocument.section, LigneDocument.id]',
+        viewonly=True,
+        lazy=True
+    )
+
+
+def _vue_section_lignes(section):
+    """Lignes d'une section, filtrées dans la collection déjà chargée (pas de requête supplémentaire)"""
+    return property(lambda self: [ligne for ligne in self.lignes if ligne.section == section])
+
+
 class Prestation(db.Model):
     """Table des prestations (formations, services)"""
     __tablename__ = 'prestations'
@@ -206,7 +362,7 @@ class Prestation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
     # Client et demande
-    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=False, index=True)
     demandeur = db.Column(db.String(200))  # Nom du demandeur si différent du client
     date_demande = db.Column(db.Date)  # Date de la demande
     reference_commande = db.Column(db.String(100))  # Référence de la commande
@@ -219,7 +375,7 @@ class Prestation(db.Model):
     description = db.Column(db.Text)
 
     # Dates et horaires
-    date_debut = db.Column(db.DateTime, nullable=False)
+    date_debut = db.Column(db.DateTime, nullable=False, index=True)
     date_fin = db.Column(db.DateTime)
     duree_heures = db.Column(db.Float)
     creneau = db.Column(db.String(20))  # "Matin", "Après-midi", "Journée", "Personnalisé"
@@ -239,16 +395,16 @@ class Prestation(db.Model):
     nb_hebergements = db.Column(db.Integer)  # Nombre d'hébergements
 
     # Financier (gardés pour compatibilité, mais plus dans le formulaire)
-    tarif_horaire = db.Column(db.Float)
-    tarif_total = db.Column(db.Float)
-    frais_fournitures = db.Column(db.Float)  # Frais de fournitures
-    frais_deplacement = db.Column(db.Float)  # Frais de déplacement
+    tarif_horaire = db.Column(Montant)
+    tarif_total = db.Column(Montant)
+    frais_fournitures = db.Column(Montant)  # Frais de fournitures
+    frais_deplacement = db.Column(Montant)  # Frais de déplacement
     statut_paiement = db.Column(db.String(50))  # En attente, Payé, Partiel, En retard
     statut_facture = db.Column(db.String(50))  # Non envoyée, Envoyée, Payée, En retard
     statut_devis = db.Column(db.String(50))  # Non envoyé, Envoyé, Accepté, Refusé
 
     # Statut
-    statut = db.Column(db.String(50), default='Demandée')  # Demandée, Planifiée, En cours, Terminée, Annulée
+    statut = db.Column(db.String(50), default='Demandée', index=True)  # Demandée, Planifiée, En cours, Terminée, Annulée
 
     # Métadonnées
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
@@ -259,7 +415,7 @@ class Prestation(db.Model):
     titre_tache = db.Column(db.String(200))
     description_tache = db.Column(db.Text)
     date_debut_tache = db.Column(db.DateTime)
-    date_echeance_tache = db.Column(db.DateTime)
+    date_echeance_tache = db.Column(db.DateTime, index=True)
     priorite_tache = db.Column(db.String(50), default='Moyenne')  # Basse, Moyenne, Haute
     statut_tache = db.Column(db.String(50), default='À faire')  # À faire, En cours, Terminée
 
@@ -269,13 +425,21 @@ class Prestation(db.Model):
     gcal_last_sync = db.Column(db.DateTime)  # Date de dernière synchronisation
     calendrier_id = db.Column(db.String(500))  # ID du calendrier Google dédié à cette prestation
 
+    # Coordonnées du lieu de prestation (renseignées à l'enregistrement)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+
+    # Fin effective (date_fin, à défaut date_debut) : borne basse des fenêtres du calendrier
+    __table_args__ = (db.Index('ix_prestations_fin_effective', func.coalesce(date_fin, date_debut)),)
+
     # Relations
     documents = db.relationship('Document', backref='prestation', lazy=True, cascade='all, delete-orphan')
     gcal_blocages = db.relationship('GcalBlocage', backref='prestation', lazy=True, cascade='all, delete-orphan')
     sessions = db.relationship('SessionPrestation', backref='prestation', lazy=True, cascade='all, delete-orphan', order_by='SessionPrestation.ordre')
-    lignes_tarif_deplacement = db.relationship('LignePrestationDeplacement', backref='prestation', lazy=True, cascade='all, delete-orphan')
-    lignes_tarif_fourniture = db.relationship('LignePrestationFourniture', backref='prestation', lazy=True, cascade='all, delete-orphan')
-    lignes_tarif_prestation = db.relationship('LignePrestationTarif', backref='prestation', lazy=True, cascade='all, delete-orphan')
+    lignes = _relation_lignes_document('prestation', 'Prestation')
+    lignes_tarif_deplacement = _vue_section_lignes('deplacement')
+    lignes_tarif_fourniture = _vue_section_lignes('fourniture')
+    lignes_tarif_prestation = _vue_section_lignes('prestation')
 
     def to_dict(self):
         return {
@@ -303,7 +467,7 @@ class Document(db.Model):
     __tablename__ = 'documents'
 
     id = db.Column(db.Integer, primary_key=True)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
+    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False, index=True)
 
     nom_fichier = db.Column(db.String(200), nullable=False)
     nom_original = db.Column(db.String(200), nullable=False)
@@ -333,16 +497,19 @@ class CalendrierConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     config_json = db.Column(db.Text)  # Stockage de la config des calendriers
     derniere_synchro = db.Column(db.DateTime)
+    calendriers_json = db.Column(db.Text)  # Liste filtrée des calendriers Google (cache, voir calendriers_google)
+    calendriers_maj = db.Column(db.DateTime)  # Dernière lecture de calendarList chez Google
 
 class GcalBlocage(db.Model):
     """Événements de blocage Google Calendar associés aux prestations"""
     __tablename__ = 'gcal_blocages'
 
     id = db.Column(db.Integer, primary_key=True)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
+    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False, index=True)
     calendar_id = db.Column(db.String(500), nullable=False)  # ID du calendrier Google
     event_id = db.Column(db.String(500), nullable=False)  # ID de l'événement Google Calendar
     calendar_name = db.Column(db.String(200))  # Nom du calendrier pour référence
+    gcal_hash = db.Column(db.String(64))  # Empreinte du contenu envoyé (synchronisation différentielle)
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
 
 class SessionPrestation(db.Model):
@@ -350,10 +517,10 @@ class SessionPrestation(db.Model):
     __tablename__ = 'sessions_prestation'
 
     id = db.Column(db.Integer, primary_key=True)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
+    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False, index=True)
 
     # Dates de cette session
-    date_debut = db.Column(db.DateTime, nullable=False)
+    date_debut = db.Column(db.DateTime, nullable=False, index=True)
     date_fin = db.Column(db.DateTime)
     duree_heures = db.Column(db.Float)
     journee_complete = db.Column(db.Boolean, default=False)  # Si coché, implique journée entière dans Google Calendar
@@ -361,17 +528,107 @@ class SessionPrestation(db.Model):
     # Synchronisation Google Calendar (un événement par session)
     gcal_event_id = db.Column(db.String(500))  # ID de l'événement Google Calendar pour cette session
     gcal_synced = db.Column(db.Boolean, default=False)
+    gcal_event_ids = db.Column(db.Text)  # JSON : IDs de tous les événements envoyés (un par jour si multi-jours)
+    gcal_calendar_id = db.Column(db.String(500))  # Calendrier où ces événements ont été créés
+    gcal_hash = db.Column(db.String(64))  # Empreinte du contenu envoyé (synchronisation différentielle)
 
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
     ordre = db.Column(db.Integer, default=0)  # Pour trier les sessions
 
+    # Fin effective (date_fin, à défaut date_debut) : borne basse des fenêtres du calendrier
+    __table_args__ = (db.Index('ix_sessions_prestation_fin_effective', func.coalesce(date_fin, date_debut)),)
+
+class GcalEvenementSupprime(db.Model):
+    """Événements Google Calendar des sessions supprimées, à retirer à la prochaine synchronisation"""
+    __tablename__ = 'gcal_evenements_supprimes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    prestation_id = db.Column(db.Integer, nullable=False, index=True)  # Pas de clé étrangère : survit à la prestation
+    calendar_id = db.Column(db.String(500))  # None : session synchronisée avant l'enregistrement du calendrier
+    event_id = db.Column(db.String(500), nullable=False)
+    date_creation = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+def ids_evenements_session(session):
+    """IDs des événements Google Calendar d'une session (anciennes sessions : seul gcal_event_id est connu)"""
+    if session.gcal_event_ids:
+        try:
+            return json.loads(session.gcal_event_ids)
+        except ValueError:
+            pass
+    return [session.gcal_event_id] if session.gcal_event_id else []
+
+
+@sa_event.listens_for(SessionPrestation, 'after_delete')
+def _memoriser_evenements_session(mapper, connection, session):
+    """Session supprimée : ses événements Google restent à supprimer (sync_prestation_to_gcal s'en charge)"""
+    ids = ids_evenements_session(session)
+    if ids:
+        connection.execute(GcalEvenementSupprime.__table__.insert(), [
+            {'prestation_id': session.prestation_id, 'calendar_id': session.gcal_calendar_id,
+             'event_id': event_id, 'date_creation': datetime.utcnow()}
+            for event_id in ids
+        ])
+
+
+class GcalFileAttente(db.Model):
+    """
+    File d'attente des synchronisations Google Calendar (une ligne par objet : les modifications successives
+    se fusionnent), écrite dans la transaction de la modification et vidée par les threads de fond
+    """
+    __tablename__ = 'gcal_file_attente'
+    __table_args__ = (db.UniqueConstraint('nature', 'objet_id', name='uq_gcal_file_attente_objet'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    nature = db.Column(db.String(20), nullable=False)  # prestation, indisponibilite
+    objet_id = db.Column(db.Integer, nullable=False)  # prestations.id ou indisponibilites.id (négatif : objet supprimé)
+    action = db.Column(db.String(10), nullable=False)  # upsert, delete
+    donnees = db.Column(db.Text)  # JSON : [[calendar_id, event_id], ...] à supprimer si l'objet a disparu
+    statut = db.Column(db.String(20), nullable=False, default='en_attente', index=True)  # en_attente, en_cours, ok, erreur
+    version = db.Column(db.Integer, nullable=False, default=1)  # Incrémentée à chaque modification de l'objet
+    tentatives = db.Column(db.Integer, nullable=False, default=0)
+    prochain_essai = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    derniere_erreur = db.Column(db.Text)
+    verrouille_le = db.Column(db.DateTime)  # Réservation par un thread (statut en_cours)
+    # gcal_synchros.id si planifiée par "Synchroniser tout" : passe après les modifications des utilisateurs
+    # (effacé quand une modification de l'objet arrive ; l'avancement est suivi dans gcal_synchros_elements)
+    synchro_id = db.Column(db.Integer, index=True)
+    date_creation = db.Column(db.DateTime, default=datetime.utcnow)
+    date_maj = db.Column(db.DateTime, default=datetime.utcnow)  # Dernier passage (succès ou échec)
+
+
+class GcalSynchroGlobale(db.Model):
+    """Synchronisation de toutes les prestations ("Synchroniser tout"), suivie par ses opérations de la file"""
+    __tablename__ = 'gcal_synchros'
+
+    id = db.Column(db.Integer, primary_key=True)
+    statut = db.Column(db.String(20), nullable=False, default='en_cours', index=True)  # en_cours, terminee
+    total = db.Column(db.Integer, nullable=False, default=0)
+    date_debut = db.Column(db.DateTime, default=datetime.utcnow)
+    date_fin = db.Column(db.DateTime)
+
+
+class GcalSynchroElement(db.Model):
+    """Avancement d'une prestation dans une synchronisation globale (figé une fois la prestation traitée)"""
+    __tablename__ = 'gcal_synchros_elements'
+    __table_args__ = (db.UniqueConstraint('synchro_id', 'prestation_id', name='uq_gcal_synchro_element'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    synchro_id = db.Column(db.Integer, db.ForeignKey('gcal_synchros.id'), nullable=False, index=True)
+    prestation_id = db.Column(db.Integer, nullable=False, index=True)
+    statut = db.Column(db.String(20), nullable=False, default='en_attente')  # en_attente, ok, erreur
+    tentatives = db.Column(db.Integer, nullable=False, default=0)
+    derniere_erreur = db.Column(db.Text)
+    date_maj = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 class Indisponibilite(db.Model):
     """Périodes d'indisponibilité (vacances, maladie, etc.) bloquant tous les calendriers"""
     __tablename__ = 'indisponibilites'
 
     id = db.Column(db.Integer, primary_key=True)
     date_debut = db.Column(db.Date, nullable=False)
-    date_fin = db.Column(db.Date, nullable=False)
+    date_fin = db.Column(db.Date, nullable=False, index=True)
     motif = db.Column(db.String(100), nullable=False)  # Vacances, Maladie, Formation, Congé, Autre
     note = db.Column(db.Text)  # Note optionnelle
 
@@ -381,6 +638,14 @@ class Indisponibilite(db.Model):
 
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @property
+    def gcal_event_id(self):
+        """Événement du calendrier principal ('primary'), lu dans gcal_events"""
+        try:
+            return json.loads(self.gcal_events or '{}').get('primary')
+        except ValueError:
+            return None
+
 class Sauvegarde(db.Model):
     """Historique des sauvegardes"""
     __tablename__ = 'sauvegardes'
@@ -428,16 +693,23 @@ class Entreprise(db.Model):
 
     # Informations juridiques et bancaires
     statut_juridique = db.Column(db.String(100))  # SARL, SAS, EURL, Entreprise individuelle, etc.
-    capital = db.Column(db.Float)
+    capital = db.Column(Montant)
     numero_nda = db.Column(db.String(50))  # Numéro de déclaration d'activité (formation)
     rcs = db.Column(db.String(100))  # Registre du Commerce et des Sociétés
     domiciliation_bancaire = db.Column(db.String(200))
     iban = db.Column(db.String(34))
     bic = db.Column(db.String(11))
 
+    # Coordonnées de l'adresse (point de départ des calculs de distance)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+
 class Notification(db.Model):
     """Historique des notifications envoyées"""
     __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_type_prestation_statut', 'type_notif', 'prestation_id', 'statut'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     type_notif = db.Column(db.String(50), nullable=False)  # rappel_prestation, facture_non_envoyee, facture_non_payee
@@ -460,12 +732,12 @@ class Facture(db.Model):
     __tablename__ = 'factures'
 
     id = db.Column(db.Integer, primary_key=True)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
+    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False, index=True)
 
     # Références
     reference_facture = db.Column(db.String(100), unique=True, nullable=False)  # FA-27.2020-12-039
     date_facture = db.Column(db.Date, nullable=False)
-    date_envoi = db.Column(db.Date)
+    date_envoi = db.Column(db.Date, index=True)
 
     # Références paiement
     reference_paiement = db.Column(db.String(100))
@@ -473,16 +745,16 @@ class Facture(db.Model):
     mail_envoi = db.Column(db.String(200))  # Email destinataire
 
     # Calcul des prix (stockés pour historique)
-    deplacement_prix_ht = db.Column(db.Float, default=0)
-    fourniture_prix_ht = db.Column(db.Float, default=0)
-    prestation_prix_ht = db.Column(db.Float, default=0)
-    acompte_prix_ht = db.Column(db.Float, default=0)
+    deplacement_prix_ht = db.Column(Montant, default=0)
+    fourniture_prix_ht = db.Column(Montant, default=0)
+    prestation_prix_ht = db.Column(Montant, default=0)
+    acompte_prix_ht = db.Column(Montant, default=0)
     remise = db.Column(db.Float, default=0)  # En pourcentage ou montant
-    majoration = db.Column(db.Float, default=0)
-    remise_ht = db.Column(db.Float, default=0)
-    total_prix_ht = db.Column(db.Float)
+    majoration = db.Column(Montant, default=0)
+    remise_ht = db.Column(Montant, default=0)
+    total_prix_ht = db.Column(Montant)
     tva_applicable = db.Column(db.Float, default=0)  # En pourcentage
-    total_ttc = db.Column(db.Float)
+    total_ttc = db.Column(Montant)
 
     # Commentaire
     commentaire = db.Column(db.Text)
@@ -495,68 +767,30 @@ class Facture(db.Model):
 
     # Relations
     prestation = db.relationship('Prestation', backref=db.backref('factures', cascade='all, delete-orphan'))
-    lignes_deplacement = db.relationship('LigneFactureDeplacement', backref='facture', lazy=True, cascade='all, delete-orphan')
-    lignes_fourniture = db.relationship('LigneFactureFourniture', backref='facture', lazy=True, cascade='all, delete-orphan')
-    lignes_prestation = db.relationship('LigneFacturePrestation', backref='facture', lazy=True, cascade='all, delete-orphan')
-
-class LigneFactureDeplacement(db.Model):
-    """Lignes de frais de déplacement dans une facture"""
-    __tablename__ = 'lignes_facture_deplacement'
-
-    id = db.Column(db.Integer, primary_key=True)
-    facture_id = db.Column(db.Integer, db.ForeignKey('factures.id'), nullable=False)
-
-    code = db.Column(db.String(50))  # REP, KM
-    type = db.Column(db.String(100))  # REPAS, PROXIMITE
-    nbre = db.Column(db.Float, default=0)  # Nombre ou quantité
-    pu_ht = db.Column(db.Float, default=0)  # Prix unitaire HT
-    pt_ht = db.Column(db.Float, default=0)  # Prix total HT
-
-class LigneFactureFourniture(db.Model):
-    """Lignes de frais de fourniture dans une facture"""
-    __tablename__ = 'lignes_facture_fourniture'
-
-    id = db.Column(db.Integer, primary_key=True)
-    facture_id = db.Column(db.Integer, db.ForeignKey('factures.id'), nullable=False)
-
-    code = db.Column(db.String(50))  # INCENDIE
-    type = db.Column(db.String(100))  # EXTINCTEUR_EAU, EXTINCTEUR_CO2
-    nbre = db.Column(db.Float, default=0)
-    pu_ht = db.Column(db.Float, default=0)
-    pt_ht = db.Column(db.Float, default=0)
-
-class LigneFacturePrestation(db.Model):
-    """Lignes de tarif prestation dans une facture"""
-    __tablename__ = 'lignes_facture_prestation'
-
-    id = db.Column(db.Integer, primary_key=True)
-    facture_id = db.Column(db.Integer, db.ForeignKey('factures.id'), nullable=False)
-
-    code = db.Column(db.String(50))  # INCENDIE
-    type = db.Column(db.String(100))  # EPI
-    nbre = db.Column(db.Float, default=1)
-    pu_ht = db.Column(db.Float, default=0)
-    pt_ht = db.Column(db.Float, default=0)
+    lignes = _relation_lignes_document('facture', 'Facture')
+    lignes_deplacement = _vue_section_lignes('deplacement')
+    lignes_fourniture = _vue_section_lignes('fourniture')
+    lignes_prestation = _vue_section_lignes('prestation')
 
 class Paiement(db.Model):
     """Table des paiements"""
     __tablename__ = 'paiements'
 
     id = db.Column(db.Integer, primary_key=True)
-    facture_id = db.Column(db.Integer, db.ForeignKey('factures.id'), nullable=False)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
+    facture_id = db.Column(db.Integer, db.ForeignKey('factures.id'), nullable=False, index=True)
+    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False, index=True)
 
     # Numérotation
     numero_paiement = db.Column(db.String(100), unique=True)  # P-001, P-002, etc.
     numero_facture = db.Column(db.String(100))  # Référence de la facture
 
     # Dates
-    date_butoir = db.Column(db.Date)  # Date limite de paiement (date_facture + délai client)
+    date_butoir = db.Column(db.Date, index=True)  # Date limite de paiement (date_facture + délai client)
     date_paiement = db.Column(db.Date)  # Date réelle du paiement
 
     # Montants
-    montant_total = db.Column(db.Float)  # Montant total à payer
-    montant_paye = db.Column(db.Float, default=0)  # Montant déjà payé
+    montant_total = db.Column(Montant)  # Montant total à payer
+    montant_paye = db.Column(Montant, default=0)  # Montant déjà payé
 
     # Mode de paiement
     mode_paiement = db.Column(db.String(50))  # Virement, Chèque, Espèces, CB, etc.
@@ -566,7 +800,7 @@ class Paiement(db.Model):
     nb_relances = db.Column(db.Integer, default=0)  # Nombre de relances envoyées
 
     # Statut
-    statut = db.Column(db.String(50), default='En attente')  # En attente, Partiel, Payé, En retard
+    statut = db.Column(db.String(50), default='En attente', index=True)  # En attente, Partiel, Payé, En retard
 
     # Métadonnées
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
@@ -581,7 +815,7 @@ class Devis(db.Model):
     __tablename__ = 'devis'
 
     id = db.Column(db.Integer, primary_key=True)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
+    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False, index=True)
 
     # Références
     reference_devis = db.Column(db.String(100), unique=True, nullable=False)
@@ -593,14 +827,14 @@ class Devis(db.Model):
     mail_envoi = db.Column(db.String(200))
 
     # Calcul des prix (similaire à facture)
-    deplacement_prix_ht = db.Column(db.Float, default=0)
-    fourniture_prix_ht = db.Column(db.Float, default=0)
-    prestation_prix_ht = db.Column(db.Float, default=0)
+    deplacement_prix_ht = db.Column(Montant, default=0)
+    fourniture_prix_ht = db.Column(Montant, default=0)
+    prestation_prix_ht = db.Column(Montant, default=0)
     remise = db.Column(db.Float, default=0)
-    remise_ht = db.Column(db.Float, default=0)
-    total_prix_ht = db.Column(db.Float)
+    remise_ht = db.Column(Montant, default=0)
+    total_prix_ht = db.Column(Montant)
     tva_applicable = db.Column(db.Float, default=0)
-    total_ttc = db.Column(db.Float)
+    total_ttc = db.Column(Montant)
 
     # Commentaire
     commentaire = db.Column(db.Text)
@@ -613,185 +847,443 @@ class Devis(db.Model):
 
     # Relations
     prestation = db.relationship('Prestation', backref=db.backref('devis_list', cascade='all, delete-orphan'))
-    lignes_deplacement = db.relationship('LigneDevisDeplacement', backref='devis', lazy=True, cascade='all, delete-orphan')
-    lignes_fourniture = db.relationship('LigneDevisFourniture', backref='devis', lazy=True, cascade='all, delete-orphan')
-    lignes_prestation = db.relationship('LigneDevisPrestation', backref='devis', lazy=True, cascade='all, delete-orphan')
+    lignes = _relation_lignes_document('devis', 'Devis')
+    lignes_deplacement = _vue_section_lignes('deplacement')
+    lignes_fourniture = _vue_section_lignes('fourniture')
+    lignes_prestation = _vue_section_lignes('prestation')
 
-class LigneDevisDeplacement(db.Model):
-    """Lignes de frais de déplacement dans un devis"""
-    __tablename__ = 'lignes_devis_deplacement'
+# ============================================================================
+# LIGNES DE DOCUMENTS (tarifs de prestation, devis, factures)
+# ============================================================================
 
-    id = db.Column(db.Integer, primary_key=True)
-    devis_id = db.Column(db.Integer, db.ForeignKey('devis.id'), nullable=False)
+NATURES_DOCUMENT_LIGNES = ('prestation', 'devis', 'facture')
+SECTIONS_LIGNES = ('deplacement', 'fourniture', 'prestation')
 
-    code = db.Column(db.String(50))
-    type = db.Column(db.String(100))
-    nbre = db.Column(db.Float, default=0)
-    pu_ht = db.Column(db.Float, default=0)
-    pt_ht = db.Column(db.Float, default=0)
 
-class LigneDevisFourniture(db.Model):
-    """Lignes de frais de fourniture dans un devis"""
-    __tablename__ = 'lignes_devis_fourniture'
+class LigneDocument(db.Model):
+    """Lignes de détail des tarifs de prestation, devis et factures (une seule table pour les trois documents)"""
+    __tablename__ = 'lignes_document'
+    __table_args__ = (db.Index('ix_lignes_document_cle', 'nature_document', 'document_id', 'section', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True)
-    devis_id = db.Column(db.Integer, db.ForeignKey('devis.id'), nullable=False)
+    nature_document = db.Column(db.String(20), nullable=False)  # prestation, devis, facture
+    document_id = db.Column(db.Integer, nullable=False)  # prestations.id, devis.id ou factures.id
+    section = db.Column(db.String(20), nullable=False)  # deplacement, fourniture, prestation
+
+    code = db.Column(db.String(50))  # REP, KM, INCENDIE, FORMATION
+    type = db.Column(db.String(100))  # REPAS, PROXIMITE, EXTINCTEUR_EAU, EPI, SST
+    nbre = db.Column(db.Float, default=0)  # Nombre ou quantité
+    pu_ht = db.Column(Montant, default=0)  # Prix unitaire HT
+    pt_ht = db.Column(Montant, default=0)  # Prix total HT
 
-    code = db.Column(db.String(50))
-    type = db.Column(db.String(100))
-    nbre = db.Column(db.Float, default=0)
-    pu_ht = db.Column(db.Float, default=0)
-    pt_ht = db.Column(db.Float, default=0)
 
-class LigneDevisPrestation(db.Model):
-    """Lignes de tarif prestation dans un devis"""
-    __tablename__ = 'lignes_devis_prestation'
+@sa_event.listens_for(Prestation, 'after_delete')
+@sa_event.listens_for(Devis, 'after_delete')
+@sa_event.listens_for(Facture, 'after_delete')
+def _supprimer_lignes_document(mapper, connection, document):
+    """Les lignes d'un document supprimé partent avec lui (pas de clé étrangère sur document_id)"""
+    nature = {'prestations': 'prestation', 'devis': 'devis', 'factures': 'facture'}[mapper.local_table.name]
+    table = LigneDocument.__table__
+    connection.execute(table.delete().where(
+        table.c.nature_document == nature,
+        table.c.document_id == document.id
+    ))
+
+
+# ============================================================================
+# STATISTIQUES MENSUELLES (agrégats tenus à jour à chaque modification de prestation)
+# ============================================================================
+
+class StatMensuelle(db.Model):
+    """Cumul mensuel des prestations par thème et domaine (alimente tableau de bord et statistiques)"""
+    __tablename__ = 'stats_mensuelles'
+    __table_args__ = (db.UniqueConstraint('annee', 'mois', 'theme', 'domaine', name='uq_stats_mensuelles_cle'),)
 
     id = db.Column(db.Integer, primary_key=True)
-    devis_id = db.Column(db.Integer, db.ForeignKey('devis.id'), nullable=False)
+    annee = db.Column(db.Integer, nullable=False)
+    mois = db.Column(db.Integer, nullable=False)
+    theme = db.Column(db.String(50), nullable=False, default='')  # '' si non renseigné
+    domaine = db.Column(db.String(100), nullable=False, default='')
 
-    code = db.Column(db.String(50))
-    type = db.Column(db.String(100))
-    nbre = db.Column(db.Float, default=1)
-    pu_ht = db.Column(db.Float, default=0)
-    pt_ht = db.Column(db.Float, default=0)
+    # Toutes prestations (annulées comprises)
+    nb_prestations = db.Column(db.Integer, nullable=False, default=0)
+    ca = db.Column(Montant, nullable=False, default=0)
+    distance_km = db.Column(db.Float, nullable=False, default=0)  # Aller-retour x nombre de jours
+    repas = db.Column(db.Integer, nullable=False, default=0)
+    hebergements = db.Column(db.Integer, nullable=False, default=0)
+
+    # Hors prestations annulées (totaux logistiques annuels)
+    distance_km_hors_annulees = db.Column(db.Float, nullable=False, default=0)
+    repas_hors_annulees = db.Column(db.Integer, nullable=False, default=0)
+    hebergements_hors_annulees = db.Column(db.Integer, nullable=False, default=0)
+    jours_formation_hors_annulees = db.Column(db.Integer, nullable=False, default=0)
+
+
+class VersionDonnees(db.Model):
+    """Compteur de version par groupe de données (ETag), incrémenté dans la transaction qui les modifie"""
+    __tablename__ = 'versions_donnees'
+
+    nom = db.Column(db.String(50), primary_key=True)  # ex: 'calendrier'
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Sequence(db.Model):
+    """Compteurs de numérotation des documents (dernier numéro attribué par nature / année / mois)"""
+    __tablename__ = 'sequences'
+
+    nature = db.Column(db.String(10), primary_key=True)  # DE (devis), FA (factures), P (paiements)
+    annee = db.Column(db.Integer, primary_key=True, default=0)  # 0 si numérotation non annuelle
+    mois = db.Column(db.Integer, primary_key=True, default=0)  # 0 si numérotation non mensuelle
+    valeur = db.Column(db.Integer, nullable=False, default=0)
+
+
+class GeocodeCache(db.Model):
+    """Réponses Nominatim déjà obtenues, par requête normalisée (évite un aller-retour réseau par frappe)"""
+    __tablename__ = 'geocode_cache'
+
+    cle = db.Column(db.String(500), primary_key=True)  # Requête normalisée + paramètres (limit, addressdetails)
+    requete = db.Column(db.String(500))  # Requête telle que saisie la première fois
+    reponse = db.Column(db.Text, nullable=False)  # JSON renvoyé par Nominatim
+    date_maj = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class OverpassTuile(db.Model):
+    """Éléments Overpass d'une tuile geohash pour un filtre de tags (la prospection ne redemande que les tuiles manquantes)"""
+    __tablename__ = 'overpass_tuiles'
+
+    filtre = db.Column(db.String(300), primary_key=True)  # Ex: 'zone:*', 'zone:bakery', 'nom:leclerc'
+    geohash = db.Column(db.String(12), primary_key=True)
+    elements = db.Column(db.Text, nullable=False)  # JSON : éléments Overpass dont le centre est dans la tuile
+    taille = db.Column(db.Integer, nullable=False)  # Octets de elements (éviction au-delà de OVERPASS_CACHE_MAX_OCTETS)
+    subdivisee = db.Column(db.Boolean)  # Plus de OVERPASS_ELEMENTS_MAX éléments : lire les 32 tuiles filles à la place
+    date_maj = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class Distance(db.Model):
+    """Trajets déjà calculés entre deux points (clé symétrique : A->B et B->A partagent la même ligne)"""
+    __tablename__ = 'distances'
+
+    cle = db.Column(db.String(60), primary_key=True)  # "lat1,lon1|lat2,lon2" (5 décimales, points triés)
+    distance_km = db.Column(db.Float, nullable=False)
+    duree_minutes = db.Column(db.Integer, nullable=False)
+    source = db.Column(db.String(20), nullable=False, default='estimation')  # estimation (vol d'oiseau) ou osrm
+    date_calcul = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
-def verifier_statuts_prestations():
-    """Met à jour automatiquement les prestations dépassées"""
-    from datetime import datetime
-    today = datetime.now()
-    
-    prestations = Prestation.query.filter(
-        Prestation.statut.in_(['Planifiée', 'En cours', 'Demandée']),
-        Prestation.date_fin < today
-    ).all()
-    
-    for p in prestations:
-        p.statut = 'Terminée'
-        print("✅ Prestation {p.id} passée en Terminée")
-    
-    if prestations:
-        db.session.commit()
 
-def verifier_statuts_prestations():
-    """Met à jour automatiquement les prestations dépassées"""
-    from datetime import datetime
-    today = datetime.now()
-    
-    prestations = Prestation.query.filter(
-        Prestation.statut.in_(['Planifiée', 'En cours', 'Demandée']),
-        Prestation.date_fin < today
-    ).all()
-    
-    for p in prestations:
-        p.statut = 'Terminée'
-        print("✅ Prestation {p.id} passée en Terminée")
-    
-    if prestations:
-        db.session.commit()
 
 # ============================================================================
-# LIGNES DE TARIF DE PRESTATION (sauvegardées au niveau de la prestation)
+# SUIVI DES MODIFICATIONS - Invalidation des caches après commit
 # ============================================================================
 
-class LignePrestationDeplacement(db.Model):
-    """Lignes de frais de déplacement au niveau de la prestation"""
-    __tablename__ = 'lignes_prestation_deplacement'
+# Fonctions à appeler après un commit, par nom de table modifiée
+_invalidations_par_table = {}
+
+
+def apres_commit_sur(*tables):
+    """Décorateur : appelle la fonction après chaque commit qui modifie une des tables"""
+    def decorateur(f):
+        for table in tables:
+            _invalidations_par_table.setdefault(table, []).append(f)
+        return f
+    return decorateur
+
+
+@sa_event.listens_for(SaSession, 'after_flush')
+def _noter_tables_flush(session, flush_context):
+    """Mémorise les tables touchées par un flush (ajouts, modifications, suppressions)"""
+    tables = session.info.setdefault('tables_modifiees', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table:
+            tables.add(table)
+
+
+@sa_event.listens_for(SaSession, 'do_orm_execute')
+def _noter_tables_bulk(orm_execute_state):
+    """Mémorise les tables touchées par un UPDATE/DELETE en masse (query.update/delete)"""
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None:
+            orm_execute_state.session.info.setdefault('tables_modifiees', set()).add(mapper.local_table.name)
+
+
+@sa_event.listens_for(SaSession, 'after_commit')
+def _invalider_apres_commit(session):
+    """Déclenche les invalidations enregistrées pour les tables modifiées"""
+    tables = session.info.pop('tables_modifiees', set())
+    if not tables:
+        return
+    deja_appelees = set()
+    for table in tables:
+        for f in _invalidations_par_table.get(table, []):
+            if f not in deja_appelees:
+                deja_appelees.add(f)
+                try:
+                    f(tables)
+                except Exception as e:
+                    print(f"⚠️ Erreur invalidation cache ({f.__name__}): {e}")
 
-    id = db.Column(db.Integer, primary_key=True)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
 
-    code = db.Column(db.String(50))  # REP, KM
-    type = db.Column(db.String(100))  # REPAS, PROXIMITE
-    nbre = db.Column(db.Float, default=0)  # Nombre ou quantité
-    pu_ht = db.Column(db.Float, default=0)  # Prix unitaire HT
-    pt_ht = db.Column(db.Float, default=0)  # Prix total HT
+@sa_event.listens_for(SaSession, 'after_rollback')
+def _oublier_tables_rollback(session):
+    """Un rollback annule les modifications : rien à invalider"""
+    session.info.pop('tables_modifiees', None)
 
-class LignePrestationFourniture(db.Model):
-    """Lignes de frais de fourniture au niveau de la prestation"""
-    __tablename__ = 'lignes_prestation_fourniture'
 
-    id = db.Column(db.Integer, primary_key=True)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
+# Versions de données partagées entre processus (gunicorn) : stockées en base,
+# incrémentées dans la même transaction que la modification
+VERSIONS_PAR_TABLE = {
+    'prestations': ['calendrier'],
+    'sessions_prestation': ['calendrier'],
+    'clients': ['calendrier'],
+    'indisponibilites': ['calendrier']
+}
+
 
-    code = db.Column(db.String(50))  # INCENDIE
-    type = db.Column(db.String(100))  # EXTINCTEUR_EAU, EXTINCTEUR_CO2
-    nbre = db.Column(db.Float, default=0)
-    pu_ht = db.Column(db.Float, default=0)
-    pt_ht = db.Column(db.Float, default=0)
+def _incrementer_versions(connection, tables):
+    """Incrémente les versions associées aux tables modifiées"""
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+    noms = {nom for table in tables for nom in VERSIONS_PAR_TABLE.get(table, [])}
+    for nom in sorted(noms):
+        requete = sqlite_insert(VersionDonnees.__table__).values(nom=nom, version=1)
+        requete = requete.on_conflict_do_update(
+            index_elements=['nom'],
+            set_={'version': VersionDonnees.__table__.c.version + 1}
+        )
+        connection.execute(requete)
 
-class LignePrestationTarif(db.Model):
-    """Lignes de tarif prestation au niveau de la prestation"""
-    __tablename__ = 'lignes_prestation_tarif'
 
-    id = db.Column(db.Integer, primary_key=True)
-    prestation_id = db.Column(db.Integer, db.ForeignKey('prestations.id'), nullable=False)
+@sa_event.listens_for(SaSession, 'after_flush')
+def _versions_apres_flush(session, flush_context):
+    """Modifications ORM : incrément des versions dans la transaction en cours"""
+    modifies = [obj for obj in session.dirty if session.is_modified(obj)]  # Ignorer les réaffectations à l'identique
+    tables = {getattr(obj, '__tablename__', None) for obj in list(session.new) + modifies + list(session.deleted)}
+    if tables & set(VERSIONS_PAR_TABLE):
+        _incrementer_versions(session.connection(), tables)
 
-    code = db.Column(db.String(50))  # INCENDIE, FORMATION
-    type = db.Column(db.String(100))  # EPI, SST
-    nbre = db.Column(db.Float, default=1)
-    pu_ht = db.Column(db.Float, default=0)
-    pt_ht = db.Column(db.Float, default=0)
 
+@sa_event.listens_for(SaSession, 'do_orm_execute')
+def _versions_apres_bulk(orm_execute_state):
+    """UPDATE/DELETE en masse (query.update/delete) : incrément après exécution"""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.local_table.name not in VERSIONS_PAR_TABLE:
+        return None
+    resultat = orm_execute_state.invoke_statement()
+    if getattr(resultat, 'rowcount', 1):  # Rien à invalider si aucune ligne touchée
+        _incrementer_versions(orm_execute_state.session.connection(), [mapper.local_table.name])
+    return resultat
 
 
+def lire_version_donnees(nom):
+    """Version courante d'un groupe de données (0 si jamais modifié)"""
+    return db.session.query(VersionDonnees.version).filter_by(nom=nom).scalar() or 0
+
 
 # ============================================================================
-# CONTEXT PROCESSOR - Variables globales pour tous les templates
+# SERVICE DE COMPTEURS (badges factures, paiements, tâches urgentes)
 # ============================================================================
 
-@app.context_processor
-def inject_global_vars():
-    """Injecter des variables globales dans tous les templates"""
+app.config.setdefault('BADGES_CACHE_SECONDES', 300)  # Durée de vie max du cache (changement de date)
 
-    # Compter les factures en retard (factures dont le délai de paiement est dépassé)
-    factures_retard = 0
-    try:
-        factures = Facture.query.all()
-        for facture in factures:
-            # Vérifier si un paiement existe et est payé
-            paiements_complets = Paiement.query.filter_by(
-                facture_id=facture.id,
-                statut='Payé'
-            ).first()
+_badges_cache = {'valeurs': None, 'calcule_le': None}
+_badges_lock = threading.Lock()
 
-            if not paiements_complets:
-                # Calculer la date butoir
-                if facture.date_facture and facture.prestation and facture.prestation.client:
-                    delai = facture.prestation.client.delai_paiement_jours or 30
-                    date_butoir = facture.date_facture + timedelta(days=delai)
 
-                    # Si aujourd'hui > date butoir, c'est en retard
-                    if datetime.now().date() > date_butoir:
-                        factures_retard += 1
-    except:
-        pass
+def calculer_compteurs_badges():
+    """
+    Calcule les compteurs des badges avec des requêtes SQL agrégées
+    Retourne un dictionnaire (factures en retard / en cours, paiements en retard, tâches urgentes)
+    """
+    maintenant = datetime.now()
+    aujourd_hui = maintenant.date().isoformat()
+
+    # Factures non payées : une seule requête pour "en retard" et "en cours"
+    paiement_complet = db.session.query(Paiement.id).filter(
+        Paiement.facture_id == Facture.id,
+        Paiement.statut == 'Payé'
+    ).exists()
+    delai = func.coalesce(func.nullif(Client.delai_paiement_jours, 0), 30)
+    en_retard = db.and_(
+        Facture.date_facture.isnot(None),
+        Client.id.isnot(None),
+        func.julianday(Facture.date_facture) + delai < func.julianday(aujourd_hui)
+    )
+    factures_retard, factures_en_cours = db.session.query(
+        func.coalesce(func.sum(db.case((en_retard, 1), else_=0)), 0),
+        func.coalesce(func.sum(db.case((Facture.date_envoi.isnot(None), 1), else_=0)), 0)
+    ).select_from(Facture).outerjoin(
+        Prestation, Facture.prestation_id == Prestation.id
+    ).outerjoin(
+        Client, Prestation.client_id == Client.id
+    ).filter(~paiement_complet).one()
+
+    # Paiements en attente dont la date butoir est dépassée
+    paiements_retard = db.session.query(func.count(Paiement.id)).filter(
+        Paiement.statut.in_(['En attente', 'Partiel']),
+        Paiement.date_butoir < maintenant.date()
+    ).scalar() or 0
+
+    # Tâches non terminées dont l'échéance est dans moins de 8 jours (ou dépassée), 10 max
+    filtre_taches = db.and_(
+        Prestation.titre_tache.isnot(None),
+        Prestation.statut_tache.in_(['À faire', 'En cours']),
+        Prestation.date_echeance_tache.isnot(None),
+        Prestation.date_echeance_tache < maintenant + timedelta(days=8)
+    )
+    taches_urgentes_count = db.session.query(func.count(Prestation.id)).filter(filtre_taches).scalar() or 0
+    lignes_taches = db.session.query(
+        Prestation.id, Prestation.titre_tache, Prestation.priorite_tache,
+        Prestation.statut_tache, Prestation.date_echeance_tache, Client.nom
+    ).outerjoin(Client, Prestation.client_id == Client.id).filter(
+        filtre_taches
+    ).order_by(Prestation.date_echeance_tache).limit(10).all()
 
-    # Compter les paiements en retard (paiements dont la date butoir est dépassée)
-    paiements_retard = 0
-    try:
-        paiements = Paiement.query.filter(Paiement.statut.in_(['En attente', 'Partiel'])).all()
-        for paiement in paiements:
-            if paiement.date_butoir and datetime.now().date() > paiement.date_butoir:
-                paiements_retard += 1
-    except:
-        pass
+    taches_urgentes = []
+    for prestation_id, titre, priorite, statut, echeance, client_nom in lignes_taches:
+        jours_restants = (echeance - maintenant).days
+        taches_urgentes.append({
+            'prestation_id': prestation_id,
+            'titre': titre,
+            'client_nom': client_nom or 'Sans client',
+            'priorite': priorite,
+            'statut': statut,
+            'echeance': echeance,
+            'jours_restants': jours_restants,
+            'en_retard': jours_restants < 0
+        })
+
+    return {
+        'factures_retard': int(factures_retard),
+        'factures_en_cours': int(factures_en_cours),
+        'paiements_retard': int(paiements_retard),
+        'taches_urgentes': taches_urgentes,
+        'taches_urgentes_count': int(taches_urgentes_count)
+    }
+
+
+def get_compteurs_badges():
+    """Retourne les compteurs depuis le cache du processus (recalculés si invalidés ou expirés)"""
+    with _badges_lock:
+        valeurs = _badges_cache['valeurs']
+        calcule_le = _badges_cache['calcule_le']
+        if valeurs is not None and calcule_le is not None:
+            age = (datetime.now() - calcule_le).total_seconds()
+            if age < app.config['BADGES_CACHE_SECONDES'] and calcule_le.date() == datetime.now().date():
+                return valeurs
+
+        valeurs = calculer_compteurs_badges()
+        _badges_cache['valeurs'] = valeurs
+        _badges_cache['calcule_le'] = datetime.now()
+        return valeurs
+
+
+@apres_commit_sur('factures', 'paiements', 'prestations', 'clients')
+def invalider_compteurs_badges(tables=None):
+    """Vide le cache des compteurs (appelé après un commit sur les tables concernées)"""
+    with _badges_lock:
+        _badges_cache['valeurs'] = None
+        _badges_cache['calcule_le'] = None
+
+
+# ============================================================================
+# BALAYAGE DES STATUTS - Passage automatique des prestations dépassées en "Terminée"
+# ============================================================================
+
+# Intervalle entre deux balayages en secondes (0 = désactivé)
+app.config.setdefault('BALAYAGE_STATUTS_INTERVALLE', int(os.environ.get('BALAYAGE_STATUTS_INTERVALLE', 300)))
 
-    # Compter les factures en cours (factures envoyées mais non payées)
-    factures_en_cours = 0
+STATUTS_A_TERMINER = ['Planifiée', 'En cours', 'Demandée']
+
+# Dernière exécution du balayage (affichée dans les diagnostics)
+balayage_statuts_info = {
+    'derniere_execution': None,
+    'duree_ms': None,
+    'lignes_modifiees': None,
+    'total_lignes_modifiees': 0,
+    'nb_executions': 0,
+    'derniere_erreur': None
+}
+
+_balayage_arret = threading.Event()
+
+
+@reessayer_si_verrouille
+def verifier_statuts_prestations():
+    """
+    Met à jour les prestations dépassées en une seule requête UPDATE
+    Retourne le nombre de prestations passées en "Terminée"
+    """
+    debut = time.perf_counter()
+    filtres = (Prestation.statut.in_(STATUTS_A_TERMINER), Prestation.date_fin < datetime.now())
     try:
-        factures = Facture.query.filter(Facture.date_envoi.isnot(None)).all()
-        for facture in factures:
-            # Vérifier si un paiement existe et est payé
-            paiements_complets = Paiement.query.filter_by(
-                facture_id=facture.id,
-                statut='Payé'
-            ).first()
+        # Années concernées : seules celles-ci sont invalidées dans le cache des statistiques
+        annees = {int(annee) for (annee,) in db.session.query(
+            func.strftime('%Y', Prestation.date_debut)
+        ).filter(*filtres).distinct() if annee}
+        nb_lignes = Prestation.query.filter(*filtres).execution_options(annees_stats=annees).update(
+            {Prestation.statut: 'Terminée'}, synchronize_session=False
+        )
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        balayage_statuts_info['derniere_erreur'] = str(e)
+        raise
 
-            if not paiements_complets:
-                factures_en_cours += 1
-    except:
-        pass
+    balayage_statuts_info['derniere_execution'] = datetime.now()
+    balayage_statuts_info['duree_ms'] = round((time.perf_counter() - debut) * 1000, 1)
+    balayage_statuts_info['lignes_modifiees'] = nb_lignes
+    balayage_statuts_info['total_lignes_modifiees'] += nb_lignes
+    balayage_statuts_info['nb_executions'] += 1
+
+    if nb_lignes:
+        print(f"✅ {nb_lignes} prestation(s) passée(s) en Terminée")
+    return nb_lignes
+
+
+def _boucle_balayage_statuts():
+    """Thread de fond : exécute le balayage à intervalle régulier"""
+    while not _balayage_arret.is_set():
+        try:
+            with app.app_context():
+                verifier_statuts_prestations()
+                db.session.remove()
+        except Exception as e:
+            print(f"⚠️ Erreur balayage des statuts: {e}")
+        _balayage_arret.wait(app.config['BALAYAGE_STATUTS_INTERVALLE'])
+
+
+def demarrer_balayage_statuts():
+    """Démarre le thread de balayage (une seule fois par processus)"""
+    if app.config['BALAYAGE_STATUTS_INTERVALLE'] <= 0:
+        return None
+    thread = threading.Thread(target=_boucle_balayage_statuts, name='balayage-statuts', daemon=True)
+    thread.start()
+    return thread
+
+
+# ============================================================================
+# CONTEXT PROCESSOR - Variables globales pour tous les templates
+# ============================================================================
+
+@app.context_processor
+def inject_global_vars():
+    """Injecter des variables globales dans tous les templates"""
+
+    # Compteurs des badges (factures en retard / en cours, paiements en retard, tâches urgentes)
+    try:
+        compteurs = get_compteurs_badges()
+    except Exception as e:
+        print(f"⚠️ Erreur calcul des compteurs: {e}")
+        db.session.rollback()
+        compteurs = {
+            'factures_retard': 0,
+            'factures_en_cours': 0,
+            'paiements_retard': 0,
+            'taches_urgentes': [],
+            'taches_urgentes_count': 0
+        }
 
     # Info sauvegarde
     derniere_sauv = Sauvegarde.query.order_by(Sauvegarde.date_sauvegarde.desc()).first()
@@ -800,55 +1292,17 @@ def inject_global_vars():
         delta = datetime.now() - derniere_sauv.date_sauvegarde
         jours_backup = delta.days
 
-    # Tâches urgentes : prestations avec tâches non terminées et échéance proche
-    taches_urgentes = []
-    try:
-        aujourd_hui = datetime.now()
-        dans_7_jours = aujourd_hui + timedelta(days=7)
-
-        # Récupérer les prestations avec tâches non terminées
-        prestations_taches = Prestation.query.filter(
-            Prestation.titre_tache.isnot(None),
-            Prestation.statut_tache.in_(['À faire', 'En cours'])
-        ).all()
-
-        for p in prestations_taches:
-            # Vérifier si la tâche a une échéance
-            if p.date_echeance_tache:
-                # Calculer les jours restants
-                jours_restants = (p.date_echeance_tache - aujourd_hui).days
-
-                # Ajouter si échéance dans les 7 prochains jours ou dépassée
-                if jours_restants <= 7:
-                    taches_urgentes.append({
-                        'prestation_id': p.id,
-                        'titre': p.titre_tache,
-                        'client_nom': p.client.nom if p.client else 'Sans client',
-                        'priorite': p.priorite_tache,
-                        'statut': p.statut_tache,
-                        'echeance': p.date_echeance_tache,
-                        'jours_restants': jours_restants,
-                        'en_retard': jours_restants < 0
-                    })
-
-        # Trier par échéance (les plus urgentes en premier)
-        taches_urgentes.sort(key=lambda x: x['echeance'])
-
-        # Limiter à 5 tâches maximum dans le footer
-        taches_urgentes = taches_urgentes[:5]
-    except:
-        taches_urgentes = []
-
     # Retourner directement la date (pas l'objet)
     date_sauvegarde = derniere_sauv.date_sauvegarde if derniere_sauv else None
 
     return dict(
-        factures_retard_count=factures_retard,
-        paiements_retard_count=paiements_retard,
-        factures_en_cours_count=factures_en_cours,
+        factures_retard_count=compteurs['factures_retard'],
+        paiements_retard_count=compteurs['paiements_retard'],
+        factures_en_cours_count=compteurs['factures_en_cours'],
         derniere_sauvegarde=date_sauvegarde,
         jours_depuis_backup=jours_backup,
-        taches_urgentes=taches_urgentes,
+        taches_urgentes=compteurs['taches_urgentes'],
+        taches_urgentes_count=compteurs['taches_urgentes_count'],
         now=datetime.now,  # Ajouter la fonction now pour les templates
         datetime=datetime  # Ajouter l'objet datetime pour les templates
     )
@@ -924,44 +1378,22 @@ def check_login():
 @login_required
 def index():
     """Page d'accueil - Tableau de bord"""
-    verifier_statuts_prestations()
-    
     now = datetime.now()
-    debut_annee = datetime(now.year, 1, 1)
-    fin_annee = datetime(now.year, 12, 31, 23, 59, 59)
-    debut_mois = datetime(now.year, now.month, 1)
-    
-    if now.month == 12:
-        fin_mois = datetime(now.year + 1, 1, 1)
-    else:
-        fin_mois = datetime(now.year, now.month + 1, 1)
-    
+
+    # Cumuls de l'année lus dans stats_mensuelles (via le cache par année)
+    stats_annee = get_stats_annee(now.year)
+
     stats = {
         'nb_clients': Client.query.filter_by(actif=True).count(),
-        'nb_prestations': Prestation.query.filter(
-            Prestation.date_debut >= debut_annee,
-            Prestation.date_debut <= fin_annee
-        ).count(),
+        'nb_prestations': sum(m['nb_prestations'] for m in stats_annee['mois']),
         'nb_en_cours': Prestation.query.filter_by(statut='En cours').count(),
-        'nb_ce_mois': Prestation.query.filter(
-            Prestation.date_debut >= debut_mois,
-            Prestation.date_debut < fin_mois
-        ).count(),
-        'ca_total': int(db.session.query(func.sum(Prestation.tarif_total)).filter(
-            Prestation.date_debut >= debut_annee,
-            Prestation.date_debut <= fin_annee
-        ).scalar() or 0),
+        'nb_ce_mois': stats_annee['mois'][now.month - 1]['nb_prestations'],
+        'ca_total': int(sum(m['ca'] for m in stats_annee['mois'])),
         'nb_factures_payees': 0
     }
     
-    date_limite = now + timedelta(days=7)
-    taches_urgentes = Prestation.query.filter(
-        Prestation.date_echeance_tache.isnot(None),
-        Prestation.date_echeance_tache <= date_limite,
-        Prestation.statut_tache != 'Terminée'
-    ).order_by(Prestation.date_echeance_tache).limit(10).all()
-    
-    return render_template('dashboard.html', stats=stats, taches_urgentes=taches_urgentes)
+    # Les tâches urgentes sont fournies par le service de compteurs (context processor)
+    return render_template('dashboard.html', stats=stats)
 
 # ============================================================================
 # ROUTES CLIENTS
@@ -1130,19 +1562,14 @@ def client_nouveau():
             calendrier_google=request.form.get('calendrier_google') or None,
             statut_client=request.form.get('statut_client', 'Client')  # Par défaut 'Client', peut être 'Prospect'
         )
+        localiser(client, request.form)
         db.session.add(client)
         db.session.commit()
         flash('Client créé avec succès !', 'success')
         return redirect(url_for('clients'))
 
-    # Récupérer la liste des calendriers Google disponibles
-    calendriers = []
-    try:
-        service = get_calendar_service()
-        if service:
-            calendriers = get_filtered_calendars(service)
-    except:
-        pass
+    # Liste des calendriers Google disponibles (cache, rafraîchie en arrière-plan)
+    calendriers = calendriers_google()
 
     return render_template('client_form.html', client=None, calendriers=calendriers)
 
@@ -1170,19 +1597,14 @@ def client_modifier(client_id):
         client.notes = request.form.get('notes')
         client.delai_paiement_jours = int(request.form.get('delai_paiement_jours', 30))
         client.calendrier_google = request.form.get('calendrier_google') or None
+        localiser(client, request.form)
 
         db.session.commit()
         flash('Client modifié avec succès !', 'success')
         return redirect(url_for('client_detail', client_id=client_id))
 
-    # Récupérer la liste des calendriers Google disponibles
-    calendriers = []
-    try:
-        service = get_calendar_service()
-        if service:
-            calendriers = get_filtered_calendars(service)
-    except:
-        pass
+    # Liste des calendriers Google disponibles (cache, rafraîchie en arrière-plan)
+    calendriers = calendriers_google()
 
     return render_template('client_form.html', client=client, calendriers=calendriers)
 
@@ -1281,45 +1703,205 @@ def contact_supprimer(contact_id):
 # ROUTES PRESTATIONS
 # ============================================================================
 
-@app.route('/api/prestations')
-def api_prestations():
-    """API pour récupérer toutes les prestations en JSON"""
-    prestations = Prestation.query.order_by(Prestation.date_debut.desc()).all()
-    
-    data = []
-    for p in prestations:
-        data.append({
-            'id': p.id,
-            'date_debut': p.date_debut.strftime('%d/%m/%Y') if p.date_debut else '-',
-            'client': f"{p.client.prenom or ''} {p.client.nom}".strip() if p.client else 'Sans client',
-            'type': p.type_prestation or '-',
-            'lieu': p.lieu or '-',
-            'statut': p.statut or 'En attente',
-            'tarif': p.tarif_total or 0
-        })
-    
-    return jsonify(data)
-
+# Liste paginée par curseur (keyset) : coût constant quelle que soit la profondeur de la page
+app.config.setdefault('PRESTATIONS_PAR_PAGE', 50)
 
-@app.route('/prestations')
-def prestations():
-    """Liste des prestations"""
-    verifier_statuts_prestations()  # ← AJOUTEZ ICI AUSSI
-    filtre_statut = request.args.get('statut', 'all')
+def _cles_tri_prestations():
+    """Clés de tri autorisées : (expression SQL, conversion de la valeur du curseur)"""
+    return {
+        'date': (Prestation.date_debut, datetime.fromisoformat),
+        'client': (Client.nom, str),
+        'tarif': (func.coalesce(Prestation.tarif_total, 0.0), float)
+    }
 
-    query = Prestation.query
 
-    if filtre_statut != 'all':
-        query = query.filter_by(statut=filtre_statut)
+def _nom_client_prestation(p):
+    """Nom affiché du client d'une prestation"""
+    return f"{p.client.prenom or ''} {p.client.nom}".strip() if p.client else 'Sans client'
+
+
+# Champs disponibles pour /api/prestations (?champs=id,client,statut)
+CHAMPS_API_PRESTATION = {
+    'id': lambda p: p.id,
+    'date_debut': lambda p: p.date_debut.strftime('%d/%m/%Y') if p.date_debut else '-',
+    'date_debut_iso': lambda p: p.date_debut.isoformat() if p.date_debut else None,
+    'date_fin_iso': lambda p: p.date_fin.isoformat() if p.date_fin else None,
+    'client': _nom_client_prestation,
+    'client_id': lambda p: p.client_id,
+    'titre': lambda p: p.titre,
+    'theme': lambda p: p.theme_prestation,
+    'domaine': lambda p: p.domaine_prestation,
+    'type': lambda p: p.type_prestation or '-',
+    'lieu': lambda p: p.lieu or '-',
+    'ville': lambda p: p.ville_prestation,
+    'statut': lambda p: p.statut or 'En attente',
+    'tarif': lambda p: p.tarif_total or 0
+}
+CHAMPS_API_PRESTATION_DEFAUT = ['id', 'date_debut', 'client', 'type', 'lieu', 'statut', 'tarif']
 
-    prestations = query.order_by(Prestation.date_debut.desc()).all()
-    return render_template('prestations.html', prestations=prestations, filtre_statut=filtre_statut)
 
+def _encoder_curseur(valeur, identifiant):
+    """Curseur opaque (base64) contenant la clé de tri et l'id de la dernière ligne"""
+    if isinstance(valeur, datetime):
+        valeur = valeur.isoformat()
+    brut = json.dumps([valeur, identifiant]).encode('utf-8')
+    return base64.urlsafe_b64encode(brut).decode('ascii')
 
-@app.route('/ouvrir_commande/<int:prestation_id>')
-def ouvrir_commande(prestation_id):
-    """Ouvre le PDF de commande - Format: AAAAMMJJ-JJMMAAAA.pdf"""
-    prestation = Prestation.query.get_or_404(prestation_id)
+
+def _decoder_curseur(curseur, conversion):
+    """Retourne (valeur, id) ou None si le curseur est invalide"""
+    try:
+        valeur, identifiant = json.loads(base64.urlsafe_b64decode(curseur.encode('ascii')))
+        return conversion(valeur), int(identifiant)
+    except Exception:
+        return None
+
+
+def lire_filtres_prestations(args):
+    """Filtres de la liste des prestations à partir des paramètres de requête"""
+    def date_param(nom):
+        try:
+            return datetime.strptime(args.get(nom, ''), '%Y-%m-%d')
+        except ValueError:
+            return None
+
+    statut = args.get('statut', '')
+    return {
+        'statut': '' if statut == 'all' else statut,
+        'theme': args.get('theme', ''),
+        'client_id': args.get('client_id', type=int),
+        'date_du': date_param('date_du'),
+        'date_au': date_param('date_au'),
+        'ville': args.get('ville', '').strip(),
+        'q': args.get('q', '').strip()
+    }
+
+
+def rechercher_prestations(filtres, tri='date', ordre='desc', apres=None, limite=None, avec_total=False):
+    """
+    Page de prestations filtrée et triée, paginée par curseur sur (clé de tri, id)
+    Le client est chargé par jointure (pas de requête par ligne)
+    Retourne {'prestations', 'suivant' (curseur ou None), 'total' (si avec_total)}
+    """
+    cles = _cles_tri_prestations()
+    tri = tri if tri in cles else 'date'
+    ordre = 'asc' if ordre == 'asc' else 'desc'
+    limite = max(1, min(limite or app.config['PRESTATIONS_PAR_PAGE'], 500))
+    expression, conversion = cles[tri]
+
+    query = Prestation.query.outerjoin(Client, Prestation.client_id == Client.id).options(
+        db.contains_eager(Prestation.client)
+    )
+
+    if filtres.get('statut'):
+        query = query.filter(Prestation.statut == filtres['statut'])
+    if filtres.get('theme'):
+        query = query.filter(Prestation.theme_prestation == filtres['theme'])
+    if filtres.get('client_id'):
+        query = query.filter(Prestation.client_id == filtres['client_id'])
+    if filtres.get('date_du'):
+        query = query.filter(Prestation.date_debut >= filtres['date_du'])
+    if filtres.get('date_au'):
+        query = query.filter(Prestation.date_debut < filtres['date_au'] + timedelta(days=1))
+    if filtres.get('ville'):
+        query = query.filter(Prestation.ville_prestation.ilike(f"{filtres['ville']}%"))
+    if filtres.get('q'):
+        motif = f"%{filtres['q']}%"
+        query = query.filter(db.or_(
+            Client.nom.ilike(motif),
+            Client.prenom.ilike(motif),
+            Prestation.type_prestation.ilike(motif),
+            Prestation.lieu.ilike(motif),
+            Prestation.titre.ilike(motif)
+        ))
+
+    total = query.order_by(None).count() if avec_total else None
+
+    position = _decoder_curseur(apres, conversion) if apres else None
+    if position is not None:
+        cle = db.tuple_(expression, Prestation.id)
+        query = query.filter(cle > position if ordre == 'asc' else cle < position)
+
+    if ordre == 'asc':
+        query = query.order_by(expression.asc(), Prestation.id.asc())
+    else:
+        query = query.order_by(expression.desc(), Prestation.id.desc())
+
+    prestations = query.limit(limite + 1).all()
+    suivant = None
+    if len(prestations) > limite:
+        prestations = prestations[:limite]
+        derniere = prestations[-1]
+        valeur = {
+            'date': derniere.date_debut,
+            'client': derniere.client.nom if derniere.client else '',
+            'tarif': derniere.tarif_total or 0.0
+        }[tri]
+        suivant = _encoder_curseur(valeur, derniere.id)
+
+    return {'prestations': prestations, 'suivant': suivant, 'total': total}
+
+
+def serialiser_prestations(prestations, champs=None):
+    """Liste JSON des prestations limitée aux champs demandés"""
+    champs = [c for c in (champs or CHAMPS_API_PRESTATION_DEFAUT) if c in CHAMPS_API_PRESTATION]
+    return [{c: CHAMPS_API_PRESTATION[c](p) for c in champs} for p in prestations]
+
+
+@app.route('/api/prestations')
+def api_prestations():
+    """
+    API des prestations en JSON, paginée par curseur
+    Paramètres : statut, theme, client_id, date_du, date_au (AAAA-MM-JJ), ville, q,
+    tri (date|client|tarif), ordre (asc|desc), apres (curseur), limite, champs (liste séparée par des virgules)
+    """
+    champs = [c.strip() for c in request.args.get('champs', '').split(',') if c.strip()] or None
+    resultat = rechercher_prestations(
+        lire_filtres_prestations(request.args),
+        tri=request.args.get('tri', 'date'),
+        ordre=request.args.get('ordre', 'desc'),
+        apres=request.args.get('apres'),
+        limite=request.args.get('limite', type=int),
+        avec_total=not request.args.get('apres')
+    )
+
+    return jsonify({
+        'prestations': serialiser_prestations(resultat['prestations'], champs),
+        'suivant': resultat['suivant'],
+        'total': resultat['total']
+    })
+
+
+@app.route('/prestations')
+def prestations():
+    """Liste des prestations (première page rendue côté serveur, suite via /api/prestations)"""
+    filtres = lire_filtres_prestations(request.args)
+    tri = request.args.get('tri', 'date')
+    ordre = request.args.get('ordre', 'desc')
+
+    resultat = rechercher_prestations(filtres, tri=tri, ordre=ordre, avec_total=True)
+    premiere_page = {
+        'prestations': serialiser_prestations(resultat['prestations']),
+        'suivant': resultat['suivant'],
+        'total': resultat['total']
+    }
+
+    # Thèmes lus dans la table de cumuls (quelques lignes) plutôt que sur toutes les prestations
+    themes = [t for (t,) in db.session.query(StatMensuelle.theme).distinct().order_by(StatMensuelle.theme) if t]
+
+    return render_template('prestations.html',
+                         premiere_page=premiere_page,
+                         filtres=filtres,
+                         filtre_statut=filtres['statut'] or 'all',
+                         tri=tri,
+                         ordre=ordre,
+                         themes=themes)
+
+
+@app.route('/ouvrir_commande/<int:prestation_id>')
+def ouvrir_commande(prestation_id):
+    """Ouvre le PDF de commande - Format: AAAAMMJJ-JJMMAAAA.pdf"""
+    prestation = Prestation.query.get_or_404(prestation_id)
 
     try:
         date_presta_str = prestation.date_debut.strftime('%Y%m%d')
@@ -1365,7 +1947,9 @@ def ouvrir_commande(prestation_id):
 def prestation_detail(prestation_id):
     """Détail d'une prestation"""
     prestation = Prestation.query.get_or_404(prestation_id)
-    return render_template('prestation_detail.html', prestation=prestation)
+    # État de la synchronisation Google Calendar en file d'attente (None si jamais planifiée)
+    sync_gcal = GcalFileAttente.query.filter_by(nature='prestation', objet_id=prestation_id).first()
+    return render_template('prestation_detail.html', prestation=prestation, sync_gcal=sync_gcal)
 
 @app.route('/prestation/<int:prestation_id>/tarifs')
 def prestation_tarifs(prestation_id):
@@ -1379,73 +1963,16 @@ def prestation_sauvegarder_tarifs(prestation_id):
     """Sauvegarder les lignes de tarif détaillées de la prestation"""
     prestation = Prestation.query.get_or_404(prestation_id)
 
-    # Supprimer les anciennes lignes
-    LignePrestationDeplacement.query.filter_by(prestation_id=prestation_id).delete()
-    LignePrestationFourniture.query.filter_by(prestation_id=prestation_id).delete()
-    LignePrestationTarif.query.filter_by(prestation_id=prestation_id).delete()
-
-    # Traiter les lignes de déplacement
-    codes_dep = request.form.getlist('deplacement_code[]')
-    types_dep = request.form.getlist('deplacement_type[]')
-    nbres_dep = request.form.getlist('deplacement_nbre[]')
-    pus_dep = request.form.getlist('deplacement_pu_ht[]')
-    pts_dep = request.form.getlist('deplacement_pt_ht[]')
-
-    total_deplacement = 0
-    for i in range(len(codes_dep)):
-        if types_dep[i].strip():  # Ne créer que si le type n'est pas vide
-            ligne = LignePrestationDeplacement(
-                prestation_id=prestation_id,
-                code=codes_dep[i].strip() or None,
-                type=types_dep[i].strip(),
-                nbre=float(nbres_dep[i]) if nbres_dep[i] else 0,
-                pu_ht=float(pus_dep[i]) if pus_dep[i] else 0,
-                pt_ht=float(pts_dep[i]) if pts_dep[i] else 0
-            )
-            db.session.add(ligne)
-            total_deplacement += ligne.pt_ht
-
-    # Traiter les lignes de fourniture
-    codes_four = request.form.getlist('fourniture_code[]')
-    types_four = request.form.getlist('fourniture_type[]')
-    nbres_four = request.form.getlist('fourniture_nbre[]')
-    pus_four = request.form.getlist('fourniture_pu_ht[]')
-    pts_four = request.form.getlist('fourniture_pt_ht[]')
-
-    total_fourniture = 0
-    for i in range(len(codes_four)):
-        if types_four[i].strip():
-            ligne = LignePrestationFourniture(
-                prestation_id=prestation_id,
-                code=codes_four[i].strip() or None,
-                type=types_four[i].strip(),
-                nbre=float(nbres_four[i]) if nbres_four[i] else 0,
-                pu_ht=float(pus_four[i]) if pus_four[i] else 0,
-                pt_ht=float(pts_four[i]) if pts_four[i] else 0
-            )
-            db.session.add(ligne)
-            total_fourniture += ligne.pt_ht
-
-    # Traiter les lignes de prestation/tarif
-    codes_prest = request.form.getlist('prestation_code[]')
-    types_prest = request.form.getlist('prestation_type[]')
-    nbres_prest = request.form.getlist('prestation_nbre[]')
-    pus_prest = request.form.getlist('prestation_pu_ht[]')
-    pts_prest = request.form.getlist('prestation_pt_ht[]')
-
-    total_prestation = 0
-    for i in range(len(codes_prest)):
-        if types_prest[i].strip():
-            ligne = LignePrestationTarif(
-                prestation_id=prestation_id,
-                code=codes_prest[i].strip() or None,
-                type=types_prest[i].strip(),
-                nbre=float(nbres_prest[i]) if nbres_prest[i] else 0,
-                pu_ht=float(pus_prest[i]) if pus_prest[i] else 0,
-                pt_ht=float(pts_prest[i]) if pts_prest[i] else 0
-            )
-            db.session.add(ligne)
-            total_prestation += ligne.pt_ht
+    try:
+        lignes, totaux = lire_lignes_formulaire(request.form)
+    except ValueError as e:
+        flash(f'❌ {str(e)}', 'error')
+        return redirect(url_for('prestation_detail', prestation_id=prestation_id))
+
+    enregistrer_lignes('prestation', prestation_id, lignes)
+    total_deplacement = totaux['deplacement']
+    total_fourniture = totaux['fourniture']
+    total_prestation = totaux['prestation']
 
     # Mettre à jour les totaux globaux dans la prestation (pour compatibilité)
     prestation.frais_deplacement = total_deplacement
@@ -1577,6 +2104,7 @@ def prestation_nouvelle():
             prestation.creneau = creneau_0
             prestation.journee_entiere = journee_complete_premiere
 
+        localiser_prestation(prestation, request.form)
         db.session.add(prestation)
         db.session.flush()  # Pour obtenir l'ID (maintenant date_debut est rempli)
 
@@ -1623,57 +2151,23 @@ def prestation_nouvelle():
             )
             db.session.add(session)
 
+        # Synchronisation Google Calendar en file d'attente, validée avec la prestation :
+        # l'enregistrement n'attend pas Google (état affiché sur la fiche de la prestation)
+        planifier_sync_gcal('prestation', prestation.id)
         db.session.commit()
 
-        # NOUVEAU SYSTÈME : Synchronisation Google Calendar avec rappels personnalisés
-        print("\n" + "🔄" * 40)
-        print("NOUVEAU SYSTÈME DE SYNCHRONISATION GOOGLE CALENDAR")
-        print("🔄" * 40 + "\n")
-
-        try:
-            # Récupérer le client
-            client = Client.query.get(prestation.client_id)
-
-            print("🔵🔵🔵 DEBUG AVANT GOOGLE CALENDAR 🔵🔵🔵")
-            print("prestation.calendrier_id:", prestation.calendrier_id)
-            print("client.calendrier_google:", client.calendrier_google if client else "None")
-            print("🔵🔵🔵🔵🔵🔵🔵🔵🔵🔵🔵🔵🔵🔵🔵")
-
-            # Utiliser la NOUVELLE fonction avec logique de sélection de calendrier :
-            # 1. prestation.calendrier_id (si défini)
-            # 2. client.calendrier_google (si défini)
-            # 3. calendrier principal (par défaut)
-            success, message, event_id = sync_prestation_to_gcal(prestation.id)
-
-            if success:
-                prestation.gcal_event_id = event_id
-                prestation.gcal_synced = True
-                prestation.gcal_last_sync = datetime.utcnow()
-                db.session.commit()
-                flash(f'✓ Prestation créée et synchronisée avec Google Calendar ! {message}', 'success')
-            else:
-                flash(f'⚠️ Prestation créée mais sync Google Calendar échouée : {message}', 'warning')
-
-        except Exception as ex:
-            print("❌ ERREUR sync Google Calendar: {str(ex)}")
-            import traceback
-            traceback.print_exc()
-            flash('Prestation créée avec succès (sync Google Calendar échouée)', 'warning')
+        if GOOGLE_CALENDAR_AVAILABLE:
+            flash('✓ Prestation créée, synchronisation Google Calendar en cours', 'success')
+        else:
+            flash('✓ Prestation créée avec succès !', 'success')
 
         return redirect(url_for('prestation_detail', prestation_id=prestation.id))
 
     clients = Client.query.filter_by(actif=True).order_by(Client.nom).all()
 
-    # DÉSACTIVÉ : Récupération des calendriers Google (cause timeout de 20-30s)
-    # La liste des calendriers n'est pas utilisée dans le formulaire
-    # Le calendrier est sélectionné automatiquement via client.calendrier_google
-    calendriers = []
-    # try:
-    #     service = get_calendar_service()
-    #     if service:
-    #         calendriers = get_filtered_calendars(service)
-    # except:
-    #     pass
+    # Liste des calendriers Google lue en cache (aucun appel à Google pendant la requête)
+    # Sans choix dans le formulaire, le calendrier reste celui du client (client.calendrier_google)
+    calendriers = calendriers_google()
 
     return render_template('prestation_form.html', prestation=None, clients=clients, calendriers=calendriers)
 
@@ -1738,8 +2232,11 @@ def prestation_modifier(prestation_id):
         prestation.statut_tache = request.form.get('statut_tache', 'À faire')
         # Google Calendar
         prestation.calendrier_id = request.form.get('calendrier_id') or None
+        localiser_prestation(prestation, request.form)
 
         # Gérer les sessions : supprimer celles qui n'existent plus et créer/mettre à jour
+        # (liste relevée avant les ajouts : les nouvelles sessions ne doivent pas être prises pour des sessions retirées)
+        sessions_avant = list(prestation.sessions)
         existing_session_ids = set()
         for i, date_debut_str in enumerate(sessions_dates_debut):
             if not date_debut_str:
@@ -1804,37 +2301,28 @@ def prestation_modifier(prestation_id):
                 prestation.journee_entiere = journee_complete
 
         # Supprimer les sessions qui ont été retirées
-        for session in prestation.sessions:
+        for session in sessions_avant:
             if session.id not in existing_session_ids:
                 db.session.delete(session)
 
-        db.session.commit()
-
-        # Gestion automatique Google Calendar
-        try:
-            nouveau_statut = prestation.statut
+        # Gestion automatique Google Calendar, mise en file dans la même transaction
+        nouveau_statut = prestation.statut
 
-            # Si la prestation passe à "Annulée" et était synchronisée → supprimer de Google Calendar
-            if nouveau_statut == 'Annulée' and etait_synchronisee:
-                success, message = delete_gcal_event(prestation_id)
-                if success:
-                    flash(f'✓ Prestation annulée et supprimée de Google Calendar', 'success')
-                else:
-                    flash(f'✓ Prestation modifiée (échec suppression Google Calendar : {message})', 'warning')
+        # Si la prestation passe à "Annulée" et était synchronisée → supprimer de Google Calendar
+        if nouveau_statut == 'Annulée' and etait_synchronisee:
+            planifier_suppression_prestation_gcal(prestation)
+            message = '✓ Prestation annulée, suppression de Google Calendar en cours'
 
-            # Si la prestation était déjà synchronisée et n'est PAS annulée → mettre à jour
-            elif etait_synchronisee and nouveau_statut != 'Annulée':
-                success, message, event_id = sync_prestation_to_gcal(prestation_id)
-                if success:
-                    flash(f'✓ Prestation modifiée et mise à jour sur Google Calendar', 'success')
-                else:
-                    flash(f'✓ Prestation modifiée (échec mise à jour Google Calendar : {message})', 'warning')
+        # Si la prestation était déjà synchronisée et n'est PAS annulée → mettre à jour
+        elif etait_synchronisee and nouveau_statut != 'Annulée':
+            planifier_sync_gcal('prestation', prestation_id)
+            message = '✓ Prestation modifiée, mise à jour Google Calendar en cours'
 
-            else:
-                flash('Prestation modifiée avec succès !', 'success')
+        else:
+            message = 'Prestation modifiée avec succès !'
 
-        except:
-            flash('Prestation modifiée avec succès !', 'success')
+        db.session.commit()
+        flash(message, 'success')
 
         return redirect(url_for('prestation_detail', prestation_id=prestation_id))
 
@@ -1856,45 +2344,34 @@ def prestation_modifier(prestation_id):
         # Recharger la prestation pour avoir les sessions
         db.session.refresh(prestation)
 
-    # DÉSACTIVÉ : Récupération des calendriers Google (cause timeout de 20-30s)
-    # La liste des calendriers n'est pas utilisée dans le formulaire
-    # Le calendrier est sélectionné automatiquement via client.calendrier_google
-    calendriers = []
-    # try:
-    #     service = get_calendar_service()
-    #     if service:
-    #         calendriers = get_filtered_calendars(service)
-    # except:
-    #     pass
+    # Liste des calendriers Google lue en cache (aucun appel à Google pendant la requête)
+    # Sans choix dans le formulaire, le calendrier reste celui du client (client.calendrier_google)
+    calendriers = calendriers_google()
 
     return render_template('prestation_form.html', prestation=prestation, clients=clients, calendriers=calendriers)
 
 @app.route('/prestation/<int:prestation_id>/supprimer', methods=['POST'])
 def prestation_supprimer(prestation_id):
-    return prestation_supprimer(prestation_id)
     """Supprimer une prestation"""
     prestation = Prestation.query.get_or_404(prestation_id)
 
-    # Supprimer les événements Google Calendar associés
-    gcal_message = None
-    if prestation.gcal_event_id:
-        try:
-            success, message = delete_gcal_event(prestation_id)
-            if success:
-                gcal_message = message
-            else:
-                flash(f'⚠️ Échec suppression Google Calendar : {message}', 'warning')
-        except Exception as e:
-            flash(f'⚠️ Erreur Google Calendar : {str(e)}', 'warning')
+    # Supprimer les événements Google Calendar associés : la liste est relevée maintenant,
+    # la suppression chez Google est faite par la file d'attente après le commit
+    # (toujours planifiée : remplace une création encore en file)
+    evenements = evenements_gcal_prestation(prestation)
+    planifier_sync_gcal('prestation', prestation_id, 'delete', evenements, detacher=True)
 
     # Supprimer la prestation de la base de données
     # La relation cascade='all, delete-orphan' supprimera automatiquement les blocages
     db.session.delete(prestation)
+    db.session.flush()
+    # Événements des sessions supprimées : déjà dans la liste relevée, rien ne doit rester rattaché à cet identifiant
+    GcalEvenementSupprime.query.filter_by(prestation_id=prestation_id).delete()
     db.session.commit()
 
     # Message de succès
-    if gcal_message:
-        flash(f'✓ Prestation supprimée ! {gcal_message}', 'success')
+    if evenements and GOOGLE_CALENDAR_AVAILABLE:
+        flash('✓ Prestation supprimée ! Suppression de Google Calendar en cours', 'success')
     else:
         flash('✓ Prestation supprimée avec succès !', 'success')
 
@@ -1944,40 +2421,14 @@ def indisponibilite_nouvelle():
             db.session.add(indispo)
             db.session.flush()
             
-            gcal_event_id = None
+            # Événement Google Calendar créé par la file d'attente après le commit
+            planifier_sync_gcal('indisponibilite', indispo.id)
+            db.session.commit()
+
             if GOOGLE_CALENDAR_AVAILABLE:
-                try:
-                    service = get_calendar_service()
-                    if service:
-                        event_data = {
-                            'summary': f'🚫 INDISPONIBLE - {motif}',
-                            'description': note or f'Indisponibilité : {motif}',
-                            'start': {
-                                'date': date_debut.strftime('%Y-%m-%d'),
-                            },
-                            'end': {
-                                'date': (date_fin + timedelta(days=1)).strftime('%Y-%m-%d'),
-                            },
-                            'transparency': 'opaque',
-                            'colorId': '11',
-                        }
-                        
-                        event = service.events().insert(
-                            calendarId='primary',
-                            body=event_data
-                        ).execute()
-                        
-                        gcal_event_id = event['id']
-                        indispo.gcal_event_id = gcal_event_id
-                        flash('✓ Indisponibilité créée et synchronisée', 'success')
-                    else:
-                        flash('✓ Indisponibilité créée', 'success')
-                except Exception as e:
-                    flash(f'✓ Indisponibilité créée (Google Calendar: {str(e)})', 'warning')
+                flash('✓ Indisponibilité créée, synchronisation Google Calendar en cours', 'success')
             else:
                 flash('✓ Indisponibilité créée', 'success')
-            
-            db.session.commit()
             return redirect(url_for('indisponibilite'))
         
         except Exception as e:
@@ -1997,18 +2448,9 @@ def supprimer_indisponibilite(indispo_id):
     try:
         indispo = Indisponibilite.query.get_or_404(indispo_id)
         
-        # Supprimer de Google Calendar si synchronisé
-        if indispo.gcal_event_id and GOOGLE_CALENDAR_AVAILABLE:
-            try:
-                service = get_calendar_service()
-                if service:
-                    service.events().delete(
-                        calendarId='primary',
-                        eventId=indispo.gcal_event_id
-                    ).execute()
-                    print(f"✓ Événement Google Calendar supprimé : {indispo.gcal_event_id}")
-            except Exception as e:
-                print(f"⚠️ Erreur suppression Google Calendar : {e}")
+        # Supprimer de Google Calendar si synchronisé (file d'attente, après le commit)
+        evenements = [[calendar_id, event_id] for calendar_id, event_id in json.loads(indispo.gcal_events or '{}').items()]
+        planifier_sync_gcal('indisponibilite', indispo.id, 'delete', evenements, detacher=True)
         
         # Supprimer de la base de données
         db.session.delete(indispo)
@@ -2039,126 +2481,220 @@ def calendrier():
     """Vue calendrier"""
     return render_template('calendrier.html')
 
-@app.route('/api/prestations/calendrier')
-def api_prestations_calendrier():
-    """API pour récupérer les prestations ET indisponibilités au format calendrier"""
-    jours = request.args.get('jours', type=int)
-    query = Prestation.query.filter(Prestation.statut != 'Annulée')
-    
+COULEURS_STATUT_CALENDRIER = {
+    'Terminée': '#4CAF50',
+    'En cours': '#FF9800',
+    'Planifiée': '#2196F3',
+    'Demandée': '#9E9E9E'
+}
+COULEUR_INDISPONIBILITE = '#DC3545'
+
+
+def _lire_date_calendrier(valeur):
+    """Date ISO (AAAA-MM-JJ ou AAAA-MM-JJTHH:MM:SS[+fuseau], format FullCalendar) -> datetime naïf"""
+    if not valeur:
+        return None
+    try:
+        return datetime.fromisoformat(valeur.strip().replace(' ', '+').replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def fenetre_calendrier(args):
+    """
+    Fenêtre [debut, fin[ demandée :
+    - start/end (FullCalendar)
+    - date (vue semaine : 7 jours à partir de cette date)
+    - jours (à partir d'aujourd'hui)
+    - par défaut : du mois précédent aux 3 mois suivants
+    """
+    debut = _lire_date_calendrier(args.get('start'))
+    fin = _lire_date_calendrier(args.get('end'))
+    if debut and fin:
+        return debut, fin
+
+    date_semaine = _lire_date_calendrier(args.get('date'))
+    if date_semaine:
+        debut = date_semaine.replace(hour=0, minute=0, second=0, microsecond=0)
+        return debut, debut + timedelta(days=7)
+
+    # Bornes tronquées au jour : fenêtre (et ETag) stables d'une requête à l'autre
+    aujourd_hui = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    jours = args.get('jours', type=int)
     if jours:
-        date_limite = datetime.now() + timedelta(days=jours)
-        query = query.filter(
-            Prestation.date_debut >= datetime.now(),
-            Prestation.date_debut <= date_limite
+        return aujourd_hui, aujourd_hui + timedelta(days=jours)
+
+    return aujourd_hui - timedelta(days=31), aujourd_hui + timedelta(days=93)
+
+
+def chevauche_fenetre(colonne_debut, colonne_fin, debut, fin):
+    """
+    Ligne qui chevauche [debut, fin[ (fin absente : la ligne dure jusqu'à son début)
+    La borne basse porte sur coalesce(fin, début), indexée sur prestations et sessions_prestation.
+    unlikely() indique à SQLite qu'elle écarte la plupart des lignes (tout l'historique terminé avant la fenêtre) :
+    sans statistiques de plage, il choisirait sinon l'index de date_debut, qui n'en écarte presque aucune
+    """
+    return db.and_(
+        colonne_debut < fin,
+        func.unlikely(func.coalesce(colonne_fin, colonne_debut) >= debut)
+    )
+
+
+def evenements_calendrier(debut, fin):
+    """
+    Événements (sessions de prestations + indisponibilités) qui chevauchent [debut, fin[
+    Les sessions et clients sont chargés par selectinload (2 requêtes au total, pas une par ligne)
+    """
+    sessions_fenetre = db.session.query(SessionPrestation.prestation_id).filter(
+        chevauche_fenetre(SessionPrestation.date_debut, SessionPrestation.date_fin, debut, fin)
+    )
+    prestations = Prestation.query.options(
+        db.selectinload(Prestation.sessions),
+        db.selectinload(Prestation.client)
+    ).filter(
+        Prestation.statut != 'Annulée',
+        db.or_(
+            Prestation.id.in_(sessions_fenetre),
+            db.and_(~Prestation.sessions.any(), chevauche_fenetre(Prestation.date_debut, Prestation.date_fin, debut, fin))
         )
-    
-    prestations = query.order_by(Prestation.date_debut).all()
+    ).order_by(Prestation.date_debut).all()
+
     events = []
-    
     for p in prestations:
         client_nom = p.client.entreprise if p.client else "Client inconnu"
-        
-        if p.sessions and len(p.sessions) > 0:
+        titre_base = f"{client_nom} - {p.titre or p.type_prestation}"
+        color = COULEURS_STATUT_CALENDRIER.get(p.statut, '#9E9E9E')
+
+        if p.sessions:
             for idx, session in enumerate(p.sessions):
-                titre = f"{client_nom} - {p.titre or p.type_prestation}"
+                session_fin = session.date_fin or session.date_debut
+                if session.date_debut >= fin or session_fin < debut:
+                    continue  # Session d'une prestation visible mais hors de la fenêtre
+                titre = titre_base
                 if len(p.sessions) > 1:
                     titre += f" (Session {idx + 1}/{len(p.sessions)})"
-                
-                color = '#4CAF50' if p.statut == 'Terminée' else '#FF9800' if p.statut == 'En cours' else '#2196F3' if p.statut == 'Planifiée' else '#9E9E9E' if p.statut == 'Demandée' else '#9E9E9E'
-                
                 events.append({
                     'id': f"{p.id}",
                     'title': titre,
-                    'start': session.date_debut.isoformat() if session.date_debut else None,
-                    'end': session.date_fin.isoformat() if session.date_fin else session.date_debut.isoformat(),
+                    'start': session.date_debut.isoformat(),
+                    'end': session_fin.isoformat(),
+                    'url': f"/prestation/{p.id}",
                     'backgroundColor': color,
                     'borderColor': color
                 })
         else:
-            titre = f"{client_nom} - {p.titre or p.type_prestation}"
-            color = '#4CAF50' if p.statut == 'Terminée' else '#FF9800' if p.statut == 'En cours' else '#2196F3' if p.statut == 'Planifiée' else '#9E9E9E' if p.statut == 'Demandée' else '#9E9E9E'
-            
             events.append({
                 'id': str(p.id),
-                'title': titre,
+                'title': titre_base,
                 'start': p.date_debut.isoformat() if p.date_debut else None,
                 'end': p.date_fin.isoformat() if p.date_fin else p.date_debut.isoformat(),
+                'url': f"/prestation/{p.id}",
                 'backgroundColor': color,
                 'borderColor': color
             })
-    
-    return jsonify(events)
+
+    # Indisponibilités (journées entières, fin exclusive pour FullCalendar)
+    indisponibilites = Indisponibilite.query.filter(
+        Indisponibilite.date_debut < fin.date() + timedelta(days=1),
+        Indisponibilite.date_fin >= debut.date()
+    ).order_by(Indisponibilite.date_debut).all()
+    for indispo in indisponibilites:
+        events.append({
+            'id': f"indispo-{indispo.id}",
+            'title': f"🚫 {indispo.motif}",
+            'start': indispo.date_debut.isoformat(),
+            'end': (indispo.date_fin + timedelta(days=1)).isoformat(),
+            'allDay': True,
+            'url': '/indisponibilite',
+            'backgroundColor': COULEUR_INDISPONIBILITE,
+            'borderColor': COULEUR_INDISPONIBILITE,
+            'extendedProps': {'type': 'indisponibilite', 'note': indispo.note}
+        })
+
+    return events
+
+
+@app.route('/api/prestations/calendrier')
+def api_prestations_calendrier():
+    """
+    API pour récupérer les prestations ET indisponibilités au format calendrier
+    Fenêtre : start/end (FullCalendar), date (semaine) ou jours
+    ETag = version des données du calendrier + fenêtre : 304 si rien n'a changé
+    """
+    debut, fin = fenetre_calendrier(request.args)
+
+    cle = f"{lire_version_donnees('calendrier')}|{debut.isoformat()}|{fin.isoformat()}"
+    etag = hashlib.md5(cle.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        reponse = app.response_class(status=304)
+    else:
+        reponse = jsonify(evenements_calendrier(debut, fin))
+    reponse.set_etag(etag)
+    reponse.headers['Cache-Control'] = 'no-cache'
+    return reponse
 
 @app.route('/api/rechercher-entreprise')
 def api_rechercher_entreprise():
-    """API pour rechercher une entreprise par nom"""
+    """
+    API pour rechercher une entreprise par nom
+    Les stratégies (recherche directe, séparations nom/ville, Overpass autour du point fourni) tournent en parallèle
+    sur un pool borné, avec un délai global ; les résultats sont fusionnés et dédupliqués par identifiant OSM
+    """
     query = request.args.get('q', '').strip()
     latitude = request.args.get('lat', type=float)
     longitude = request.args.get('lon', type=float)
     rayon = request.args.get('rayon', 10, type=int)
     debug_mode = request.args.get('debug', '').lower() == 'true'
+    rafraichir = request.args.get('rafraichir', '').lower() == 'true'  # Tuiles Overpass redemandées même en cache
 
-    debug_info = {'etapes': []}
+    debug_info = {'etapes': [], 'strategies': []}
     debug_info['etapes'].append(f"Query initiale: '{query}'")
 
     if not query or len(query) < 3:
         return jsonify({'success': False, 'message': 'Requête trop courte (min 3 caractères)'})
 
-    # Approche intelligente : essayer plusieurs stratégies
-    ville_detectee = None
-    nom_entreprise = query
-    entreprises = []
-
-    # STRATÉGIE 1 : Recherche directe avec Nominatim (ex: "leclerc carcassonne")
-    debug_info['etapes'].append(f"Stratégie 1: Recherche directe Nominatim avec '{query}'")
-    entreprises = rechercher_entreprises_nominatim_direct(query)
-    debug_info['etapes'].append(f"Nominatim direct a trouvé: {len(entreprises)} entreprises")
-
-# STRATÉGIE 2 : Si rien trouvé, essayer de séparer nom/ville intelligemment
-    if len(entreprises) == 0:
-        parts = query.strip().split()
-        if len(parts) >= 2:
-            import requests
-            
-            for nb_mots_ville in [2, 1]:
-                if len(parts) <= nb_mots_ville:
-                    continue
-                
-                ville_potentielle = ' '.join(parts[-nb_mots_ville:])
-                nom_potentiel = ' '.join(parts[:-nb_mots_ville])
-                
-                debug_info['etapes'].append(f"Strategie 2.{nb_mots_ville}: nom='{nom_potentiel}', ville='{ville_potentielle}'")
-                
-                try:
-                    geocode_url = f"https://nominatim.openstreetmap.org/search?q={ville_potentielle},France&format=json&limit=1"
-                    resp = requests.get(geocode_url, headers={'User-Agent': 'GestionEntreprise/1.0'}, timeout=5)
-                    
-                    if resp.status_code == 200 and resp.json():
-                        geo_data = resp.json()[0]
-                        latitude = float(geo_data['lat'])
-                        longitude = float(geo_data['lon'])
-                        ville_detectee = ville_potentielle
-                        nom_entreprise = nom_potentiel
-                        rayon = 20
-                        debug_info['etapes'].append(f"Ville geolocalisee")
-                        
-                        entreprises = rechercher_entreprises_nominatim(nom_entreprise, ville_detectee)
-                        debug_info['etapes'].append(f"Trouve: {len(entreprises)} entreprises")
-                        
-                        if len(entreprises) > 0:
-                            break
-                    else:
-                        debug_info['etapes'].append(f"Geocodage echoue")
-                
-                except Exception as e:
-                    debug_info['etapes'].append(f"Erreur geocodage: {str(e)}")
-                    
-    # STRATÉGIE 3 : Si toujours rien et on a des coordonnées, essayer Overpass
-    if len(entreprises) == 0 and latitude and longitude:
-        debug_info['etapes'].append(f"Stratégie 3: Recherche Overpass autour de lat={latitude}, lon={longitude}, rayon={rayon}km")
-        entreprises = rechercher_entreprises_overpass(nom_entreprise, latitude, longitude, rayon)
-        debug_info['etapes'].append(f"Overpass a trouvé: {len(entreprises)} entreprises")
+    debut = time.perf_counter()
+    echeance = time.monotonic() + app.config['RECHERCHE_ENTREPRISE_DELAI']
+
+    # STRATÉGIE 1 : Recherche directe (ex: "leclerc carcassonne")
+    strategies = [('directe', rechercher_entreprises_nominatim_direct, (query,))]
+
+    # STRATÉGIE 2 : Séparer nom/ville (2 puis 1 mot(s) de ville)
+    parts = query.split()
+    for nb_mots_ville in [2, 1]:
+        if len(parts) > nb_mots_ville:
+            strategies.append((
+                f"separation_{nb_mots_ville}", _strategie_nom_ville,
+                (' '.join(parts[:-nb_mots_ville]), ' '.join(parts[-nb_mots_ville:]))
+            ))
+
+    # STRATÉGIE 3 : Overpass autour du point fourni par l'appelant
+    if latitude and longitude:
+        strategies.append(('overpass', rechercher_entreprises_overpass, (query, latitude, longitude, rayon, rafraichir)))
+
+    resultats = executer_strategies(strategies, echeance)
+
+    # Overpass autour d'une ville détectée : seulement si rien trouvé (un appel Overpass de plus, pas en parallèle)
+    separation = next((r['separation'] for r in resultats if r['separation']), None)
+    if not any(r['entreprises'] for r in resultats) and separation and time.monotonic() < echeance:
+        resultats += executer_strategies(
+            [('overpass_ville', rechercher_entreprises_overpass, (separation['nom'], *separation['point'], 20, rafraichir))],
+            echeance
+        )
+
+    entreprises = fusionner_entreprises(r['entreprises'] for r in resultats)
 
+    for resultat in resultats:
+        debug_info['strategies'].append({
+            'nom': resultat['nom'],
+            'statut': resultat['statut'],
+            'duree_ms': resultat['duree_ms'],
+            'nb': len(resultat['entreprises'])
+        })
+        debug_info['etapes'].append(
+            f"Stratégie {resultat['nom']}: {resultat['statut']}, {len(resultat['entreprises'])} entreprise(s) en {resultat['duree_ms']} ms"
+        )
+    debug_info['duree_totale_ms'] = round((time.perf_counter() - debut) * 1000)
     debug_info['etapes'].append(f"Total d'entreprises trouvées: {len(entreprises)}")
 
     if debug_mode:
@@ -2172,11 +2708,12 @@ def api_rechercher_zone():
     ville = request.args.get('ville', '')
     secteur = request.args.get('secteur', '')
     rayon = request.args.get('rayon', 20, type=int)
+    rafraichir = request.args.get('rafraichir', '').lower() == 'true'
 
     if not ville:
         return jsonify({'success': False, 'message': 'Ville requise'})
 
-    entreprises = rechercher_par_zone(ville, secteur if secteur else None, rayon)
+    entreprises = rechercher_par_zone(ville, secteur if secteur else None, rayon, rafraichir)
     return jsonify({'success': True, 'entreprises': entreprises, 'count': len(entreprises)})
 
 @app.route('/api/rechercher-clients')
@@ -2245,229 +2782,652 @@ def api_demandeurs():
     return jsonify({'success': True, 'demandeurs': demandeurs})
 
 # ============================================================================
-# ROUTES STATISTIQUES
+# MOTEUR DE STATISTIQUES MENSUELLES (table stats_mensuelles, cache par année)
 # ============================================================================
 
-@app.route('/statistiques')
-def statistiques():
-    """Page statistiques avec graphiques"""
-    from sqlalchemy import func
-    
-    stats_clients_raw = db.session.query(
-        Client.nom,
-        func.count(Prestation.id).label('nombre')
-    ).join(Prestation).group_by(Client.id).order_by(func.count(Prestation.id).desc()).limit(10).all()
+_stats_annee_cache = {}
+_stats_annee_lock = threading.Lock()
 
-    stats_clients = [(row[0], row[1]) for row in stats_clients_raw]
+# Champs de Prestation qui entrent dans les statistiques mensuelles
+CHAMPS_STATS_PRESTATION = ('date_debut', 'date_fin', 'theme_prestation', 'domaine_prestation', 'statut',
+                           'tarif_total', 'distance_km', 'nb_repas', 'nb_hebergements')
 
-    annee_en_cours = datetime.now().year
-    stats_mois = []
+MESURES_STATS_MENSUELLES = ('nb_prestations', 'ca', 'distance_km', 'repas', 'hebergements',
+                            'distance_km_hors_annulees', 'repas_hors_annulees',
+                            'hebergements_hors_annulees', 'jours_formation_hors_annulees')
 
-    for mois in range(1, 13):
-        debut_mois = datetime(annee_en_cours, mois, 1)
-        if mois == 12:
-            fin_mois = datetime(annee_en_cours + 1, 1, 1)
+
+def _expr_jours_prestation():
+    """Nombre de jours couverts par une prestation (au moins 1), calculé en SQL"""
+    ecart = db.cast(func.julianday(func.date(Prestation.date_fin)) - func.julianday(func.date(Prestation.date_debut)), db.Integer)
+    return db.case((Prestation.date_fin.is_(None), 1), else_=func.max(1, ecart + 1))
+
+
+def _contribution_stats(valeurs):
+    """
+    Part d'une prestation dans stats_mensuelles
+    Retourne (clé (annee, mois, theme, domaine), mesures) ou None si la prestation n'a pas de date
+    """
+    date_debut = valeurs['date_debut']
+    if not date_debut:
+        return None
+
+    jours = 1
+    if valeurs['date_fin']:
+        jours = max(1, (valeurs['date_fin'].date() - date_debut.date()).days + 1)
+    distance = valeurs['distance_km'] * 2 * jours if valeurs['distance_km'] else 0
+    repas = valeurs['nb_repas'] or 0
+    hebergements = valeurs['nb_hebergements'] or 0
+    comptee = valeurs['statut'] != 'Annulée'
+
+    cle = (date_debut.year, date_debut.month, valeurs['theme_prestation'] or '', valeurs['domaine_prestation'] or '')
+    mesures = {
+        'nb_prestations': 1,
+        'ca': valeurs['tarif_total'] or 0,
+        'distance_km': distance,
+        'repas': repas,
+        'hebergements': hebergements,
+        'distance_km_hors_annulees': distance if comptee else 0,
+        'repas_hors_annulees': repas if comptee else 0,
+        'hebergements_hors_annulees': hebergements if comptee else 0,
+        'jours_formation_hors_annulees': jours if comptee and valeurs['distance_km'] else 0
+    }
+    return cle, mesures
+
+
+def _valeurs_stats_prestation(prestation, anciennes=False):
+    """Valeurs des champs statistiques avant (anciennes=True) ou après le flush en cours"""
+    etat = db.inspect(prestation)
+    valeurs = {}
+    for champ in CHAMPS_STATS_PRESTATION:
+        historique = etat.attrs[champ].history
+        if historique.unchanged:
+            valeurs[champ] = historique.unchanged[0]
+        elif anciennes:
+            valeurs[champ] = historique.deleted[0] if historique.deleted else None
+        elif historique.added:
+            valeurs[champ] = historique.added[0]
         else:
-            fin_mois = datetime(annee_en_cours, mois + 1, 1)
+            valeurs[champ] = getattr(prestation, champ)
+    return valeurs
+
+
+def _appliquer_contribution(connection, contribution, signe):
+    """Ajoute (signe=1) ou retire (signe=-1) la part d'une prestation dans stats_mensuelles"""
+    if contribution is None:
+        return
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+    (annee, mois, theme, domaine), mesures = contribution
+    table = StatMensuelle.__table__
+    valeurs = {nom: valeur * signe for nom, valeur in mesures.items()}
+    requete = sqlite_insert(table).values(annee=annee, mois=mois, theme=theme, domaine=domaine, **valeurs)
+    requete = requete.on_conflict_do_update(
+        index_elements=['annee', 'mois', 'theme', 'domaine'],
+        set_={nom: table.c[nom] + requete.excluded[nom] for nom in mesures}
+    )
+    connection.execute(requete)
 
-        prestations_mois = Prestation.query.filter(
-            Prestation.date_debut >= debut_mois,
-            Prestation.date_debut < fin_mois
-        ).all()
+    if signe < 0:
+        connection.execute(table.delete().where(
+            table.c.annee == annee, table.c.mois == mois,
+            table.c.theme == theme, table.c.domaine == domaine,
+            table.c.nb_prestations <= 0
+        ))
 
-        nb_prestations = len(prestations_mois)
-        ca = sum(p.tarif_total or 0 for p in prestations_mois)
 
-        distance_mois = 0
-        repas_mois = 0
-        hebergements_mois = 0
+@sa_event.listens_for(Prestation, 'after_insert')
+def _stats_apres_insertion(mapper, connection, prestation):
+    """Nouvelle prestation : ajout de sa part dans stats_mensuelles"""
+    _appliquer_contribution(connection, _contribution_stats(_valeurs_stats_prestation(prestation)), 1)
 
-        for p in prestations_mois:
-            if p.distance_km:
-                jours = 1
-                if p.date_debut and p.date_fin:
-                    delta = p.date_fin.date() - p.date_debut.date()
-                    jours = max(1, delta.days + 1)
-                distance_mois += p.distance_km * 2 * jours
 
-            if p.nb_repas:
-                repas_mois += p.nb_repas
+@sa_event.listens_for(Prestation, 'after_update')
+def _stats_apres_modification(mapper, connection, prestation):
+    """Prestation modifiée : retrait de l'ancienne part, ajout de la nouvelle"""
+    ancienne = _contribution_stats(_valeurs_stats_prestation(prestation, anciennes=True))
+    nouvelle = _contribution_stats(_valeurs_stats_prestation(prestation))
+    if ancienne != nouvelle:  # Changement sans effet sur les statistiques (ex: commentaires)
+        _appliquer_contribution(connection, ancienne, -1)
+        _appliquer_contribution(connection, nouvelle, 1)
 
-            if p.nb_hebergements:
-                hebergements_mois += p.nb_hebergements
 
-        stats_mois.append({
-            'mois': mois,
-            'nom_mois': debut_mois.strftime('%B'),
-            'nb_prestations': nb_prestations,
-            'ca': float(ca),
-            'distance_km': round(distance_mois, 1),
-            'repas': repas_mois,
-            'hebergements': hebergements_mois
-        })
+@sa_event.listens_for(Prestation, 'after_delete')
+def _stats_apres_suppression(mapper, connection, prestation):
+    """Prestation supprimée : retrait de sa part dans stats_mensuelles"""
+    _appliquer_contribution(connection, _contribution_stats(_valeurs_stats_prestation(prestation, anciennes=True)), -1)
 
-    prestations_annee = Prestation.query.filter(
-        Prestation.date_debut >= datetime(annee_en_cours, 1, 1),
-        Prestation.date_debut < datetime(annee_en_cours + 1, 1, 1),
-        Prestation.statut != 'Annulée'
-    ).all()
 
-    total_distance = 0
-    total_repas = 0
-    total_hebergements = 0
-    nb_jours_formation = 0
+def _charger_ancienne_valeur(target, value, oldvalue, initiator):
+    """active_history : l'ancienne valeur est chargée même si l'objet était expiré (après un commit)"""
 
-    for p in prestations_annee:
-        if p.distance_km:
-            jours = 1
-            if p.date_debut and p.date_fin:
-                delta = p.date_fin.date() - p.date_debut.date()
-                jours = max(1, delta.days + 1)
-            total_distance += p.distance_km * 2 * jours
-            nb_jours_formation += jours
 
-        if p.nb_repas:
-            total_repas += p.nb_repas
+for _champ in CHAMPS_STATS_PRESTATION:
+    sa_event.listen(getattr(Prestation, _champ), 'set', _charger_ancienne_valeur, active_history=True)
 
-        if p.nb_hebergements:
-            total_hebergements += p.nb_hebergements
 
-    stats_logistique = {
-        'total_distance_km': round(total_distance, 1),
-        'total_repas': total_repas,
-        'total_hebergements': total_hebergements,
-        'nb_jours_formation': nb_jours_formation
-    }
+def reconstruire_stats_mensuelles():
+    """
+    Recalcule entièrement stats_mensuelles depuis les prestations (une requête INSERT ... SELECT groupée)
+    Les UPDATE en masse sur les prestations (balayage des statuts) ne passent pas par les hooks :
+    ils ne changent que des statuts non annulés, sans effet sur les cumuls
+    """
+    jours = _expr_jours_prestation()
+    comptee = db.or_(Prestation.statut.is_(None), Prestation.statut != 'Annulée')
+    avec_distance = Prestation.distance_km.isnot(None) & (Prestation.distance_km != 0)
+    distance = Prestation.distance_km * 2 * jours
+
+    def somme(expr, condition=None):
+        if condition is not None:
+            expr = db.case((condition, expr), else_=0)
+        return func.coalesce(func.sum(expr), 0)
+
+    annee = db.cast(func.strftime('%Y', Prestation.date_debut), db.Integer)
+    mois = db.cast(func.strftime('%m', Prestation.date_debut), db.Integer)
+    theme = func.coalesce(Prestation.theme_prestation, '')
+    domaine = func.coalesce(Prestation.domaine_prestation, '')
+
+    selection = db.select(
+        annee, mois, theme, domaine,
+        func.count(Prestation.id),
+        somme(Prestation.tarif_total),
+        somme(distance, avec_distance),
+        somme(Prestation.nb_repas),
+        somme(Prestation.nb_hebergements),
+        somme(distance, avec_distance & comptee),
+        somme(Prestation.nb_repas, comptee),
+        somme(Prestation.nb_hebergements, comptee),
+        somme(jours, avec_distance & comptee)
+    ).where(Prestation.date_debut.isnot(None)).group_by(annee, mois, theme, domaine)
+
+    table = StatMensuelle.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(['annee', 'mois', 'theme', 'domaine'] + list(MESURES_STATS_MENSUELLES), selection))
+    db.session.commit()
+    invalider_stats_annees()
+    return db.session.query(func.count(StatMensuelle.id)).scalar()
 
-    return render_template('statistiques.html',
-                         stats_clients=stats_clients,
-                         stats_mois=stats_mois,
-                         stats_logistique=stats_logistique,
-                         annee=annee_en_cours)
 
-# ============================================================================
-# ROUTES COMPTABILITÉ
-# ============================================================================
+def initialiser_stats_mensuelles():
+    """Remplit stats_mensuelles au premier démarrage (table vide alors que des prestations existent)"""
+    if StatMensuelle.query.first() is None and Prestation.query.first() is not None:
+        nb = reconstruire_stats_mensuelles()
+        print(f"✅ Statistiques mensuelles initialisées ({nb} lignes)")
 
-@app.route('/facture/<int:facture_id>')
-def facture_detail(facture_id):
-    """Afficher le détail d'une facture"""
-    facture = Facture.query.get_or_404(facture_id)
-    entreprise = Entreprise.query.first()
 
-    # Calculer la date limite de paiement
-    date_limite = None
-    if facture.date_facture and facture.prestation and facture.prestation.client:
-        delai = facture.prestation.client.delai_paiement_jours or 30
-        date_limite = facture.date_facture + timedelta(days=delai)
+@app.cli.command('reconstruire-stats')
+def reconstruire_stats_commande():
+    """Recalcule la table stats_mensuelles à partir des prestations"""
+    nb = reconstruire_stats_mensuelles()
+    print(f"✅ stats_mensuelles reconstruite : {nb} lignes")
 
-    return render_template('facture_detail.html', facture=facture, entreprise=entreprise, date_limite=date_limite)
 
-@app.route('/factures-en-cours')
-def factures_en_cours():
-    """Liste des factures en cours (envoyées mais non payées)"""
-    factures = []
-    total_factures_en_cours = 0
+def calculer_stats_annee(annee):
+    """
+    Statistiques mensuelles et annuelles d'une année, lues dans stats_mensuelles (12 x thèmes x domaines lignes max)
+    - par mois : nombre de prestations, CA, distance (aller-retour x jours), repas, hébergements
+    - sur l'année : totaux logistiques hors prestations annulées
+    """
+    lignes = db.session.query(
+        StatMensuelle.mois,
+        *[func.sum(getattr(StatMensuelle, nom)) for nom in MESURES_STATS_MENSUELLES]
+    ).filter(StatMensuelle.annee == annee).group_by(StatMensuelle.mois).all()
 
-    try:
-        factures_query = Facture.query.filter(Facture.date_envoi.isnot(None)).all()
+    par_mois = {ligne[0]: ligne for ligne in lignes}
+    stats_mois = []
+    for mois in range(1, 13):
+        ligne = par_mois.get(mois)
+        stats_mois.append({
+            'mois': mois,
+            'nom_mois': datetime(annee, mois, 1).strftime('%B'),
+            'nb_prestations': ligne[1] if ligne else 0,
+            'ca': round(float(ligne[2]), 2) if ligne else 0.0,
+            'distance_km': round(ligne[3], 1) if ligne else 0,
+            'repas': ligne[4] if ligne else 0,
+            'hebergements': ligne[5] if ligne else 0
+        })
 
-        for facture in factures_query:
-            # Vérifier si un paiement complet existe
-            paiement_complet = Paiement.query.filter_by(
-                facture_id=facture.id,
-                statut='Payé'
-            ).first()
+    stats_logistique = {
+        'total_distance_km': round(sum(ligne[6] for ligne in lignes), 1),
+        'total_repas': sum(ligne[7] for ligne in lignes),
+        'total_hebergements': sum(ligne[8] for ligne in lignes),
+        'nb_jours_formation': sum(ligne[9] for ligne in lignes)
+    }
 
-            if not paiement_complet:
-                factures.append(facture)
-                total_factures_en_cours += facture.total_ttc or 0
-    except:
-        pass
+    return {'mois': stats_mois, 'logistique': stats_logistique}
 
-    return render_template('factures_en_cours.html',
-                         factures=factures,
-                         total=total_factures_en_cours)
 
-@app.route('/factures-en-retard')
-def factures_en_retard():
-    """Liste des factures en retard (date butoir dépassée)"""
-    factures = []
-    total_factures_retard = 0
+def get_stats_annee(annee):
+    """Retourne les statistiques d'une année depuis le cache (calculées au premier appel)"""
+    with _stats_annee_lock:
+        stats = _stats_annee_cache.get(annee)
+        if stats is None:
+            stats = calculer_stats_annee(annee)
+            _stats_annee_cache[annee] = stats
+        return stats
 
-    try:
-        factures_query = Facture.query.all()
 
-        for facture in factures_query:
-            # Vérifier si un paiement complet existe
-            paiement_complet = Paiement.query.filter_by(
-                facture_id=facture.id,
-                statut='Payé'
-            ).first()
+def invalider_stats_annees(annees=None):
+    """Vide le cache des années indiquées (toutes si None)"""
+    with _stats_annee_lock:
+        if annees is None:
+            _stats_annee_cache.clear()
+        else:
+            for annee in annees:
+                _stats_annee_cache.pop(annee, None)
 
-            if not paiement_complet and facture.date_facture and facture.prestation and facture.prestation.client:
-                # Calculer la date butoir
-                delai = facture.prestation.client.delai_paiement_jours or 30
-                date_butoir = facture.date_facture + timedelta(days=delai)
-
-                # Si aujourd'hui > date butoir, c'est en retard
-                if datetime.now().date() > date_butoir:
-                    facture.date_butoir = date_butoir  # Ajouter pour affichage
-                    facture.jours_retard = (datetime.now().date() - date_butoir).days
-                    factures.append(facture)
-                    total_factures_retard += facture.total_ttc or 0
-    except:
-        pass
 
-    return render_template('factures_en_retard.html',
-                         factures=factures,
-                         total=total_factures_retard)
+@sa_event.listens_for(SaSession, 'after_flush')
+def _noter_annees_stats_flush(session, flush_context):
+    """Mémorise les années des prestations modifiées (ancienne et nouvelle date de début)"""
+    annees = session.info.setdefault('annees_stats_modifiees', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Prestation):
+            continue
+        historique = db.inspect(obj).attrs.date_debut.history
+        for date_debut in list(historique.added) + list(historique.unchanged) + list(historique.deleted):
+            if date_debut:
+                annees.add(date_debut.year)
 
-@app.route('/paiements-en-retard')
-def paiements_en_retard():
-    """Liste des paiements en retard (date butoir dépassée)"""
-    paiements = []
-    total_paiements_retard = 0
 
-    try:
-        paiements_query = Paiement.query.filter(
-            Paiement.statut.in_(['En attente', 'Partiel'])
-        ).all()
+@sa_event.listens_for(SaSession, 'do_orm_execute')
+def _noter_annees_stats_bulk(orm_execute_state):
+    """
+    UPDATE/DELETE en masse sur les prestations : années passées par l'appelant
+    (execution_options(annees_stats=...)), sinon tout le cache est à vider
+    """
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.local_table.name != Prestation.__tablename__:
+        return None
+    resultat = orm_execute_state.invoke_statement()
+    if getattr(resultat, 'rowcount', 1):  # Rien à invalider si aucune ligne touchée
+        annees = orm_execute_state.execution_options.get('annees_stats')
+        if annees is None:
+            orm_execute_state.session.info['annees_stats_toutes'] = True
+        else:
+            orm_execute_state.session.info.setdefault('annees_stats_modifiees', set()).update(annees)
+    return resultat
 
-        for paiement in paiements_query:
-            if paiement.date_butoir and datetime.now().date() > paiement.date_butoir:
-                # Calculer jours de retard
-                paiement.jours_retard = (datetime.now().date() - paiement.date_butoir).days
-                paiements.append(paiement)
-                total_paiements_retard += (paiement.montant_total or 0) - (paiement.montant_paye or 0)
-    except:
-        pass
 
-    return render_template('paiements_en_retard.html',
-                         paiements=paiements,
-                         total=total_paiements_retard)
+@sa_event.listens_for(SaSession, 'after_commit')
+def _invalider_stats_apres_commit(session):
+    """Invalide uniquement les années touchées par la transaction"""
+    annees = session.info.pop('annees_stats_modifiees', set())
+    if session.info.pop('annees_stats_toutes', False):
+        invalider_stats_annees()
+    elif annees:
+        invalider_stats_annees(annees)
 
-@app.route('/paiements-recus')
-def paiements_recus():
-    """Liste des paiements reçus avec filtre de dates"""
-    # Récupérer les paramètres de date (par défaut: 1er janvier de l'année en cours)
-    date_debut_str = request.args.get('date_debut')
-    date_fin_str = request.args.get('date_fin')
 
-    # Dates par défaut
-    if not date_debut_str:
-        date_debut = datetime(datetime.now().year, 1, 1).date()
-    else:
-        date_debut = datetime.strptime(date_debut_str, '%Y-%m-%d').date()
+@sa_event.listens_for(SaSession, 'after_rollback')
+def _oublier_annees_stats_rollback(session):
+    """Un rollback annule les modifications : rien à invalider"""
+    session.info.pop('annees_stats_modifiees', None)
+    session.info.pop('annees_stats_toutes', None)
 
-    if not date_fin_str:
-        date_fin = datetime.now().date()
-    else:
-        date_fin = datetime.strptime(date_fin_str, '%Y-%m-%d').date()
 
-    # Récupérer les paiements payés dans la période
-    paiements = []
-    total_paiements_recus = 0
+# ============================================================================
+# ROUTES STATISTIQUES
+# ============================================================================
+
+@app.route('/statistiques')
+def statistiques():
+    """Page statistiques avec graphiques (?annee=AAAA, année en cours par défaut)"""
+    annee = request.args.get('annee', type=int) or datetime.now().year
+    if not 2000 <= annee <= 2100:
+        annee = datetime.now().year
+
+    stats_clients_raw = db.session.query(
+        Client.nom,
+        func.count(Prestation.id).label('nombre')
+    ).join(Prestation).group_by(Client.id).order_by(func.count(Prestation.id).desc()).limit(10).all()
+
+    stats_clients = [(row[0], row[1]) for row in stats_clients_raw]
+
+    stats = get_stats_annee(annee)
+
+    return render_template('statistiques.html',
+                         stats_clients=stats_clients,
+                         stats_mois=stats['mois'],
+                         stats_logistique=stats['logistique'],
+                         annee=annee)
+
+# ============================================================================
+# CRÉANCES CLIENTS - Échéances, restes dus et balance âgée calculés en SQL
+# ============================================================================
+
+app.config.setdefault('CREANCES_PAR_PAGE', 50)
+
+# Tranches de la balance âgée (jours de retard après l'échéance)
+TRANCHES_BALANCE_AGEE = ['non_echu', '0-30', '31-60', '61-90', '90+']
+
+
+def _expr_tranche(jours_retard):
+    """Tranche de balance âgée correspondant à un nombre de jours de retard"""
+    return db.case(
+        (jours_retard <= 0, 'non_echu'),
+        (jours_retard <= 30, '0-30'),
+        (jours_retard <= 60, '31-60'),
+        (jours_retard <= 90, '61-90'),
+        else_='90+'
+    )
+
+
+def _colonnes_creances_factures(aujourd_hui):
+    """
+    Expressions SQL des factures non soldées (sans paiement au statut 'Payé')
+    Échéance = date_facture + délai client (30 jours si non renseigné)
+    """
+    paiements = db.session.query(
+        Paiement.facture_id.label('facture_id'),
+        func.sum(func.coalesce(Paiement.montant_paye, 0)).label('paye'),
+        func.max(db.case((Paiement.statut == 'Payé', 1), else_=0)).label('soldee')
+    ).group_by(Paiement.facture_id).subquery()
+
+    delai = func.coalesce(func.nullif(Client.delai_paiement_jours, 0), 30)
+    echeance_jour = func.julianday(Facture.date_facture) + delai
+    jours_retard = db.cast(func.julianday(aujourd_hui.isoformat()) - echeance_jour, db.Integer)
+
+    return {
+        'paiements': paiements,
+        'echeance': func.date(echeance_jour, type_=db.Date),
+        'echeance_jour': echeance_jour,
+        'jours_retard': jours_retard,
+        'reste_du': func.coalesce(Facture.total_ttc, 0) - func.coalesce(paiements.c.paye, 0),
+        'tranche': _expr_tranche(jours_retard),
+        'non_soldee': func.coalesce(paiements.c.soldee, 0) == 0
+    }
+
+
+def _requete_creances_factures(colonnes, *entites):
+    """Jointure facture / prestation / client / paiements agrégés, limitée aux factures non soldées"""
+    return db.session.query(*entites).select_from(Facture).join(
+        Prestation, Facture.prestation_id == Prestation.id
+    ).join(
+        Client, Prestation.client_id == Client.id
+    ).outerjoin(
+        colonnes['paiements'], colonnes['paiements'].c.facture_id == Facture.id
+    ).filter(colonnes['non_soldee'])
+
+
+def _colonnes_creances_paiements(aujourd_hui):
+    """Expressions SQL des paiements en attente ou partiels (échéance = date_butoir)"""
+    jours_retard = db.cast(func.julianday(aujourd_hui.isoformat()) - func.julianday(Paiement.date_butoir), db.Integer)
+    return {
+        'jours_retard': jours_retard,
+        'reste_du': func.coalesce(Paiement.montant_total, 0) - func.coalesce(Paiement.montant_paye, 0),
+        'tranche': _expr_tranche(jours_retard),
+        'en_attente': db.and_(Paiement.statut.in_(['En attente', 'Partiel']), Paiement.date_butoir.isnot(None))
+    }
+
+
+def _requete_creances_paiements(colonnes, *entites):
+    """Jointure paiement / prestation / client, limitée aux paiements en attente avec date butoir"""
+    return db.session.query(*entites).select_from(Paiement).join(
+        Prestation, Paiement.prestation_id == Prestation.id
+    ).outerjoin(
+        Client, Prestation.client_id == Client.id
+    ).filter(colonnes['en_attente'])
+
+
+def _paginer_creances(requete, cles_tri, tri, ordre, page, par_page, totaux, construire):
+    """
+    Trie, pagine et exécute une requête de créances en une seule instruction SQL :
+    les totaux sur l'ensemble du filtre sont calculés par fonctions de fenêtre (OVER ())
+    """
+    tri = tri if tri in cles_tri else next(iter(cles_tri))
+    ordre = 'asc' if ordre == 'asc' else 'desc'
+    par_page = max(1, min(par_page or app.config['CREANCES_PAR_PAGE'], 500))
+    page = max(1, page or 1)
+
+    expression = cles_tri[tri]
+    tri_sql = expression.asc() if ordre == 'asc' else expression.desc()
+    noms_totaux = list(totaux)
+    requete = requete.add_columns(
+        func.count().over().label('_total_elements'),
+        *[expr.over().label('_' + nom) for nom, expr in totaux.items()]
+    ).order_by(tri_sql, requete.column_descriptions[0]['entity'].id)
+
+    lignes = requete.limit(par_page).offset((page - 1) * par_page).all()
+    if not lignes and page > 1:
+        # Page au-delà de la dernière : retour à la première
+        page = 1
+        lignes = requete.limit(par_page).all()
+
+    nb_totaux = len(noms_totaux) + 1
+    total_elements = lignes[0][-nb_totaux] if lignes else 0
+    valeurs_totaux = {nom: (lignes[0][-len(noms_totaux) + i] or 0) if lignes else 0 for i, nom in enumerate(noms_totaux)}
+
+    return {
+        'elements': [construire(ligne[:-nb_totaux]) for ligne in lignes],
+        'total_elements': total_elements,
+        'totaux': valeurs_totaux,
+        'page': page,
+        'pages': max(1, -(-total_elements // par_page)),
+        'par_page': par_page,
+        'tri': tri,
+        'ordre': ordre
+    }
+
+
+def lister_creances_factures(etat='en_retard', page=1, par_page=None, tri=None, ordre='desc', aujourd_hui=None):
+    """
+    Factures non soldées, triées et paginées
+    etat='en_retard' : échéance dépassée | etat='en_cours' : factures envoyées
+    Chaque facture reçoit date_butoir, jours_retard, reste_du et tranche
+    """
+    aujourd_hui = aujourd_hui or datetime.now().date()
+    c = _colonnes_creances_factures(aujourd_hui)
+
+    requete = _requete_creances_factures(
+        c, Facture, c['echeance'], c['jours_retard'], c['reste_du'], c['tranche']
+    ).options(
+        db.contains_eager(Facture.prestation).contains_eager(Prestation.client)
+    )
+    if etat == 'en_cours':
+        requete = requete.filter(Facture.date_envoi.isnot(None))
+    else:
+        requete = requete.filter(c['jours_retard'] > 0)
+
+    cles_tri = {
+        'retard': c['jours_retard'],
+        'echeance': c['echeance_jour'],
+        'montant': c['reste_du'],
+        'client': Client.nom,
+        'date': Facture.date_facture,
+        'reference': Facture.reference_facture
+    }
+    totaux = {
+        'montant_ttc': func.sum(func.coalesce(Facture.total_ttc, 0)),
+        'montant_ht': func.sum(func.coalesce(Facture.total_prix_ht, 0)),
+        'reste_du': func.sum(c['reste_du']),
+        'retard_moyen': func.avg(c['jours_retard'])
+    }
+
+    def construire(ligne):
+        facture, echeance, jours_retard, reste_du, tranche = ligne[:5]
+        facture.date_butoir = echeance
+        facture.jours_retard = jours_retard
+        facture.reste_du = reste_du
+        facture.tranche = tranche
+        return facture
+
+    tri_defaut = 'date' if etat == 'en_cours' else 'retard'
+    return _paginer_creances(requete, cles_tri, tri or tri_defaut, ordre, page, par_page, totaux, construire)
+
+
+def lister_creances_paiements(page=1, par_page=None, tri=None, ordre='desc', aujourd_hui=None):
+    """Paiements en attente dont la date butoir est dépassée, triés et paginés"""
+    aujourd_hui = aujourd_hui or datetime.now().date()
+    c = _colonnes_creances_paiements(aujourd_hui)
+
+    requete = _requete_creances_paiements(
+        c, Paiement, c['jours_retard'], c['reste_du'], c['tranche']
+    ).options(
+        db.contains_eager(Paiement.prestation).contains_eager(Prestation.client)
+    ).filter(Paiement.date_butoir < aujourd_hui)
+
+    cles_tri = {
+        'retard': c['jours_retard'],
+        'echeance': Paiement.date_butoir,
+        'montant': c['reste_du'],
+        'client': Client.nom,
+        'reference': Paiement.numero_paiement
+    }
+    totaux = {
+        'reste_du': func.sum(c['reste_du']),
+        'retard_moyen': func.avg(c['jours_retard'])
+    }
+
+    def construire(ligne):
+        paiement, jours_retard, reste_du, tranche = ligne[:4]
+        paiement.jours_retard = jours_retard
+        paiement.reste_du = reste_du
+        paiement.tranche = tranche
+        return paiement
+
+    return _paginer_creances(requete, cles_tri, tri or 'retard', ordre, page, par_page, totaux, construire)
+
+
+def balance_agee(aujourd_hui=None):
+    """
+    Balance âgée : nombre et montant restant dû par tranche de retard
+    (une requête GROUP BY pour les factures, une pour les paiements)
+    """
+    aujourd_hui = aujourd_hui or datetime.now().date()
+    resultat = {}
+
+    cf = _colonnes_creances_factures(aujourd_hui)
+    cp = _colonnes_creances_paiements(aujourd_hui)
+    sources = {
+        'factures': _requete_creances_factures(cf, cf['tranche'], func.count(Facture.id), func.sum(cf['reste_du'])).group_by(cf['tranche']),
+        'paiements': _requete_creances_paiements(cp, cp['tranche'], func.count(Paiement.id), func.sum(cp['reste_du'])).group_by(cp['tranche'])
+    }
+    for nom, requete in sources.items():
+        tranches = {tranche: {'nombre': 0, 'montant': 0.0} for tranche in TRANCHES_BALANCE_AGEE}
+        for tranche, nombre, montant in requete.all():
+            tranches[tranche] = {'nombre': nombre, 'montant': round(montant or 0, 2)}
+        resultat[nom] = tranches
+
+    return resultat
+
+
+# ============================================================================
+# ROUTES COMPTABILITÉ
+# ============================================================================
+
+@app.route('/facture/<int:facture_id>')
+def facture_detail(facture_id):
+    """Afficher le détail d'une facture"""
+    facture = Facture.query.get_or_404(facture_id)
+    entreprise = Entreprise.query.first()
+
+    # Calculer la date limite de paiement
+    date_limite = None
+    if facture.date_facture and facture.prestation and facture.prestation.client:
+        delai = facture.prestation.client.delai_paiement_jours or 30
+        date_limite = facture.date_facture + timedelta(days=delai)
+
+    return render_template('facture_detail.html', facture=facture, entreprise=entreprise, date_limite=date_limite)
+
+def _parametres_liste_creances():
+    """Paramètres de pagination et de tri communs aux listes de créances (?page=&tri=&ordre=)"""
+    return {
+        'page': request.args.get('page', 1, type=int),
+        'par_page': request.args.get('par_page', type=int),
+        'tri': request.args.get('tri'),
+        'ordre': request.args.get('ordre', 'desc')
+    }
+
+
+def _page_creances_vide():
+    """Page de créances vide (affichée en cas d'erreur de calcul)"""
+    return {'elements': [], 'total_elements': 0, 'totaux': {}, 'page': 1, 'pages': 1,
+            'par_page': app.config['CREANCES_PAR_PAGE'], 'tri': None, 'ordre': 'desc'}
+
+
+@app.route('/factures-en-cours')
+def factures_en_cours():
+    """Liste des factures en cours (envoyées mais non payées)"""
+    try:
+        resultat = lister_creances_factures('en_cours', **_parametres_liste_creances())
+    except Exception as e:
+        print(f"❌ Erreur factures en cours : {e}")
+        flash(f'❌ Erreur lors du calcul des factures en cours : {str(e)}', 'error')
+        resultat = _page_creances_vide()
+
+    return render_template('factures_en_cours.html',
+                         factures=resultat['elements'],
+                         total=resultat['totaux'].get('montant_ttc', 0),
+                         resultat=resultat)
+
+@app.route('/factures-en-retard')
+def factures_en_retard():
+    """Liste des factures en retard (date butoir dépassée)"""
+    try:
+        resultat = lister_creances_factures('en_retard', **_parametres_liste_creances())
+    except Exception as e:
+        print(f"❌ Erreur factures en retard : {e}")
+        flash(f'❌ Erreur lors du calcul des factures en retard : {str(e)}', 'error')
+        resultat = _page_creances_vide()
+
+    return render_template('factures_en_retard.html',
+                         factures=resultat['elements'],
+                         total=resultat['totaux'].get('reste_du', 0),
+                         resultat=resultat)
+
+@app.route('/paiements-en-retard')
+def paiements_en_retard():
+    """Liste des paiements en retard (date butoir dépassée)"""
+    try:
+        resultat = lister_creances_paiements(**_parametres_liste_creances())
+    except Exception as e:
+        print(f"❌ Erreur paiements en retard : {e}")
+        flash(f'❌ Erreur lors du calcul des paiements en retard : {str(e)}', 'error')
+        resultat = _page_creances_vide()
+
+    return render_template('paiements_en_retard.html',
+                         paiements=resultat['elements'],
+                         total=resultat['totaux'].get('reste_du', 0),
+                         resultat=resultat)
+
+@app.route('/api/creances/balance-agee')
+@login_required
+def api_balance_agee():
+    """API : balance âgée des factures et paiements (nombre et reste dû par tranche de retard)"""
+    try:
+        return jsonify({
+            'success': True,
+            'date': datetime.now().date().isoformat(),
+            'tranches': TRANCHES_BALANCE_AGEE,
+            'balance': balance_agee()
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/paiements-recus')
+def paiements_recus():
+    """Liste des paiements reçus avec filtre de dates"""
+    # Récupérer les paramètres de date (par défaut: 1er janvier de l'année en cours)
+    date_debut_str = request.args.get('date_debut')
+    date_fin_str = request.args.get('date_fin')
+
+    # Dates par défaut
+    if not date_debut_str:
+        date_debut = datetime(datetime.now().year, 1, 1).date()
+    else:
+        date_debut = datetime.strptime(date_debut_str, '%Y-%m-%d').date()
+
+    if not date_fin_str:
+        date_fin = datetime.now().date()
+    else:
+        date_fin = datetime.strptime(date_fin_str, '%Y-%m-%d').date()
+
+    # Récupérer les paiements payés dans la période
+    paiements = []
+    total_paiements_recus = 0
 
     try:
         paiements_query = Paiement.query.filter(
@@ -2478,7 +3438,7 @@ def paiements_recus():
         ).order_by(Paiement.date_paiement.desc()).all()
 
         paiements = paiements_query
-        total_paiements_recus = sum([p.montant_paye or 0 for p in paiements])
+        total_paiements_recus = sum(en_centimes(p.montant_paye) for p in paiements) / 100
     except:
         pass
 
@@ -2488,6 +3448,290 @@ def paiements_recus():
                          date_debut=date_debut,
                          date_fin=date_fin)
 
+# ============================================================================
+# NUMÉROTATION DES DOCUMENTS (table sequences)
+# ============================================================================
+
+# Format des références : (numérotation par année, par mois, nombre de chiffres)
+FORMATS_NUMEROTATION = {
+    'DE': {'annuelle': True, 'mensuelle': False, 'chiffres': 3},   # DE-2025-001
+    'FA': {'annuelle': True, 'mensuelle': True, 'chiffres': 3},    # FA-2025-11-001
+    'P': {'annuelle': False, 'mensuelle': False, 'chiffres': 4}    # P-0001
+}
+
+# Compteurs déjà alignés sur les références existantes dans ce processus
+_sequences_synchronisees = set()
+_sequences_lock = threading.Lock()
+
+
+def _cle_sequence(nature, quand):
+    """Clé (nature, annee, mois) d'un compteur pour une date"""
+    format_numero = FORMATS_NUMEROTATION[nature]
+    annee = quand.year if format_numero['annuelle'] else 0
+    mois = quand.month if format_numero['mensuelle'] else 0
+    return nature, annee, mois
+
+
+def _prefixe_reference(nature, annee, mois):
+    """Préfixe commun des références d'un compteur (ex: FA-2025-11-)"""
+    morceaux = [nature]
+    if annee:
+        morceaux.append(str(annee))
+    if mois:
+        morceaux.append(f"{mois:02d}")
+    return '-'.join(morceaux) + '-'
+
+
+def _colonne_reference(nature):
+    """Colonne portant la référence des documents d'une nature"""
+    return {'DE': Devis.reference_devis, 'FA': Facture.reference_facture, 'P': Paiement.numero_paiement}[nature]
+
+
+def _dernier_numero_existant(nature, annee, mois):
+    """Plus grand numéro déjà utilisé pour ce compteur (recherche sur l'index unique de la référence)"""
+    prefixe = _prefixe_reference(nature, annee, mois)
+    colonne = _colonne_reference(nature)
+    # Intervalle [prefixe, prefixe avec '-' remplacé par '.'[ : utilise l'index, contrairement à LIKE
+    fin_prefixe = prefixe[:-1] + '.'
+    return db.session.query(
+        func.max(db.cast(func.substr(colonne, len(prefixe) + 1), db.Integer))
+    ).filter(colonne >= prefixe, colonne < fin_prefixe).scalar() or 0
+
+
+def _synchroniser_sequence(cle):
+    """Aligne le compteur sur les références existantes (reprise de l'historique, une fois par clé et par processus)"""
+    with _sequences_lock:
+        if cle in _sequences_synchronisees:
+            return
+    nature, annee, mois = cle
+    existant = _dernier_numero_existant(nature, annee, mois)
+    if existant:
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        table = Sequence.__table__
+        requete = sqlite_insert(table).values(nature=nature, annee=annee, mois=mois, valeur=existant)
+        requete = requete.on_conflict_do_update(
+            index_elements=['nature', 'annee', 'mois'],
+            set_={'valeur': func.max(table.c.valeur, requete.excluded.valeur)}
+        )
+        db.session.execute(requete)
+    # Mémorisée seulement après le commit (un rollback annule aussi l'alignement)
+    db.session.info.setdefault('sequences_synchronisees', set()).add(cle)
+
+
+@sa_event.listens_for(SaSession, 'after_commit')
+def _valider_sequences_synchronisees(session):
+    """Les compteurs alignés dans la transaction validée n'ont plus besoin d'être vérifiés"""
+    cles = session.info.pop('sequences_synchronisees', None)
+    if cles:
+        with _sequences_lock:
+            _sequences_synchronisees.update(cles)
+
+
+@sa_event.listens_for(SaSession, 'after_rollback')
+def _oublier_sequences_synchronisees(session):
+    """Rollback : l'alignement des compteurs est annulé avec la transaction"""
+    session.info.pop('sequences_synchronisees', None)
+
+
+def allouer_numero(nature, quand=None):
+    """
+    Attribue le numéro suivant d'un compteur en une instruction atomique (INSERT ... ON CONFLICT DO UPDATE ... RETURNING)
+    L'incrément fait partie de la transaction du document : en cas de rollback le numéro est rendu,
+    la numérotation reste donc sans trou (pas de réservation de numéros à l'avance)
+    """
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+    cle = _cle_sequence(nature, quand or datetime.now())
+    _synchroniser_sequence(cle)
+    nature, annee, mois = cle
+
+    table = Sequence.__table__
+    requete = sqlite_insert(table).values(nature=nature, annee=annee, mois=mois, valeur=1)
+    requete = requete.on_conflict_do_update(
+        index_elements=['nature', 'annee', 'mois'],
+        set_={'valeur': table.c.valeur + 1}
+    )
+    if db.engine.dialect.insert_returning:
+        return db.session.execute(requete.returning(table.c.valeur)).scalar()
+
+    # SQLite < 3.35 : le verrou d'écriture est acquis par l'UPSERT, la relecture reste atomique
+    db.session.execute(requete)
+    return db.session.query(Sequence.valeur).filter_by(nature=nature, annee=annee, mois=mois).scalar()
+
+
+def prochaine_reference(nature, quand=None):
+    """Référence complète du prochain document (ex: FA-2025-11-004, DE-2025-012, P-0042)"""
+    quand = quand or datetime.now()
+    numero = allouer_numero(nature, quand)
+    _, annee, mois = _cle_sequence(nature, quand)
+    return f"{_prefixe_reference(nature, annee, mois)}{numero:0{FORMATS_NUMEROTATION[nature]['chiffres']}d}"
+
+
+def initialiser_sequences():
+    """Reprise unique des compteurs depuis les références existantes (table sequences vide)"""
+    if Sequence.query.first() is not None:
+        return
+    cles = set()
+    for nature in FORMATS_NUMEROTATION:
+        for (reference,) in db.session.query(_colonne_reference(nature)).filter(_colonne_reference(nature).like(f'{nature}-%')):
+            morceaux = reference.split('-')
+            try:
+                annee = int(morceaux[1]) if FORMATS_NUMEROTATION[nature]['annuelle'] else 0
+                mois = int(morceaux[2]) if FORMATS_NUMEROTATION[nature]['mensuelle'] else 0
+            except (IndexError, ValueError):
+                continue
+            cles.add((nature, annee, mois))
+    for cle in cles:
+        _synchroniser_sequence(cle)
+    db.session.commit()
+    if cles:
+        print(f"✅ Compteurs de numérotation initialisés ({len(cles)} séquences)")
+
+
+# ============================================================================
+# LIGNES DE DÉTAIL (déplacement, fourniture, prestation) - lecture du formulaire et écriture groupée
+# ============================================================================
+
+CHAMPS_LIGNE = ('code', 'type', 'nbre', 'pu_ht', 'pt_ht')
+
+
+def lire_lignes_formulaire(form):
+    """
+    Lit et valide les tableaux du formulaire (<section>_code[], _type[], _nbre[], _pu_ht[], _pt_ht[])
+    Retourne (lignes par section, total HT par section) ; les lignes sans type sont ignorées
+    Lève ValueError si une valeur numérique est invalide
+    """
+    def nombre(valeur, section, champ, rang):
+        valeur = (valeur or '').strip().replace(',', '.')
+        if not valeur:
+            return 0.0
+        try:
+            return float(valeur)
+        except ValueError:
+            raise ValueError(f"Valeur invalide '{valeur}' ({section}, ligne {rang}, {champ})")
+
+    lignes = {}
+    totaux = {}
+    for section in SECTIONS_LIGNES:
+        colonnes = {champ: form.getlist(f'{section}_{champ}[]') for champ in CHAMPS_LIGNE}
+        nb_lignes = max(len(valeurs) for valeurs in colonnes.values())
+
+        def valeur(champ, i):
+            return colonnes[champ][i] if i < len(colonnes[champ]) else ''
+
+        lignes[section] = []
+        for i in range(nb_lignes):
+            type_ligne = valeur('type', i).strip()
+            if not type_ligne:  # Ne créer que si le type n'est pas vide
+                continue
+            lignes[section].append({
+                'code': valeur('code', i).strip() or None,
+                'type': type_ligne,
+                'nbre': nombre(valeur('nbre', i), section, 'nbre', i + 1),
+                # Prix arrondis au centime : identiques à ce qui sera relu en base
+                'pu_ht': en_centimes(nombre(valeur('pu_ht', i), section, 'pu_ht', i + 1)) / 100,
+                'pt_ht': en_centimes(nombre(valeur('pt_ht', i), section, 'pt_ht', i + 1)) / 100
+            })
+        totaux[section] = sum(en_centimes(ligne['pt_ht']) for ligne in lignes[section]) / 100
+
+    return lignes, totaux
+
+
+def enregistrer_lignes(nature, document_id, lignes):
+    """
+    Écrit les lignes d'un document (prestation, devis, facture) en ne touchant que ce qui a changé :
+    lecture des lignes existantes en une requête, comparaison position par position dans chaque section
+    (l'ordre d'affichage est celui des id), puis un executemany pour les mises à jour, un pour les insertions
+    et un DELETE pour les lignes en trop
+    Retourne le nombre de lignes (inchangées, modifiées, ajoutées, supprimées)
+    """
+    table = LigneDocument.__table__
+    existantes_par_section = {section: [] for section in SECTIONS_LIGNES}
+    for ligne in db.session.execute(
+        db.select(table.c.id, table.c.section, *[table.c[champ] for champ in CHAMPS_LIGNE])
+        .where(table.c.nature_document == nature, table.c.document_id == document_id)
+        .order_by(table.c.section, table.c.id)
+    ):
+        existantes_par_section.setdefault(ligne.section, []).append(ligne)
+
+    inchangees, a_modifier, a_ajouter, a_supprimer = 0, [], [], []
+    for section, existantes in existantes_par_section.items():
+        nouvelles = lignes.get(section, [])
+        for i, ligne in enumerate(nouvelles):
+            if i < len(existantes):
+                actuelle = existantes[i]
+                if all(getattr(actuelle, champ) == ligne[champ] for champ in CHAMPS_LIGNE):
+                    inchangees += 1
+                else:
+                    a_modifier.append(dict(ligne, ligne_id=actuelle.id))
+            else:
+                a_ajouter.append(dict(ligne, nature_document=nature, document_id=document_id, section=section))
+        a_supprimer.extend(ligne.id for ligne in existantes[len(nouvelles):])
+
+    if a_modifier:
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('ligne_id')).values(
+                **{champ: db.bindparam(champ) for champ in CHAMPS_LIGNE}
+            ),
+            a_modifier
+        )
+    if a_ajouter:
+        db.session.execute(table.insert(), a_ajouter)
+    if a_supprimer:
+        db.session.execute(table.delete().where(table.c.id.in_(a_supprimer)))
+
+    return {
+        'inchangees': inchangees,
+        'modifiees': len(a_modifier),
+        'ajoutees': len(a_ajouter),
+        'supprimees': len(a_supprimer)
+    }
+
+
+# Anciennes tables de lignes (une par document et par section) : (table, nature, colonne du document, section)
+ANCIENNES_TABLES_LIGNES = [
+    ('lignes_prestation_deplacement', 'prestation', 'prestation_id', 'deplacement'),
+    ('lignes_prestation_fourniture', 'prestation', 'prestation_id', 'fourniture'),
+    ('lignes_prestation_tarif', 'prestation', 'prestation_id', 'prestation'),
+    ('lignes_devis_deplacement', 'devis', 'devis_id', 'deplacement'),
+    ('lignes_devis_fourniture', 'devis', 'devis_id', 'fourniture'),
+    ('lignes_devis_prestation', 'devis', 'devis_id', 'prestation'),
+    ('lignes_facture_deplacement', 'facture', 'facture_id', 'deplacement'),
+    ('lignes_facture_fourniture', 'facture', 'facture_id', 'fourniture'),
+    ('lignes_facture_prestation', 'facture', 'facture_id', 'prestation'),
+]
+
+
+def migrer_lignes_document():
+    """
+    Déplace les lignes des neuf anciennes tables vers lignes_document puis supprime ces tables
+    (une seule transaction : en cas d'erreur rien n'est perdu). Idempotent.
+    Les anciens prix (REAL en euros) sont convertis en centimes : lancer après migrer_montants_centimes()
+    Retourne le nombre de lignes déplacées
+    """
+    from sqlalchemy import inspect
+
+    tables_existantes = set(inspect(db.engine).get_table_names())
+    a_migrer = [ancienne for ancienne in ANCIENNES_TABLES_LIGNES if ancienne[0] in tables_existantes]
+    if not a_migrer:
+        return 0
+
+    nb_lignes = 0
+    with db.engine.begin() as conn:
+        for table, nature, colonne, section in a_migrer:
+            resultat = conn.exec_driver_sql(
+                f"INSERT INTO lignes_document (nature_document, document_id, section, code, type, nbre, pu_ht, pt_ht) "
+                f"SELECT ?, {colonne}, ?, code, type, nbre, CAST(ROUND(pu_ht * 100) AS INTEGER), CAST(ROUND(pt_ht * 100) AS INTEGER) "
+                f"FROM {table} ORDER BY {colonne}, id",
+                (nature, section)
+            )
+            nb_lignes += resultat.rowcount
+            conn.exec_driver_sql(f"DROP TABLE {table}")
+
+    print(f"✅ {nb_lignes} ligne(s) de documents migrée(s) depuis {len(a_migrer)} ancienne(s) table(s)")
+    return nb_lignes
+
+
 # ============================================================================
 # ROUTES SAISIE DEVIS, FACTURES, PAIEMENTS
 # ============================================================================
@@ -2499,19 +3743,14 @@ def devis_saisie(prestation_id):
     entreprise = Entreprise.query.first()
 
     if request.method == 'POST':
-        # Générer référence devis automatiquement
-        annee = datetime.now().year
-        dernier_devis = Devis.query.filter(
-            Devis.reference_devis.like(f'DE-{annee}-%')
-        ).order_by(Devis.reference_devis.desc()).first()
-
-        if dernier_devis:
-            dernier_num = int(dernier_devis.reference_devis.split('-')[-1])
-            nouveau_num = dernier_num + 1
-        else:
-            nouveau_num = 1
+        try:
+            lignes, totaux = lire_lignes_formulaire(request.form)
+        except ValueError as e:
+            flash(f'❌ {str(e)}', 'error')
+            return render_template('devis_saisie.html', prestation=prestation, entreprise=entreprise)
 
-        reference_devis = f'DE-{annee}-{nouveau_num:03d}'
+        # Générer référence devis automatiquement
+        reference_devis = prochaine_reference('DE')
 
         # Créer le devis
         devis = Devis(
@@ -2530,68 +3769,10 @@ def devis_saisie(prestation_id):
         db.session.add(devis)
         db.session.flush()  # Obtenir l'ID du devis
 
-        # Traiter les lignes de déplacement
-        codes_dep = request.form.getlist('deplacement_code[]')
-        types_dep = request.form.getlist('deplacement_type[]')
-        nbres_dep = request.form.getlist('deplacement_nbre[]')
-        pus_dep = request.form.getlist('deplacement_pu_ht[]')
-        pts_dep = request.form.getlist('deplacement_pt_ht[]')
-
-        total_deplacement = 0
-        for i in range(len(codes_dep)):
-            if types_dep[i].strip():  # Ne créer que si le type n'est pas vide
-                ligne = LigneDevisDeplacement(
-                    devis_id=devis.id,
-                    code=codes_dep[i].strip() or None,
-                    type=types_dep[i].strip(),
-                    nbre=float(nbres_dep[i]) if nbres_dep[i] else 0,
-                    pu_ht=float(pus_dep[i]) if pus_dep[i] else 0,
-                    pt_ht=float(pts_dep[i]) if pts_dep[i] else 0
-                )
-                db.session.add(ligne)
-                total_deplacement += ligne.pt_ht
-
-        # Traiter les lignes de fourniture
-        codes_four = request.form.getlist('fourniture_code[]')
-        types_four = request.form.getlist('fourniture_type[]')
-        nbres_four = request.form.getlist('fourniture_nbre[]')
-        pus_four = request.form.getlist('fourniture_pu_ht[]')
-        pts_four = request.form.getlist('fourniture_pt_ht[]')
-
-        total_fourniture = 0
-        for i in range(len(codes_four)):
-            if types_four[i].strip():  # Ne créer que si le type n'est pas vide
-                ligne = LigneDevisFourniture(
-                    devis_id=devis.id,
-                    code=codes_four[i].strip() or None,
-                    type=types_four[i].strip(),
-                    nbre=float(nbres_four[i]) if nbres_four[i] else 0,
-                    pu_ht=float(pus_four[i]) if pus_four[i] else 0,
-                    pt_ht=float(pts_four[i]) if pts_four[i] else 0
-                )
-                db.session.add(ligne)
-                total_fourniture += ligne.pt_ht
-
-        # Traiter les lignes de prestation
-        codes_prest = request.form.getlist('prestation_code[]')
-        types_prest = request.form.getlist('prestation_type[]')
-        nbres_prest = request.form.getlist('prestation_nbre[]')
-        pus_prest = request.form.getlist('prestation_pu_ht[]')
-        pts_prest = request.form.getlist('prestation_pt_ht[]')
-
-        total_prestation = 0
-        for i in range(len(codes_prest)):
-            if types_prest[i].strip():  # Ne créer que si le type n'est pas vide
-                ligne = LigneDevisPrestation(
-                    devis_id=devis.id,
-                    code=codes_prest[i].strip() or None,
-                    type=types_prest[i].strip(),
-                    nbre=float(nbres_prest[i]) if nbres_prest[i] else 0,
-                    pu_ht=float(pus_prest[i]) if pus_prest[i] else 0,
-                    pt_ht=float(pts_prest[i]) if pts_prest[i] else 0
-                )
-                db.session.add(ligne)
-                total_prestation += ligne.pt_ht
+        enregistrer_lignes('devis', devis.id, lignes)
+        total_deplacement = totaux['deplacement']
+        total_fourniture = totaux['fourniture']
+        total_prestation = totaux['prestation']
 
         # Mettre à jour les totaux globaux dans le devis (pour compatibilité)
         devis.deplacement_prix_ht = total_deplacement
@@ -2634,25 +3815,19 @@ def facture_saisie(prestation_id):
     if request.method == 'POST':
         action = request.form.get('action', 'creer')
 
+        try:
+            lignes, totaux = lire_lignes_formulaire(request.form)
+        except ValueError as e:
+            flash(f'❌ {str(e)}', 'error')
+            return redirect(url_for('facture_saisie', prestation_id=prestation_id))
+
         # Si on modifie une facture existante
         if action == 'modifier' and facture_existante:
             facture = facture_existante
             # On garde la même référence
         else:
             # Générer une nouvelle référence facture
-            annee = datetime.now().year
-            mois = datetime.now().month
-            derniere_facture = Facture.query.filter(
-                Facture.reference_facture.like(f'FA-{annee}-{mois:02d}-%')
-            ).order_by(Facture.reference_facture.desc()).first()
-
-            if derniere_facture:
-                dernier_num = int(derniere_facture.reference_facture.split('-')[-1])
-                nouveau_num = dernier_num + 1
-            else:
-                nouveau_num = 1
-
-            reference_facture = f'FA-{annee}-{mois:02d}-{nouveau_num:03d}'
+            reference_facture = prochaine_reference('FA')
 
             # Créer une nouvelle facture
             facture = Facture(
@@ -2672,79 +3847,16 @@ def facture_saisie(prestation_id):
         facture.commentaire = request.form.get('commentaire')
         facture.rib = request.form.get('rib')
 
-        # Supprimer les anciennes lignes si on modifie une facture existante
-        if action == 'modifier':
-            LigneFactureDeplacement.query.filter_by(facture_id=facture.id).delete()
-            LigneFactureFourniture.query.filter_by(facture_id=facture.id).delete()
-            LigneFacturePrestation.query.filter_by(facture_id=facture.id).delete()
-
         # Sauvegarder la facture pour obtenir un ID si c'est une nouvelle facture
-        if action != 'modifier':
+        if facture.id is None:
             db.session.add(facture)
             db.session.flush()  # Obtenir l'ID de la facture
 
-        # Traiter les lignes de déplacement
-        codes_dep = request.form.getlist('deplacement_code[]')
-        types_dep = request.form.getlist('deplacement_type[]')
-        nbres_dep = request.form.getlist('deplacement_nbre[]')
-        pus_dep = request.form.getlist('deplacement_pu_ht[]')
-        pts_dep = request.form.getlist('deplacement_pt_ht[]')
-
-        total_deplacement = 0
-        for i in range(len(codes_dep)):
-            if types_dep[i].strip():  # Ne créer que si le type n'est pas vide
-                ligne = LigneFactureDeplacement(
-                    facture_id=facture.id,
-                    code=codes_dep[i].strip() or None,
-                    type=types_dep[i].strip(),
-                    nbre=float(nbres_dep[i]) if nbres_dep[i] else 0,
-                    pu_ht=float(pus_dep[i]) if pus_dep[i] else 0,
-                    pt_ht=float(pts_dep[i]) if pts_dep[i] else 0
-                )
-                db.session.add(ligne)
-                total_deplacement += ligne.pt_ht
-
-        # Traiter les lignes de fourniture
-        codes_four = request.form.getlist('fourniture_code[]')
-        types_four = request.form.getlist('fourniture_type[]')
-        nbres_four = request.form.getlist('fourniture_nbre[]')
-        pus_four = request.form.getlist('fourniture_pu_ht[]')
-        pts_four = request.form.getlist('fourniture_pt_ht[]')
-
-        total_fourniture = 0
-        for i in range(len(codes_four)):
-            if types_four[i].strip():  # Ne créer que si le type n'est pas vide
-                ligne = LigneFactureFourniture(
-                    facture_id=facture.id,
-                    code=codes_four[i].strip() or None,
-                    type=types_four[i].strip(),
-                    nbre=float(nbres_four[i]) if nbres_four[i] else 0,
-                    pu_ht=float(pus_four[i]) if pus_four[i] else 0,
-                    pt_ht=float(pts_four[i]) if pts_four[i] else 0
-                )
-                db.session.add(ligne)
-                total_fourniture += ligne.pt_ht
-
-        # Traiter les lignes de prestation
-        codes_prest = request.form.getlist('prestation_code[]')
-        types_prest = request.form.getlist('prestation_type[]')
-        nbres_prest = request.form.getlist('prestation_nbre[]')
-        pus_prest = request.form.getlist('prestation_pu_ht[]')
-        pts_prest = request.form.getlist('prestation_pt_ht[]')
-
-        total_prestation = 0
-        for i in range(len(codes_prest)):
-            if types_prest[i].strip():  # Ne créer que si le type n'est pas vide
-                ligne = LigneFacturePrestation(
-                    facture_id=facture.id,
-                    code=codes_prest[i].strip() or None,
-                    type=types_prest[i].strip(),
-                    nbre=float(nbres_prest[i]) if nbres_prest[i] else 0,
-                    pu_ht=float(pus_prest[i]) if pus_prest[i] else 0,
-                    pt_ht=float(pts_prest[i]) if pts_prest[i] else 0
-                )
-                db.session.add(ligne)
-                total_prestation += ligne.pt_ht
+        # Lignes : seules les lignes modifiées sont réécrites (facture existante)
+        enregistrer_lignes('facture', facture.id, lignes)
+        total_deplacement = totaux['deplacement']
+        total_fourniture = totaux['fourniture']
+        total_prestation = totaux['prestation']
 
         # Mettre à jour les totaux globaux dans la facture (pour compatibilité)
         facture.deplacement_prix_ht = total_deplacement
@@ -2804,14 +3916,7 @@ Cordialement,
 
         # Créer automatiquement un paiement associé si facture envoyée
         if facture.date_envoi and action != 'modifier':
-            dernier_paiement = Paiement.query.order_by(Paiement.numero_paiement.desc()).first()
-            if dernier_paiement and dernier_paiement.numero_paiement:
-                dernier_num = int(dernier_paiement.numero_paiement.split('-')[1])
-                nouveau_num = dernier_num + 1
-            else:
-                nouveau_num = 1
-
-            numero_paiement = f'P-{nouveau_num:04d}'
+            numero_paiement = prochaine_reference('P')
             delai = prestation.client.delai_paiement_jours if prestation.client else 30
             date_butoir = facture.date_facture + timedelta(days=delai)
 
@@ -2882,17 +3987,10 @@ def paiement_saisie():
     if request.method == 'POST':
         if not paiement:
             # Créer nouveau paiement
-            dernier_paiement = Paiement.query.order_by(Paiement.numero_paiement.desc()).first()
-            if dernier_paiement and dernier_paiement.numero_paiement:
-                dernier_num = int(dernier_paiement.numero_paiement.split('-')[1])
-                nouveau_num = dernier_num + 1
-            else:
-                nouveau_num = 1
-
             paiement = Paiement(
                 facture_id=facture.id,
                 prestation_id=facture.prestation_id,
-                numero_paiement=f'P-{nouveau_num:04d}',
+                numero_paiement=prochaine_reference('P'),
                 numero_facture=facture.reference_facture
             )
             db.session.add(paiement)
@@ -2917,7 +4015,7 @@ def paiement_saisie():
                 paiement.nb_jours_retard = max(0, (datetime.now().date() - paiement.date_butoir).days)
 
         # Définir statut
-        if paiement.montant_paye >= paiement.montant_total:
+        if en_centimes(paiement.montant_paye) >= en_centimes(paiement.montant_total):
             paiement.statut = 'Payé'
             facture.prestation.statut_paiement = 'Payé'
             facture.prestation.statut_facture = 'Payée'
@@ -3092,6 +4190,7 @@ def entreprise_modifier():
             db.session.add(info_entreprise)
             flash('Informations de l\'entreprise créées avec succès !', 'success')
 
+        localiser(info_entreprise, request.form)
         db.session.commit()
         return redirect(url_for('entreprise'))
 
@@ -3108,7 +4207,9 @@ def api_entreprise_adresse():
             'adresse': adresse_complete,
             'adresse_brut': info_entreprise.adresse,
             'code_postal': info_entreprise.code_postal,
-            'ville': info_entreprise.ville
+            'ville': info_entreprise.ville,
+            'latitude': info_entreprise.latitude,
+            'longitude': info_entreprise.longitude
         })
     else:
         return jsonify({
@@ -3136,7 +4237,7 @@ def sauvegarde_creer():
         # Obtenir le chemin absolu de la base de données depuis l'instance Flask
         db_source = os.path.join(os.getcwd(), 'instance', 'gestion_entreprise.db')
         if os.path.exists(db_source):
-            shutil.copy2(db_source, chemin_local)
+            copier_base_sqlite(db_source, chemin_local)
             taille = os.path.getsize(chemin_local)
 
             # Tenter la copie vers Google Drive
@@ -3227,10 +4328,10 @@ def sauvegarde_restaurer(sauvegarde_id):
         db_backup_old = os.path.join(os.getcwd(), 'instance', 'gestion_entreprise_OLD.db')
 
         if os.path.exists(db_actuelle):
-            shutil.copy2(db_actuelle, db_backup_old)
+            copier_base_sqlite(db_actuelle, db_backup_old)
 
         # Restaurer la sauvegarde
-        shutil.copy2(sauvegarde.chemin_local, db_actuelle)
+        restaurer_base_sqlite(sauvegarde.chemin_local, db_actuelle)
 
         flash(f'✓ Base de données restaurée avec succès ! (Ancienne base sauvegardée dans {db_backup_old})', 'success')
 
@@ -3256,10 +4357,10 @@ def sauvegarde_restaurer_fichier():
         db_backup_old = os.path.join(os.getcwd(), 'instance', 'gestion_entreprise_OLD.db')
 
         if os.path.exists(db_actuelle):
-            shutil.copy2(db_actuelle, db_backup_old)
+            copier_base_sqlite(db_actuelle, db_backup_old)
 
         # Restaurer la sauvegarde
-        shutil.copy2(chemin_sauvegarde, db_actuelle)
+        restaurer_base_sqlite(chemin_sauvegarde, db_actuelle)
 
         flash(f'✓ Base de données restaurée avec succès ! (Ancienne base sauvegardée dans {db_backup_old})', 'success')
 
@@ -3378,8 +4479,6 @@ def envoyer_sms_twilio(destinataire_tel, message, account_sid, auth_token, from_
 def envoyer_sms_smsmode(destinataire_tel, message, api_key):
     """Envoyer un SMS via SMS Mode (API HTTP)"""
     try:
-        import requests
-
         url = "https://api.smsmode.com/http/1.6/sendSMS.do"
         params = {
             'accessToken': api_key,
@@ -3388,7 +4487,8 @@ def envoyer_sms_smsmode(destinataire_tel, message, api_key):
             'emetteur': 'MonEntreprise'  # Max 11 caractères
         }
 
-        response = requests.get(url, params=params)
+        # Pas de reprise automatique : un envoi rejoué après un timeout pourrait partir deux fois
+        response = requete_http('GET', url, params=params, reessais=0)
 
         if response.status_code == 200:
             return True, "SMS Mode envoyé avec succès"
@@ -3701,66 +4801,1237 @@ def parametres():
     # Passer la config au template
     return render_template('parametres.html', config=app.config)
 # ============================================================================
-# FONCTIONS RECHERCHE ENTREPRISES (OpenStreetMap)
+# CLIENT HTTP SORTANT - session partagée, limites de débit par hôte, reprises
 # ============================================================================
 
-def rechercher_entreprises_nominatim_direct(query):
+app.config.setdefault('HTTP_TIMEOUT', 15)  # Secondes, quand l'appelant n'en précise pas
+app.config.setdefault('HTTP_REESSAIS', 2)  # Nouvelles tentatives sur erreur réseau, 429 ou 5xx
+app.config.setdefault('HTTP_REESSAI_DELAI', 0.5)  # Secondes avant la 1re reprise, doublées à chaque tentative
+app.config.setdefault('HTTP_POOL_TAILLE', 10)  # Connexions gardées ouvertes par hôte
+app.config.setdefault('HTTP_USER_AGENT', 'GestionEntreprise/1.0')
+# Débit par hôte (requêtes/seconde, rafale) : seau à jetons partagé par tous les threads du processus
+app.config.setdefault('LIMITES_HOTES', {
+    'nominatim.openstreetmap.org': (1.0, 1),  # Politique d'usage Nominatim : 1 requête par seconde au plus
+    'overpass-api.de': (1.0, 2),
+    'router.project-osrm.org': (1.0, 1),
+})
+
+STATUTS_A_REESSAYER = (429, 500, 502, 503, 504)
+
+_session_http = None
+_http_lock = threading.Lock()
+_seaux_hotes = {}  # hôte -> SeauJetons
+http_compteurs = {}  # hôte -> {'appels', 'erreurs', 'reessais', 'duree_ms', 'duree_max_ms', 'dernier_statut'}
+_echeance_http = threading.local()  # Échéance (time.monotonic) des appels du thread courant, posée par executer_strategies
+
+
+class SeauJetons:
+    """Seau à jetons : `debit` requêtes par seconde en régime établi, `rafale` requêtes d'affilée au plus"""
+
+    def __init__(self, debit, rafale):
+        self.debit = debit
+        self.rafale = rafale
+        self.jetons = float(rafale)
+        self.instant = time.monotonic()
+        self.lock = threading.Lock()
+
+    def attente(self):
+        """Prend un jeton et retourne le temps à attendre avant de l'utiliser (les threads en trop font la queue)"""
+        with self.lock:
+            maintenant = time.monotonic()
+            self.jetons = min(self.rafale, self.jetons + (maintenant - self.instant) * self.debit) - 1
+            self.instant = maintenant
+            return -self.jetons / self.debit if self.jetons < 0 else 0
+
+
+def session_http():
+    """Session requests partagée (pool de connexions keep-alive), créée au premier usage dans chaque processus"""
+    global _session_http
+    with _http_lock:
+        if _session_http is None:
+            from requests.adapters import HTTPAdapter
+
+            session_requests = requests.Session()
+            adaptateur = HTTPAdapter(pool_connections=app.config['HTTP_POOL_TAILLE'],
+                                     pool_maxsize=app.config['HTTP_POOL_TAILLE'])
+            session_requests.mount('https://', adaptateur)
+            session_requests.mount('http://', adaptateur)
+            session_requests.headers['User-Agent'] = app.config['HTTP_USER_AGENT']
+            _session_http = session_requests
+        return _session_http
+
+
+def _seau_hote(hote):
+    limite = app.config['LIMITES_HOTES'].get(hote)
+    if not limite:
+        return None
+    with _http_lock:
+        if hote not in _seaux_hotes:
+            _seaux_hotes[hote] = SeauJetons(*limite)
+        return _seaux_hotes[hote]
+
+
+def _compter_http(hote, duree_ms=None, statut=None, erreur=False, reessai=False):
+    with _http_lock:
+        compteurs = http_compteurs.setdefault(hote, {'appels': 0, 'erreurs': 0, 'reessais': 0,
+                                                     'duree_ms': 0, 'duree_max_ms': 0, 'dernier_statut': None})
+        if duree_ms is not None:
+            compteurs['appels'] += 1
+            compteurs['duree_ms'] += duree_ms
+            compteurs['duree_max_ms'] = max(compteurs['duree_max_ms'], duree_ms)
+            compteurs['dernier_statut'] = statut
+        compteurs['erreurs'] += erreur
+        compteurs['reessais'] += reessai
+
+
+def echeance_http_depassee():
+    """L'échéance du thread courant est atteinte (False sans échéance)"""
+    echeance = getattr(_echeance_http, 'valeur', None)
+    return echeance is not None and time.monotonic() >= echeance
+
+
+def requete_http(methode, url, reessais=None, echeance=None, **options):
     """
-    Recherche directe avec Nominatim (sans séparation nom/ville)
-    Ex: "leclerc carcassonne" cherché tel quel
+    Appel HTTP sortant via la session partagée : limite de débit de l'hôte, timeout par défaut,
+    reprises avec attente exponentielle sur erreur réseau / 429 / 5xx (Retry-After respecté)
+    Retourne la réponse (l'appelant teste le statut), lève l'exception réseau si toutes les tentatives échouent
+    reessais=0 pour un appel non rejouable (envoi de SMS)
+    echeance (time.monotonic, par défaut celle du thread courant) : timeout réduit au temps restant,
+    aucune tentative ni attente au-delà (requests.Timeout si l'appel ne peut plus partir à temps)
     """
-    import requests
+    from urllib.parse import urlsplit
+
+    hote = urlsplit(url).hostname
+    seau = _seau_hote(hote)
+    timeout = options.pop('timeout', app.config['HTTP_TIMEOUT'])
+    reessais = app.config['HTTP_REESSAIS'] if reessais is None else reessais
+    echeance = getattr(_echeance_http, 'valeur', None) if echeance is None else echeance
+
+    for tentative in range(reessais + 1):
+        attente = seau.attente() if seau else 0
+        restant = None if echeance is None else echeance - time.monotonic() - attente
+        if restant is not None and restant <= 0:
+            raise requests.Timeout(f"Échéance atteinte avant l'appel à {hote}")
+        if attente:
+            time.sleep(attente)
+        debut = time.perf_counter()
+        try:
+            reponse = session_http().request(methode, url, timeout=timeout if restant is None else min(timeout, restant),
+                                             **options)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _compter_http(hote, round((time.perf_counter() - debut) * 1000), type(e).__name__, erreur=True)
+            delai = app.config['HTTP_REESSAI_DELAI'] * 2 ** tentative
+            if tentative == reessais or (echeance is not None and time.monotonic() + delai >= echeance):
+                raise
+        else:
+            _compter_http(hote, round((time.perf_counter() - debut) * 1000), reponse.status_code,
+                          erreur=reponse.status_code >= 400)
+            delai = app.config['HTTP_REESSAI_DELAI'] * 2 ** tentative
+            retry_after = reponse.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delai = max(delai, min(int(retry_after), 60))
+            if (reponse.status_code not in STATUTS_A_REESSAYER or tentative == reessais
+                    or (echeance is not None and time.monotonic() + delai >= echeance)):
+                return reponse
+        _compter_http(hote, reessai=True)
+        time.sleep(delai)
+
+
+def stats_http():
+    """Compteurs par hôte depuis le démarrage du processus (latence moyenne en ms)"""
+    with _http_lock:
+        stats = {hote: dict(compteurs) for hote, compteurs in http_compteurs.items()}
+    for compteurs in stats.values():
+        compteurs['duree_moyenne_ms'] = round(compteurs['duree_ms'] / compteurs['appels']) if compteurs['appels'] else None
+    return stats
 
-    try:
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {
-            'q': f"{query}, France",
-            'format': 'json',
-            'limit': 20,
-            'addressdetails': 1
-        }
-        headers = {'User-Agent': 'GestionEntreprise/1.0'}
 
-        response = requests.get(url, params=params, headers=headers, timeout=10)
+# ============================================================================
+# GÉOCODAGE NOMINATIM - cache persistant (geocode_cache) + LRU en mémoire
+# ============================================================================
 
-        if response.status_code != 200:
-            return []
+app.config.setdefault('NOMINATIM_URL', 'https://nominatim.openstreetmap.org/search')
+app.config.setdefault('GEOCODAGE_TIMEOUT', 10)  # Secondes
+app.config.setdefault('GEOCODAGE_CACHE_JOURS', int(os.environ.get('GEOCODAGE_CACHE_JOURS', 30)))  # Durée de validité en base
+app.config.setdefault('GEOCODAGE_LRU_TAILLE', 512)  # Nombre de requêtes gardées en mémoire par processus
+# Transport HTTP : fonction (url, params, headers, timeout) -> JSON décodé, lève une exception si échec.
+# None = client HTTP partagé ; les tests peuvent y mettre un bouchon local (aucun accès réseau)
+app.config.setdefault('GEOCODAGE_TRANSPORT', None)
 
-        data = response.json()
-        entreprises = []
+_geocodage_lru = OrderedDict()  # clé -> (expiration, résultats)
+_geocodage_lock = threading.Lock()
+geocodage_compteurs = {'lru': 0, 'base': 0, 'reseau': 0, 'erreurs': 0}
 
-        for result in data:
-            # Vérifier que c'est bien un commerce/POI et pas juste une ville
-            osm_type = result.get('type', '')
-            if osm_type in ['city', 'town', 'village', 'municipality']:
-                continue  # Ignorer les résultats qui sont juste des villes
 
-            address = result.get('address', {})
+def normaliser_requete(texte):
+    """Clé de cache : minuscules, sans accents, espaces et virgules uniformisés"""
+    texte = unicodedata.normalize('NFKD', texte or '')
+    texte = ''.join(c for c in texte if not unicodedata.combining(c)).lower()
+    texte = re.sub(r'\s*,\s*', ', ', texte)
+    return re.sub(r'\s+', ' ', texte).strip(' ,')
 
-            # Construire l'adresse
-            rue = address.get('road', '')
-            numero = address.get('house_number', '')
-            if numero and rue:
-                adresse_complete = f"{numero} {rue}"
-            elif rue:
-                adresse_complete = rue
-            else:
-                adresse_complete = ''
 
-            # Extraire le nom (premier élément avant la virgule)
-            nom_complet = result.get('display_name', '')
-            nom = nom_complet.split(',')[0].strip()
+def _transport_nominatim(url, params, headers, timeout):
+    """Transport HTTP par défaut (client HTTP partagé)"""
+    reponse = requete_http('GET', url, params=params, headers=headers, timeout=timeout)
+    reponse.raise_for_status()
+    return reponse.json()
 
-            entreprise = {
-                'nom': nom,
-                'adresse': adresse_complete,
-                'code_postal': address.get('postcode', ''),
-                'ville': address.get('city') or address.get('town') or address.get('village', ''),
-                'latitude': float(result.get('lat', 0)),
-                'longitude': float(result.get('lon', 0))
-            }
 
-            entreprises.append(entreprise)
+def _compter_geocodage(source):
+    with _geocodage_lock:
+        geocodage_compteurs[source] += 1
+
+
+def _lru_geocodage(cle, resultats=None, expiration=None):
+    """Lecture (resultats=None) ou écriture dans le LRU en mémoire"""
+    with _geocodage_lock:
+        if resultats is None:
+            entree = _geocodage_lru.get(cle)
+            if entree is None or entree[0] < time.time():
+                return None
+            _geocodage_lru.move_to_end(cle)
+            return entree[1]
+        _geocodage_lru[cle] = (expiration, resultats)
+        _geocodage_lru.move_to_end(cle)
+        while len(_geocodage_lru) > app.config['GEOCODAGE_LRU_TAILLE']:
+            _geocodage_lru.popitem(last=False)
+
+
+def geocoder(requete, limite=1, details=False):
+    """
+    Recherche Nominatim avec cache : LRU du processus, puis table geocode_cache, puis réseau
+    Retourne la liste de résultats Nominatim (éventuellement vide, les réponses vides sont aussi gardées)
+    Lève une exception si Nominatim est injoignable (rien n'est alors mis en cache)
+    """
+    cle = f"{normaliser_requete(requete)}|{limite}|{1 if details else 0}"
+    duree = timedelta(days=app.config['GEOCODAGE_CACHE_JOURS'])
+
+    resultats = _lru_geocodage(cle)
+    if resultats is not None:
+        _compter_geocodage('lru')
+        return resultats
+
+    # Connexion dédiée : le cache ne doit pas committer la session de la requête en cours
+    table = GeocodeCache.__table__
+    with db.engine.connect() as conn:
+        ligne = conn.execute(
+            db.select(table.c.reponse, table.c.date_maj).where(table.c.cle == cle)
+        ).first()
+    if ligne and ligne.date_maj + duree > datetime.utcnow():
+        resultats = json.loads(ligne.reponse)
+        _lru_geocodage(cle, resultats, time.time() + (ligne.date_maj + duree - datetime.utcnow()).total_seconds())
+        _compter_geocodage('base')
+        return resultats
+
+    transport = app.config['GEOCODAGE_TRANSPORT'] or _transport_nominatim
+    params = {'q': requete, 'format': 'json', 'limit': limite}
+    if details:
+        params['addressdetails'] = 1
+    try:
+        resultats = transport(app.config['NOMINATIM_URL'], params,
+                              {'User-Agent': 'GestionEntreprise/1.0'}, app.config['GEOCODAGE_TIMEOUT'])
+    except Exception:
+        _compter_geocodage('erreurs')
+        raise
+    _compter_geocodage('reseau')
+
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+    maintenant = datetime.utcnow()
+    requete_sql = sqlite_insert(table).values(cle=cle, requete=requete[:500], reponse=json.dumps(resultats), date_maj=maintenant)
+    requete_sql = requete_sql.on_conflict_do_update(
+        index_elements=['cle'],
+        set_={'reponse': requete_sql.excluded.reponse, 'date_maj': requete_sql.excluded.date_maj}
+    )
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(requete_sql)
+    except OperationalError as e:
+        print(f"⚠️ Cache de géocodage non enregistré : {e}")
+    _lru_geocodage(cle, resultats, time.time() + duree.total_seconds())
+    return resultats
+
+
+def geocoder_point(requete):
+    """Premier résultat sous forme (lat, lon), ou None si le lieu est inconnu"""
+    resultats = geocoder(requete)
+    if not resultats:
+        return None
+    return float(resultats[0]['lat']), float(resultats[0]['lon'])
+
+
+def stats_geocodage():
+    """Compteurs depuis le démarrage du processus + taille des caches"""
+    with _geocodage_lock:
+        stats = dict(geocodage_compteurs, taille_lru=len(_geocodage_lru))
+    total = stats['lru'] + stats['base'] + stats['reseau']
+    stats['taux_succes'] = round(100 * (stats['lru'] + stats['base']) / total, 1) if total else None
+    stats['taille_base'] = db.session.query(func.count(GeocodeCache.cle)).scalar()
+    return stats
+
+
+def purger_cache_geocodage(tout=False):
+    """Supprime les entrées expirées (ou toutes) du cache de géocodage. Retourne le nombre de lignes supprimées"""
+    table = GeocodeCache.__table__
+    requete = table.delete()
+    if not tout:
+        requete = requete.where(table.c.date_maj < datetime.utcnow() - timedelta(days=app.config['GEOCODAGE_CACHE_JOURS']))
+    with db.engine.begin() as conn:
+        nb = conn.execute(requete).rowcount
+    with _geocodage_lock:
+        _geocodage_lru.clear()
+    return nb
+
+
+@app.cli.command('purger-geocodage')
+def purger_geocodage_commande():
+    """Supprime les entrées expirées du cache de géocodage"""
+    nb = purger_cache_geocodage()
+    print(f"✅ {nb} entrée(s) supprimée(s) du cache de géocodage")
+
+
+# ============================================================================
+# DISTANCES - coordonnées enregistrées + cache des trajets (table distances)
+# ============================================================================
+
+app.config.setdefault('VITESSE_MOYENNE_KMH', 80)  # Estimation de durée quand le trajet n'est pas calculé par OSRM
+# Serveur OSRM (ex: https://router.project-osrm.org) pour des distances routières ; None = estimation à vol d'oiseau
+app.config.setdefault('OSRM_URL', os.environ.get('OSRM_URL') or None)
+app.config.setdefault('DISTANCES_LOT_MAX', 100)  # Destinations maximum par appel de /api/distances
+
+# Champs formant l'adresse postale, par table
+CHAMPS_ADRESSE = {
+    'clients': ('adresse', 'code_postal', 'ville'),
+    'prestations': ('adresse_prestation', 'code_postal_prestation', 'ville_prestation'),
+    'entreprise': ('adresse', 'code_postal', 'ville')
+}
+
+
+def adresse_postale(objet):
+    """Adresse d'un client, d'une prestation ou de l'entreprise sur une ligne ('' si vide)"""
+    adresse, code_postal, ville = (getattr(objet, champ) or '' for champ in CHAMPS_ADRESSE[objet.__tablename__])
+    return ', '.join(partie for partie in (adresse.strip(), f"{code_postal.strip()} {ville.strip()}".strip()) if partie)
+
+
+def localiser(objet, formulaire=None):
+    """
+    Renseigne latitude/longitude à l'enregistrement :
+    coordonnées envoyées par le formulaire (autocomplétion BAN) si présentes,
+    sinon géocodage (en cache) seulement si l'adresse a changé ou n'a jamais été localisée
+    N'échoue jamais : sans réseau les coordonnées restent vides
+    """
+    if formulaire is not None:
+        latitude = formulaire.get('latitude', type=float)
+        longitude = formulaire.get('longitude', type=float)
+        if latitude is not None and longitude is not None:
+            objet.latitude, objet.longitude = latitude, longitude
+            return True
+
+    etat = db.inspect(objet)
+    adresse_modifiee = etat.transient or etat.pending or any(
+        etat.attrs[champ].history.has_changes() for champ in CHAMPS_ADRESSE[objet.__tablename__]
+    )
+    if objet.latitude is not None and not adresse_modifiee:
+        return True
+
+    objet.latitude = objet.longitude = None
+    adresse = adresse_postale(objet)
+    if not adresse:
+        return False
+    try:
+        point = geocoder_point(f"{adresse}, France")
+    except Exception as e:
+        print(f"⚠️ Géocodage impossible pour '{adresse}' : {e}")
+        return False
+    if point:
+        objet.latitude, objet.longitude = point
+    return point is not None
+
+
+def point_entreprise():
+    """
+    Coordonnées de l'entreprise, ou None
+    Géocodées puis enregistrées la première fois par une connexion dédiée (la session de la requête n'est ni
+    flushée ni committée : pas de verrou d'écriture pris pendant l'appel réseau)
+    """
+    with db.session.no_autoflush:
+        info_entreprise = Entreprise.query.first()
+    if not info_entreprise:
+        return None
+    if info_entreprise.latitude is None:
+        adresse = adresse_postale(info_entreprise)
+        try:
+            point = geocoder_point(f"{adresse}, France") if adresse else None
+        except Exception as e:
+            print(f"⚠️ Géocodage de l'adresse de l'entreprise impossible : {e}")
+            point = None
+        if point is None:
+            return None
+        from sqlalchemy.orm.attributes import set_committed_value
+        with db.engine.begin() as conn:
+            conn.execute(Entreprise.__table__.update().where(Entreprise.__table__.c.id == info_entreprise.id)
+                         .values(latitude=point[0], longitude=point[1]))
+        set_committed_value(info_entreprise, 'latitude', point[0])
+        set_committed_value(info_entreprise, 'longitude', point[1])
+    return info_entreprise.latitude, info_entreprise.longitude
+
+
+def _cle_trajet(point_a, point_b):
+    """Clé symétrique d'un trajet : les deux points arrondis à 5 décimales (~1 m) puis triés"""
+    a, b = sorted(f"{round(lat, 5):.5f},{round(lon, 5):.5f}" for lat, lon in (point_a, point_b))
+    return f"{a}|{b}"
+
+
+def _estimer_trajet(point_a, point_b):
+    """Distance à vol d'oiseau (haversine) et durée à vitesse moyenne"""
+    from math import radians, cos, sin, asin, sqrt
+
+    lat1, lon1, lat2, lon2 = map(radians, [point_a[0], point_a[1], point_b[0], point_b[1]])
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    distance_km = round(2 * asin(sqrt(a)) * 6371, 1)
+    return distance_km, round(distance_km / app.config['VITESSE_MOYENNE_KMH'] * 60)
+
+
+def _trajets_osrm(origine, destinations):
+    """Un seul appel OSRM /table pour toutes les destinations : liste de (km, minutes) ou None par destination"""
+    coordonnees = ';'.join(f"{lon},{lat}" for lat, lon in [origine] + destinations)
+    reponse = requete_http(
+        'GET', f"{app.config['OSRM_URL'].rstrip('/')}/table/v1/driving/{coordonnees}",
+        params={'sources': 0, 'annotations': 'distance,duration'}
+    )
+    reponse.raise_for_status()
+    donnees = reponse.json()
+    distances, durees = donnees['distances'][0][1:], donnees['durations'][0][1:]
+    return [
+        (round(d / 1000, 1), round(t / 60)) if d is not None and t is not None else None
+        for d, t in zip(distances, durees)
+    ]
+
+
+def calculer_trajets(origine, destinations):
+    """
+    Distance (km) et durée (min) de origine vers chaque destination, dans l'ordre
+    Une requête pour relire le cache, un seul appel OSRM (si configuré) pour les trajets manquants,
+    un executemany pour les enregistrer
+    Retourne une liste de {'distance_km', 'duree_minutes', 'source'}
+    """
+    cles = [_cle_trajet(origine, destination) for destination in destinations]
+    with db.session.no_autoflush:  # Les écritures du cache passent par une connexion dédiée
+        connus = {
+            ligne.cle: {'distance_km': ligne.distance_km, 'duree_minutes': ligne.duree_minutes, 'source': ligne.source}
+            for ligne in Distance.query.filter(Distance.cle.in_(set(cles))).all()
+        } if cles else {}
+
+    manquants = sorted({cle: destination for cle, destination in zip(cles, destinations) if cle not in connus}.items())
+    nouveaux = {}
+    if manquants and app.config['OSRM_URL']:
+        try:
+            for (cle, _), trajet in zip(manquants, _trajets_osrm(origine, [d for _, d in manquants])):
+                if trajet:
+                    nouveaux[cle] = {'cle': cle, 'distance_km': trajet[0], 'duree_minutes': trajet[1], 'source': 'osrm'}
+        except Exception as e:
+            print(f"⚠️ OSRM indisponible, estimation à vol d'oiseau : {e}")
+    for cle, destination in manquants:
+        if cle not in nouveaux:
+            distance_km, duree_minutes = _estimer_trajet(origine, destination)
+            nouveaux[cle] = {'cle': cle, 'distance_km': distance_km, 'duree_minutes': duree_minutes, 'source': 'estimation'}
+
+    if nouveaux:
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        maintenant = datetime.utcnow()
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    sqlite_insert(Distance.__table__).on_conflict_do_nothing(index_elements=['cle']),
+                    [dict(trajet, date_calcul=maintenant) for trajet in nouveaux.values()]
+                )
+        except OperationalError as e:
+            print(f"⚠️ Cache des distances non enregistré : {e}")
+
+    for cle, trajet in nouveaux.items():
+        connus[cle] = {champ: trajet[champ] for champ in ('distance_km', 'duree_minutes', 'source')}
+    return [connus[cle] for cle in cles]
+
+
+def calculer_trajet(origine, destination):
+    """Distance et durée d'un seul trajet (via le cache)"""
+    return calculer_trajets(origine, [destination])[0]
+
+
+def trajet_depuis_entreprise(prestation):
+    """Distance/durée depuis l'entreprise jusqu'au lieu d'une prestation localisée, sans appel réseau si déjà en cache"""
+    if prestation.latitude is None:
+        return None
+    origine = point_entreprise()
+    if origine is None:
+        return None
+    return calculer_trajet(origine, (prestation.latitude, prestation.longitude))
+
+
+def localiser_prestation(prestation, formulaire=None):
+    """Coordonnées du lieu puis, si le formulaire ne les donne pas, distance et durée depuis l'entreprise"""
+    localiser(prestation, formulaire)
+    if prestation.distance_km is None:
+        trajet = trajet_depuis_entreprise(prestation)
+        if trajet:
+            prestation.distance_km = trajet['distance_km']
+            prestation.duree_trajet_minutes = trajet['duree_minutes']
+
+
+@app.route('/api/distances', methods=['POST'])
+@login_required
+def api_distances():
+    """
+    Distances et durées depuis l'entreprise vers N destinations en un appel
+    Corps JSON : {"destinations": ["10 rue X, 11000 Carcassonne", {"latitude": 43.2, "longitude": 2.35}, ...]}
+    Réponse : {"success": true, "trajets": [{"distance_km", "duree_minutes", "source"} ou null], ...} dans le même ordre
+    """
+    donnees = request.get_json(silent=True) or {}
+    destinations = donnees.get('destinations') or []
+    if not isinstance(destinations, list) or not destinations:
+        return jsonify({'success': False, 'message': 'Liste de destinations requise'}), 400
+    if len(destinations) > app.config['DISTANCES_LOT_MAX']:
+        return jsonify({'success': False, 'message': f"{app.config['DISTANCES_LOT_MAX']} destinations maximum"}), 400
+
+    origine = point_entreprise()
+    if origine is None:
+        return jsonify({'success': False, 'message': 'Adresse de l\'entreprise non configurée ou introuvable'})
+
+    points = []
+    for destination in destinations:
+        point = None
+        try:
+            if isinstance(destination, dict):
+                point = (float(destination['latitude']), float(destination['longitude']))
+            elif isinstance(destination, str) and destination.strip():
+                point = geocoder_point(destination)
+        except Exception as e:
+            print(f"⚠️ Destination ignorée ({destination}) : {e}")
+        points.append(point)
+
+    localises = [point for point in points if point is not None]
+    trajets = iter(calculer_trajets(origine, localises)) if localises else iter([])
+    return jsonify({
+        'success': True,
+        'origine': {'latitude': origine[0], 'longitude': origine[1]},
+        'trajets': [next(trajets) if point is not None else None for point in points]
+    })
+
+
+# ============================================================================
+# RÉFÉRENTIEL HORS LIGNE - adresses BAN + lieux OSM (base SQLite annexe, FTS5 + R*Tree)
+# ============================================================================
+
+# Base annexe alimentée par `flask importer-referentiel` ; absente = recherches en ligne uniquement
+app.config.setdefault('REFERENTIEL_DB', os.environ.get('REFERENTIEL_DB') or os.path.join(app.instance_path, 'referentiel.db'))
+app.config.setdefault('REFERENTIEL_LOT_IMPORT', 5000)  # Lignes par executemany lors de l'import
+
+# Tags OSM qui font d'un objet nommé un lieu de prospection (le premier présent donne le secteur)
+CLES_SECTEUR_OSM = ('shop', 'office', 'amenity', 'craft', 'tourism', 'healthcare')
+
+referentiel_compteurs = {'trouve': 0, 'absent': 0}
+_referentiel_lock = threading.Lock()
+
+SCHEMA_REFERENTIEL = """
+CREATE TABLE IF NOT EXISTS lieux (
+    id INTEGER PRIMARY KEY,
+    cle_source TEXT NOT NULL UNIQUE,
+    source TEXT NOT NULL,
+    nom TEXT NOT NULL,
+    numero TEXT,
+    rue TEXT,
+    code_postal TEXT,
+    ville TEXT,
+    ville_cle TEXT,
+    secteur TEXT,
+    telephone TEXT,
+    email TEXT,
+    website TEXT,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_lieux_ville ON lieux (source, ville_cle);
+CREATE VIRTUAL TABLE IF NOT EXISTS lieux_fts USING fts5(
+    nom, rue, code_postal, ville,
+    content='lieux', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS lieux_geo USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE TRIGGER IF NOT EXISTS lieux_ai AFTER INSERT ON lieux BEGIN
+    INSERT INTO lieux_fts (rowid, nom, rue, code_postal, ville) VALUES (new.id, new.nom, new.rue, new.code_postal, new.ville);
+    INSERT INTO lieux_geo VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+END;
+CREATE TRIGGER IF NOT EXISTS lieux_ad AFTER DELETE ON lieux BEGIN
+    INSERT INTO lieux_fts (lieux_fts, rowid, nom, rue, code_postal, ville) VALUES ('delete', old.id, old.nom, old.rue, old.code_postal, old.ville);
+    DELETE FROM lieux_geo WHERE id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS lieux_au AFTER UPDATE ON lieux BEGIN
+    INSERT INTO lieux_fts (lieux_fts, rowid, nom, rue, code_postal, ville) VALUES ('delete', old.id, old.nom, old.rue, old.code_postal, old.ville);
+    INSERT INTO lieux_fts (rowid, nom, rue, code_postal, ville) VALUES (new.id, new.nom, new.rue, new.code_postal, new.ville);
+    UPDATE lieux_geo SET min_lat = new.latitude, max_lat = new.latitude, min_lon = new.longitude, max_lon = new.longitude WHERE id = new.id;
+END;
+"""
+
+COLONNES_LIEU = ('cle_source', 'source', 'nom', 'numero', 'rue', 'code_postal', 'ville', 'ville_cle',
+                 'secteur', 'telephone', 'email', 'website', 'latitude', 'longitude')
+
+
+def _connexion_referentiel(ecriture=False):
+    """Connexion sqlite3 à la base annexe (lecture seule par défaut), None si elle n'a pas encore été importée"""
+    import sqlite3
+
+    chemin = app.config['REFERENTIEL_DB']
+    if ecriture:
+        os.makedirs(os.path.dirname(os.path.abspath(chemin)), exist_ok=True)
+        conn = sqlite3.connect(chemin)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA_REFERENTIEL)
+    elif not os.path.exists(chemin):
+        return None
+    else:
+        conn = sqlite3.connect(f"{Path(chemin).resolve().as_uri()}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _enregistrer_lieux(conn, lieux):
+    """Upsert par lot (clé = identifiant BAN ou objet OSM) ; les triggers tiennent FTS et R*Tree à jour"""
+    requete = (
+        f"INSERT INTO lieux ({', '.join(COLONNES_LIEU)}) VALUES ({', '.join('?' * len(COLONNES_LIEU))}) "
+        f"ON CONFLICT (cle_source) DO UPDATE SET "
+        + ', '.join(f"{colonne} = excluded.{colonne}" for colonne in COLONNES_LIEU[1:])
+    )
+    total = 0
+    lot = []
+    for lieu in lieux:
+        lieu['ville_cle'] = normaliser_requete(lieu.get('ville'))
+        lot.append(tuple(lieu.get(colonne) for colonne in COLONNES_LIEU))
+        if len(lot) >= app.config['REFERENTIEL_LOT_IMPORT']:
+            conn.executemany(requete, lot)
+            total += len(lot)
+            lot = []
+    if lot:
+        conn.executemany(requete, lot)
+        total += len(lot)
+    return total
+
+
+def lire_ban_csv(chemin):
+    """Adresses d'un export BAN (adresses-XX.csv[.gz], séparateur ';')"""
+    import csv
+    import gzip
+
+    ouvrir = gzip.open if chemin.endswith('.gz') else open
+    with ouvrir(chemin, 'rt', encoding='utf-8', newline='') as fichier:
+        for ligne in csv.DictReader(fichier, delimiter=';'):
+            try:
+                latitude, longitude = float(ligne['lat']), float(ligne['lon'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            numero = f"{ligne.get('numero') or ''} {ligne.get('rep') or ''}".strip()
+            rue = (ligne.get('nom_voie') or ligne.get('nom_ld') or '').strip()
+            yield {
+                'cle_source': f"ban:{ligne['id']}",
+                'source': 'ban',
+                'nom': f"{numero} {rue}".strip() or ligne.get('nom_commune', ''),
+                'numero': numero,
+                'rue': rue,
+                'code_postal': ligne.get('code_postal', ''),
+                'ville': ligne.get('nom_commune', ''),
+                'latitude': latitude,
+                'longitude': longitude
+            }
+
+
+def _lieu_osm(type_osm, identifiant, tags, latitude, longitude):
+    """Lieu de prospection à partir des tags OSM, None si l'objet n'est pas un commerce/service nommé"""
+    nom = tags.get('name') or tags.get('brand')
+    secteur = next((tags[cle] for cle in CLES_SECTEUR_OSM if tags.get(cle)), None)
+    if not nom or not secteur or latitude is None or longitude is None:
+        return None
+    return {
+        'cle_source': f"osm:{type_osm}/{identifiant}",
+        'source': 'osm',
+        'nom': nom,
+        'numero': tags.get('addr:housenumber', ''),
+        'rue': tags.get('addr:street', ''),
+        'code_postal': tags.get('addr:postcode', ''),
+        'ville': tags.get('addr:city', ''),
+        'secteur': secteur,
+        'telephone': tags.get('phone') or tags.get('contact:phone', ''),
+        'email': tags.get('email') or tags.get('contact:email', ''),
+        'website': tags.get('website') or tags.get('contact:website', ''),
+        'latitude': float(latitude),
+        'longitude': float(longitude)
+    }
+
+
+def lire_osm_json(chemin):
+    """Lieux d'un export Overpass (out center) ou d'un GeoJSON de points"""
+    with open(chemin, encoding='utf-8') as fichier:
+        donnees = json.load(fichier)
+
+    for element in donnees.get('elements', []):
+        centre = element.get('center', element)
+        lieu = _lieu_osm(element.get('type'), element.get('id'), element.get('tags', {}),
+                         centre.get('lat'), centre.get('lon'))
+        if lieu:
+            yield lieu
+
+    for feature in donnees.get('features', []):
+        geometrie = feature.get('geometry') or {}
+        if geometrie.get('type') != 'Point':
+            continue
+        proprietes = feature.get('properties', {})
+        tags = proprietes.get('tags', proprietes)
+        type_osm, _, identifiant = str(feature.get('id') or proprietes.get('@id', '')).partition('/')
+        longitude, latitude = geometrie['coordinates'][:2]
+        lieu = _lieu_osm(type_osm or 'feature', identifiant or type_osm, tags, latitude, longitude)
+        if lieu:
+            yield lieu
+
+
+def lire_osm_pbf(chemin):
+    """Lieux d'un extrait .osm.pbf (nécessite le module optionnel osmium)"""
+    try:
+        import osmium
+    except ImportError:
+        raise RuntimeError("Module osmium non installé (pip install osmium) : exporter l'extrait en JSON Overpass")
+
+    lieux = []
+
+    class Collecteur(osmium.SimpleHandler):
+        def node(self, n):
+            if n.location.valid():
+                lieu = _lieu_osm('node', n.id, dict(n.tags), n.location.lat, n.location.lon)
+                if lieu:
+                    lieux.append(lieu)
+
+        def way(self, w):
+            points = [(nd.lat, nd.lon) for nd in w.nodes if nd.location.valid()]
+            if points:
+                lieu = _lieu_osm('way', w.id, dict(w.tags),
+                                 sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points))
+                if lieu:
+                    lieux.append(lieu)
+
+    Collecteur().apply_file(chemin, locations=True)
+    return lieux
+
+
+def importer_referentiel(chemin):
+    """Importe un fichier BAN (.csv/.csv.gz) ou OSM (.json/.geojson/.pbf) dans la base annexe. Retourne le nombre de lieux"""
+    nom = chemin.lower()
+    if nom.endswith(('.csv', '.csv.gz')):
+        lieux = lire_ban_csv(chemin)
+    elif nom.endswith(('.json', '.geojson')):
+        lieux = lire_osm_json(chemin)
+    elif nom.endswith('.pbf'):
+        lieux = lire_osm_pbf(chemin)
+    else:
+        raise ValueError(f"Format non reconnu : {chemin} (attendu .csv, .csv.gz, .json, .geojson ou .pbf)")
+
+    conn = _connexion_referentiel(ecriture=True)
+    try:
+        with conn:
+            nb = _enregistrer_lieux(conn, lieux)
+        conn.execute("INSERT INTO lieux_fts (lieux_fts) VALUES ('optimize')")
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+    return nb
+
+
+@app.cli.command('importer-referentiel')
+@click.argument('fichiers', nargs=-1, required=True)
+def importer_referentiel_commande(fichiers):
+    """Charge des extraits BAN / OSM dans la base de recherche hors ligne"""
+    for chemin in fichiers:
+        try:
+            nb = importer_referentiel(chemin)
+            print(f"✅ {chemin} : {nb} lieu(x) importé(s)")
+        except Exception as e:
+            print(f"⚠️ {chemin} : {e}")
+    print(f"   Base : {app.config['REFERENTIEL_DB']}")
+
+
+def _lieu_en_resultat(ligne, point=None):
+    """Ligne de la base annexe au format des résultats Nominatim/Overpass"""
+    adresse = f"{ligne['numero'] or ''} {ligne['rue'] or ''}".strip() if ligne['rue'] else ''
+    resultat = {
+        'osm_id': ligne['cle_source'][4:] if ligne['cle_source'].startswith('osm:') else None,
+        'nom': ligne['nom'],
+        'adresse': adresse,
+        'adresse_complete': adresse,
+        'numero': ligne['numero'] or '',
+        'code_postal': ligne['code_postal'] or '',
+        'ville': ligne['ville'] or '',
+        'telephone': ligne['telephone'] or '',
+        'email': ligne['email'] or '',
+        'website': ligne['website'] or '',
+        'secteur': ligne['secteur'] or 'Autre',
+        'latitude': ligne['latitude'],
+        'longitude': ligne['longitude'],
+        'source': 'local'
+    }
+    if point:
+        resultat['distance_km'] = _estimer_trajet(point, (ligne['latitude'], ligne['longitude']))[0]
+    return resultat
+
+
+def rechercher_referentiel(texte=None, point=None, rayon_km=None, source=None, secteur=None, limite=20):
+    """
+    Recherche dans la base annexe : plein texte (FTS5, préfixes, sans accents) et/ou rayon autour d'un point (R*Tree)
+    Retourne une liste vide si la base est absente ou ne contient rien : l'appelant passe alors aux API en ligne
+    """
+    from math import cos, radians
+
+    mots = re.findall(r'\w+', normaliser_requete(texte)) if texte else []
+    if texte and not mots:
+        return []
+
+    conn = _connexion_referentiel()
+    if conn is None:
+        return []
+
+    jointures = ['lieux l']
+    conditions = []
+    parametres = []
+    if mots:
+        jointures.append('JOIN lieux_fts ON lieux_fts.rowid = l.id')
+        conditions.append('lieux_fts MATCH ?')
+        parametres.append(' '.join(f'"{mot}"*' for mot in mots))
+    if point and rayon_km:
+        ecart_lat = rayon_km / 111.32
+        ecart_lon = rayon_km / (111.32 * max(cos(radians(point[0])), 0.01))
+        jointures.append('JOIN lieux_geo g ON g.id = l.id')
+        conditions.append('g.min_lat >= ? AND g.max_lat <= ? AND g.min_lon >= ? AND g.max_lon <= ?')
+        parametres += [point[0] - ecart_lat, point[0] + ecart_lat, point[1] - ecart_lon, point[1] + ecart_lon]
+    if source:
+        conditions.append('l.source = ?')
+        parametres.append(source)
+    if secteur:
+        conditions.append('l.secteur = ?')
+        parametres.append(secteur)
+
+    # Avec un point, le tri par distance se fait après coup : on lit plus de candidats que la limite
+    requete = f"SELECT l.* FROM {' '.join(jointures)}"
+    if conditions:
+        requete += f" WHERE {' AND '.join(conditions)}"
+    if mots:
+        requete += ' ORDER BY lieux_fts.rank'
+    requete += ' LIMIT ?'
+    parametres.append(limite * 20 if point else limite)
+
+    try:
+        lignes = conn.execute(requete, parametres).fetchall()
+    except Exception as e:
+        print(f"⚠️ Référentiel hors ligne : {e}")
+        lignes = []
+    finally:
+        conn.close()
+
+    resultats = [_lieu_en_resultat(ligne, point) for ligne in lignes]
+    if point:
+        if rayon_km:
+            resultats = [r for r in resultats if r['distance_km'] <= rayon_km]
+        resultats = sorted(resultats, key=lambda r: r['distance_km'])[:limite]
+
+    with _referentiel_lock:
+        referentiel_compteurs['trouve' if resultats else 'absent'] += 1
+    return resultats
+
+
+def stats_referentiel():
+    """Compteurs depuis le démarrage du processus + nombre de lieux importés par source"""
+    with _referentiel_lock:
+        stats = dict(referentiel_compteurs, chemin=app.config['REFERENTIEL_DB'], sources={})
+    conn = _connexion_referentiel()
+    if conn is not None:
+        try:
+            stats['sources'] = dict(conn.execute('SELECT source, count(*) FROM lieux GROUP BY source').fetchall())
+        except Exception as e:
+            print(f"⚠️ Référentiel hors ligne : {e}")
+        finally:
+            conn.close()
+    return stats
+
+
+def point_referentiel(ville):
+    """Centre d'une commune d'après les adresses BAN importées : (lat, lon) ou None"""
+    cle = normaliser_requete(re.sub(r',?\s*france\s*$', '', ville or '', flags=re.IGNORECASE))
+    conn = _connexion_referentiel() if cle else None
+    if conn is None:
+        return None
+    try:
+        ligne = conn.execute(
+            "SELECT avg(latitude), avg(longitude) FROM lieux WHERE source = 'ban' AND ville_cle = ?", (cle,)
+        ).fetchone()
+    except Exception as e:
+        print(f"⚠️ Référentiel hors ligne : {e}")
+        return None
+    finally:
+        conn.close()
+    return (ligne[0], ligne[1]) if ligne and ligne[0] is not None else None
+
+
+# ============================================================================
+# CACHE OVERPASS PAR TUILES GEOHASH (prospection par zone)
+# ============================================================================
+
+app.config.setdefault('OVERPASS_URL', 'https://overpass-api.de/api/interpreter')
+app.config.setdefault('OVERPASS_TIMEOUT', 25)  # Secondes côté serveur Overpass (+5 s côté client)
+app.config.setdefault('OVERPASS_CACHE_JOURS', 7)  # Validité d'une tuile
+app.config.setdefault('OVERPASS_CACHE_MAX_OCTETS', 50 * 1024 * 1024)  # Au-delà, les tuiles les plus anciennes sont évincées
+app.config.setdefault('OVERPASS_TUILES_MAX', 160)  # Nombre max de tuiles par recherche (fixe la précision geohash)
+app.config.setdefault('OVERPASS_PRECISION_MIN', 5)  # Tuiles jamais plus grandes qu'un geohash de 5 caractères (~5 x 5 km)
+app.config.setdefault('OVERPASS_PRECISION_MAX', 8)  # Subdivision des tuiles tronquées jusqu'à 8 caractères (~40 x 20 m)
+app.config.setdefault('OVERPASS_SURFACE_MAX', 3)  # Surface des tuiles / surface du cercle au-delà de laquelle on interroge le cercle directement
+app.config.setdefault('OVERPASS_TUILES_PAR_APPEL', 16)  # Tuiles manquantes demandées par appel Overpass
+app.config.setdefault('OVERPASS_ELEMENTS_MAX', 100)  # Éléments max renvoyés par tuile (au-delà, la tuile est subdivisée)
+
+BASE32_GEOHASH = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+overpass_compteurs = {'tuiles_cache': 0, 'tuiles_reseau': 0, 'tuiles_subdivisees': 0, 'appels': 0, 'erreurs': 0}
+_overpass_lock = threading.Lock()
+
+
+def encoder_geohash(latitude, longitude, precision):
+    """Geohash (base 32) du point, sur `precision` caractères"""
+    intervalles = [[-90.0, 90.0], [-180.0, 180.0]]
+    code = []
+    bits = 0
+    nb_bits = 0
+    longitude_suivante = True
+    while len(code) < precision:
+        intervalle, valeur = (intervalles[1], longitude) if longitude_suivante else (intervalles[0], latitude)
+        milieu = (intervalle[0] + intervalle[1]) / 2
+        bits <<= 1
+        if valeur >= milieu:
+            bits |= 1
+            intervalle[0] = milieu
+        else:
+            intervalle[1] = milieu
+        longitude_suivante = not longitude_suivante
+        nb_bits += 1
+        if nb_bits == 5:
+            code.append(BASE32_GEOHASH[bits])
+            bits = nb_bits = 0
+    return ''.join(code)
+
+
+def bbox_geohash(code):
+    """Emprise (sud, ouest, nord, est) d'une tuile geohash"""
+    intervalles = [[-90.0, 90.0], [-180.0, 180.0]]
+    longitude_suivante = True
+    for caractere in code:
+        valeur = BASE32_GEOHASH.index(caractere)
+        for decalage in range(4, -1, -1):
+            intervalle = intervalles[1] if longitude_suivante else intervalles[0]
+            milieu = (intervalle[0] + intervalle[1]) / 2
+            if valeur >> decalage & 1:
+                intervalle[0] = milieu
+            else:
+                intervalle[1] = milieu
+            longitude_suivante = not longitude_suivante
+    return intervalles[0][0], intervalles[1][0], intervalles[0][1], intervalles[1][1]
+
+
+def _tuile_dans_rayon(code, point, rayon_km):
+    """La tuile intersecte le cercle : son point le plus proche du centre est dans le rayon"""
+    sud, ouest, nord, est = bbox_geohash(code)
+    proche = (min(max(point[0], sud), nord), min(max(point[1], ouest), est))
+    return _estimer_trajet(point, proche)[0] <= rayon_km
+
+
+def tuiles_couvrant(point, rayon_km):
+    """
+    Tuiles geohash qui intersectent le cercle (point, rayon) : la précision la plus grossière (au moins
+    OVERPASS_PRECISION_MIN) dont les tuiles couvrent au plus OVERPASS_SURFACE_MAX fois la surface du cercle,
+    sous OVERPASS_TUILES_MAX tuiles (même rayon = mêmes tuiles, donc mêmes clés de cache)
+    Retourne None si aucune précision ne convient : l'appelant interroge alors le cercle directement
+    """
+    from math import cos, pi, radians
+
+    ecart_lat = rayon_km / 111.32
+    ecart_lon = rayon_km / (111.32 * max(cos(radians(point[0])), 0.01))
+    surface_cercle = pi * ecart_lat * ecart_lon  # En degrés², comme les tuiles
+    for precision in range(app.config['OVERPASS_PRECISION_MIN'], 7):
+        bits = 5 * precision
+        pas_lat = 180.0 / 2 ** (bits // 2)
+        pas_lon = 360.0 / 2 ** (bits - bits // 2)
+        if ((2 * ecart_lat / pas_lat) + 2) * ((2 * ecart_lon / pas_lon) + 2) > 4 * app.config['OVERPASS_TUILES_MAX']:
+            return None  # Trop de tuiles à coup sûr (et plus encore aux précisions suivantes)
+
+        tuiles = []
+        latitude = point[0] - ecart_lat
+        while latitude < point[0] + ecart_lat + pas_lat:
+            longitude = point[1] - ecart_lon
+            while longitude < point[1] + ecart_lon + pas_lon:
+                code = encoder_geohash(min(latitude, point[0] + ecart_lat), min(longitude, point[1] + ecart_lon), precision)
+                if code not in tuiles and _tuile_dans_rayon(code, point, rayon_km):
+                    tuiles.append(code)
+                longitude += pas_lon
+            latitude += pas_lat
+        if len(tuiles) > app.config['OVERPASS_TUILES_MAX']:
+            return None
+        if len(tuiles) * pas_lat * pas_lon <= app.config['OVERPASS_SURFACE_MAX'] * surface_cercle:
+            return tuiles
+        # Tuiles trop grandes pour ce cercle : précision suivante
+    return None
+
+
+def _compter_overpass(compteur, nb=1):
+    with _overpass_lock:
+        overpass_compteurs[compteur] += nb
+
+
+def _centre_element(element):
+    """Coordonnées d'un élément Overpass (nœud, ou centre d'un way/relation demandé avec 'out center')"""
+    if element.get('type') == 'node':
+        return element.get('lat'), element.get('lon')
+    centre = element.get('center') or {}
+    return centre.get('lat'), centre.get('lon')
+
+
+def _appeler_overpass(corps):
+    """Un appel Overpass (corps = instructions après l'en-tête). Retourne les éléments, lève une exception en cas d'échec"""
+    requete = f"[out:json][timeout:{app.config['OVERPASS_TIMEOUT']}];{corps}"
+    _compter_overpass('appels')
+    try:
+        reponse = requete_http('POST', app.config['OVERPASS_URL'], data={'data': requete},
+                               timeout=app.config['OVERPASS_TIMEOUT'] + 5)
+        if reponse.status_code != 200:
+            raise RuntimeError(f"Overpass HTTP {reponse.status_code}: {reponse.text[:200]}")
+        return reponse.json().get('elements', [])
+    except Exception:
+        _compter_overpass('erreurs')
+        raise
+
+
+def _repartir_tuiles_overpass(lot, recus):
+    """
+    Répartit la réponse d'un appel sur les tuiles du lot. Chaque tuile a produit un élément "count"
+    (total réel) suivi de ses éléments plafonnés : les blocs sont lus dans l'ordre des tuiles.
+    Retourne ({tuile: éléments dont le centre est dans la tuile}, [tuiles tronquées])
+    """
+    blocs = []
+    for element in recus:
+        if element.get('type') == 'count':
+            blocs.append((int((element.get('tags') or {}).get('total', 0)), []))
+        elif blocs:
+            blocs[-1][1].append(element)
+    if len(blocs) != len(lot):
+        raise RuntimeError(f"Réponse Overpass inattendue : {len(blocs)} bloc(s) pour {len(lot)} tuile(s)")
+
+    nouvelles = {}
+    tronquees = []
+    for tuile, (total, elements) in zip(lot, blocs):
+        if total > app.config['OVERPASS_ELEMENTS_MAX']:
+            tronquees.append(tuile)
+        # Chaque élément est rangé dans la tuile de son centre (les tuiles vides sont gardées aussi)
+        nouvelles[tuile] = []
+        for element in elements:
+            latitude, longitude = _centre_element(element)
+            if latitude is not None and longitude is not None and encoder_geohash(latitude, longitude, len(tuile)) == tuile:
+                nouvelles[tuile].append(element)
+    return nouvelles, tronquees
+
+
+def elements_overpass(filtre, selecteurs, point, rayon_km, rafraichir=False):
+    """
+    Éléments Overpass autour d'un point, assemblés à partir des tuiles geohash en cache (table overpass_tuiles)
+    - filtre : clé de cache des tags demandés (ex: 'zone:bakery', 'nom:leclerc')
+    - selecteurs : fragments Overpass sans emprise (ex: 'node["shop"]'), répétés pour chaque tuile manquante
+    Seules les tuiles absentes ou expirées (toutes si rafraichir) sont demandées, par appels de
+    OVERPASS_TUILES_PAR_APPEL tuiles et au plus OVERPASS_ELEMENTS_MAX éléments par tuile.
+    Une tuile qui dépasse ce plafond n'est jamais mise en cache tronquée : elle est enregistrée comme
+    subdivisée et ses tuiles filles (précision suivante, jusqu'à OVERPASS_PRECISION_MAX) sont demandées à leur tour.
+    Sans découpage en tuiles possible (rayon trop grand), le cercle est interrogé directement, sans cache.
+    Le filtrage par distance est laissé à l'appelant. Lève une exception si Overpass échoue
+    ou si l'échéance du thread (executer_strategies) est atteinte entre deux appels.
+    """
+    tuiles = tuiles_couvrant(point, rayon_km)
+    if tuiles is None:
+        corps = ''.join(f"{selecteur}(around:{rayon_km * 1000:.0f},{point[0]:.6f},{point[1]:.6f});" for selecteur in selecteurs)
+        return _appeler_overpass(f"({corps});out body center {app.config['OVERPASS_ELEMENTS_MAX']};")
+
+    table = OverpassTuile.__table__
+    elements_par_tuile = {}
+    taille_lot = app.config['OVERPASS_TUILES_PAR_APPEL']
+
+    # Une précision par tour : tuiles de la recherche, puis filles des tuiles subdivisées
+    while tuiles:
+        subdivisees = []
+        if not rafraichir:
+            limite = datetime.utcnow() - timedelta(days=app.config['OVERPASS_CACHE_JOURS'])
+            nb_cache = 0
+            with db.engine.connect() as conn:
+                for ligne in conn.execute(db.select(table.c.geohash, table.c.elements, table.c.subdivisee).where(
+                    table.c.filtre == filtre, table.c.geohash.in_(tuiles), table.c.date_maj >= limite
+                )):
+                    if ligne.subdivisee:
+                        subdivisees.append(ligne.geohash)
+                    else:
+                        elements_par_tuile[ligne.geohash] = json.loads(ligne.elements)
+                    nb_cache += 1
+            _compter_overpass('tuiles_cache', nb_cache)
+
+        manquantes = [tuile for tuile in tuiles if tuile not in elements_par_tuile and tuile not in subdivisees]
+        for i in range(0, len(manquantes), taille_lot):
+            if echeance_http_depassee():
+                # Recherche bornée (executer_strategies) déjà en retard : les tuiles reçues restent en cache
+                raise requests.Timeout("Échéance atteinte : tuiles Overpass restantes non demandées")
+            lot = manquantes[i:i + taille_lot]
+            # Par tuile : "out count" (total réel, délimite la tuile dans la réponse) puis les éléments plafonnés
+            corps = ''.join(
+                '(' + ''.join(f"{selecteur}({sud:.6f},{ouest:.6f},{nord:.6f},{est:.6f});" for selecteur in selecteurs)
+                + f")->.t;.t out count;.t out body center {app.config['OVERPASS_ELEMENTS_MAX']};"
+                for sud, ouest, nord, est in map(bbox_geohash, lot)
+            )
+            nouvelles, tronquees = _repartir_tuiles_overpass(lot, _appeler_overpass(corps))
+            _compter_overpass('tuiles_reseau', len(lot))
+
+            a_subdiviser = [tuile for tuile in tronquees if len(tuile) < app.config['OVERPASS_PRECISION_MAX']]
+            if len(a_subdiviser) < len(tronquees):
+                print(f"⚠️ Overpass : {len(tronquees) - len(a_subdiviser)} tuile(s) encore tronquée(s) "
+                      f"à la précision maximale, non mises en cache")
+            _compter_overpass('tuiles_subdivisees', len(a_subdiviser))
+            enregistrer_tuiles_overpass(
+                filtre, {tuile: elements for tuile, elements in nouvelles.items() if tuile not in tronquees}, a_subdiviser
+            )
+            subdivisees.extend(a_subdiviser)
+            # Précision maximale atteinte : éléments tronqués rendus tels quels, sans cache
+            elements_par_tuile.update((tuile, elements) for tuile, elements in nouvelles.items() if tuile not in a_subdiviser)
+
+        tuiles = [parent + caractere for parent in subdivisees for caractere in BASE32_GEOHASH
+                  if _tuile_dans_rayon(parent + caractere, point, rayon_km)]
+
+    elements = {}
+    for element_tuile in elements_par_tuile.values():
+        for element in element_tuile:
+            elements[(element.get('type'), element.get('id'))] = element
+    return list(elements.values())
+
+
+def enregistrer_tuiles_overpass(filtre, tuiles, subdivisees=()):
+    """
+    Upsert des tuiles complètes ({geohash: éléments}) et des tuiles subdivisées (sans éléments) sur une
+    connexion dédiée, puis éviction des plus anciennes au-delà de OVERPASS_CACHE_MAX_OCTETS
+    """
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+    table = OverpassTuile.__table__
+    maintenant = datetime.utcnow()
+    valeurs = []
+    for geohash, elements in tuiles.items():
+        contenu = json.dumps(elements, separators=(',', ':'))
+        valeurs.append({'filtre': filtre, 'geohash': geohash, 'elements': contenu,
+                        'taille': len(contenu), 'subdivisee': False, 'date_maj': maintenant})
+    valeurs.extend({'filtre': filtre, 'geohash': geohash, 'elements': '[]', 'taille': 2,
+                    'subdivisee': True, 'date_maj': maintenant} for geohash in subdivisees)
+    if not valeurs:
+        return
+    requete = sqlite_insert(table)
+    requete = requete.on_conflict_do_update(
+        index_elements=['filtre', 'geohash'],
+        set_={'elements': requete.excluded.elements, 'taille': requete.excluded.taille,
+              'subdivisee': requete.excluded.subdivisee, 'date_maj': requete.excluded.date_maj}
+    )
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(requete, valeurs)
+            conn.execute(db.text("""
+                DELETE FROM overpass_tuiles WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, SUM(taille) OVER (ORDER BY date_maj DESC, rowid DESC) AS cumul FROM overpass_tuiles
+                    ) WHERE cumul > :max_octets
+                )
+            """), {'max_octets': app.config['OVERPASS_CACHE_MAX_OCTETS']})
+    except OperationalError as e:
+        print(f"⚠️ Cache Overpass non enregistré : {e}")
+
+
+def stats_overpass():
+    """Compteurs depuis le démarrage du processus + occupation du cache"""
+    with _overpass_lock:
+        stats = dict(overpass_compteurs)
+    nb, octets = db.session.query(func.count(OverpassTuile.geohash), func.sum(OverpassTuile.taille)).one()
+    stats['taille_base'] = nb
+    stats['octets'] = octets or 0
+    return stats
+
+
+def purger_cache_overpass(tout=False):
+    """Supprime les tuiles expirées (ou toutes). Retourne le nombre de tuiles supprimées"""
+    table = OverpassTuile.__table__
+    requete = table.delete()
+    if not tout:
+        requete = requete.where(table.c.date_maj < datetime.utcnow() - timedelta(days=app.config['OVERPASS_CACHE_JOURS']))
+    with db.engine.begin() as conn:
+        return conn.execute(requete).rowcount
+
+
+@app.cli.command('purger-overpass')
+@click.option('--tout', is_flag=True, help='Vider tout le cache (rafraîchissement complet)')
+def purger_overpass_commande(tout):
+    """Supprime les tuiles Overpass expirées (ou toutes avec --tout)"""
+    nb = purger_cache_overpass(tout)
+    print(f"✅ {nb} tuile(s) supprimée(s) du cache Overpass")
+
+
+# ============================================================================
+# FONCTIONS RECHERCHE ENTREPRISES (OpenStreetMap)
+# ============================================================================
+
+def rechercher_entreprises_nominatim_direct(query):
+    """
+    Recherche directe avec Nominatim (sans séparation nom/ville)
+    Ex: "leclerc carcassonne" cherché tel quel
+    Le référentiel hors ligne est consulté d'abord, Nominatim seulement s'il ne trouve rien
+    """
+    locaux = rechercher_referentiel(query, source='osm')
+    if locaux:
+        return locaux
+
+    try:
+        data = geocoder(f"{query}, France", limite=20, details=True)
+        entreprises = []
+
+        for result in data:
+            # Vérifier que c'est bien un commerce/POI et pas juste une ville
+            osm_type = result.get('type', '')
+            if osm_type in ['city', 'town', 'village', 'municipality']:
+                continue  # Ignorer les résultats qui sont juste des villes
+
+            address = result.get('address', {})
+
+            # Construire l'adresse
+            rue = address.get('road', '')
+            numero = address.get('house_number', '')
+            if numero and rue:
+                adresse_complete = f"{numero} {rue}"
+            elif rue:
+                adresse_complete = rue
+            else:
+                adresse_complete = ''
+
+            # Extraire le nom (premier élément avant la virgule)
+            nom_complet = result.get('display_name', '')
+            nom = nom_complet.split(',')[0].strip()
+
+            entreprise = {
+                'osm_id': f"{result['osm_type']}/{result['osm_id']}" if result.get('osm_id') else None,
+                'nom': nom,
+                'adresse': adresse_complete,
+                'code_postal': address.get('postcode', ''),
+                'ville': address.get('city') or address.get('town') or address.get('village', ''),
+                'latitude': float(result.get('lat', 0)),
+                'longitude': float(result.get('lon', 0))
+            }
+
+            entreprises.append(entreprise)
 
         return entreprises
 
@@ -3779,26 +6050,14 @@ def rechercher_entreprises_nominatim(query, ville):
     Returns:
         Liste de dictionnaires avec les informations des entreprises
     """
-    import requests
+    locaux = rechercher_referentiel(f"{query} {ville}", source='osm')
+    if locaux:
+        return locaux
 
     try:
         # Rechercher avec Nominatim
         search_query = f"{query}, {ville}, France"
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {
-            'q': search_query,
-            'format': 'json',
-            'limit': 20,
-            'addressdetails': 1
-        }
-        headers = {'User-Agent': 'GestionEntreprise/1.0'}
-
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-
-        if response.status_code != 200:
-            return []
-
-        data = response.json()
+        data = geocoder(search_query, limite=20, details=True)
         entreprises = []
 
         for result in data:
@@ -3815,6 +6074,7 @@ def rechercher_entreprises_nominatim(query, ville):
                 adresse_complete = ''
 
             entreprise = {
+                'osm_id': f"{result['osm_type']}/{result['osm_id']}" if result.get('osm_id') else None,
                 'nom': result.get('display_name', '').split(',')[0],  # Premier élément = nom
                 'adresse': adresse_complete,
                 'code_postal': address.get('postcode', ''),
@@ -3831,47 +6091,41 @@ def rechercher_entreprises_nominatim(query, ville):
         print("Erreur Nominatim: {e}")
         return []
 
-def rechercher_entreprises_overpass(query, latitude=None, longitude=None, rayon_km=10):
+def rechercher_entreprises_overpass(query, latitude=None, longitude=None, rayon_km=10, rafraichir=False):
     """
     Rechercher des entreprises via Overpass API (OpenStreetMap)
+    Autour d'un point, les réponses sont gardées par tuile geohash : seules les tuiles manquantes sont demandées
 
     Args:
         query: Nom de l'entreprise ou secteur d'activité
         latitude: Latitude du centre de recherche (optionnel)
         longitude: Longitude du centre de recherche (optionnel)
         rayon_km: Rayon de recherche en km (défaut: 10km)
+        rafraichir: Redemander les tuiles à Overpass même si elles sont en cache
 
     Returns:
         Liste de dictionnaires avec les informations des entreprises
     """
-    import requests
+    point = (latitude, longitude) if latitude and longitude else None
+    locaux = rechercher_referentiel(query, point, rayon_km if point else None, source='osm', limite=100)
+    if locaux:
+        return locaux
 
     try:
-        # Construire la requête Overpass
         # Échapper les caractères spéciaux pour la regex
         query_escaped = query.replace('[', '\\[').replace(']', '\\]').replace('(', '\\(').replace(')', '\\)')
 
-        if latitude and longitude:
-            # Recherche dans un rayon autour d'un point
-            rayon_m = rayon_km * 1000
-            # Recherche plus permissive : chercher tous les commerces puis filtrer
-            # Utiliser .*leclerc.* pour matcher "E.Leclerc", "Leclerc", "leclerc drive", etc.
-            overpass_query = f"""
-            [out:json][timeout:25];
-            (
-              node["name"~".*{query_escaped}.*",i](around:{rayon_m},{latitude},{longitude});
-              way["name"~".*{query_escaped}.*",i](around:{rayon_m},{latitude},{longitude});
-              relation["name"~".*{query_escaped}.*",i](around:{rayon_m},{latitude},{longitude});
-              node["brand"~".*{query_escaped}.*",i](around:{rayon_m},{latitude},{longitude});
-              way["brand"~".*{query_escaped}.*",i](around:{rayon_m},{latitude},{longitude});
-              relation["brand"~".*{query_escaped}.*",i](around:{rayon_m},{latitude},{longitude});
-              node["operator"~".*{query_escaped}.*",i](around:{rayon_m},{latitude},{longitude});
-              way["operator"~".*{query_escaped}.*",i](around:{rayon_m},{latitude},{longitude});
-            );
-            out body center 100;
-            """
+        if point:
+            # Recherche permissive : .*leclerc.* matche "E.Leclerc", "Leclerc", "leclerc drive", etc.
+            motif = f'".*{query_escaped}.*",i'
+            selecteurs = [f'{type_osm}["{cle}"~{motif}]' for cle, types_osm in (
+                ('name', ('node', 'way', 'relation')),
+                ('brand', ('node', 'way', 'relation')),
+                ('operator', ('node', 'way'))
+            ) for type_osm in types_osm]
+            elements = elements_overpass(f"nom:{query.strip().lower()}", selecteurs, point, rayon_km, rafraichir)
         else:
-            # Recherche globale (limité à 100 résultats)
+            # Recherche globale (limité à 100 résultats, pas de tuile donc pas de cache)
             overpass_query = f"""
             [out:json][timeout:25];
             (
@@ -3882,25 +6136,16 @@ def rechercher_entreprises_overpass(query, latitude=None, longitude=None, rayon_
             );
             out body center 100;
             """
+            response = requete_http('POST', app.config['OVERPASS_URL'], data={'data': overpass_query}, timeout=30)
+            if response.status_code != 200:
+                print(f"[OVERPASS] Erreur HTTP: {response.text[:200]}")
+                return []
+            elements = response.json().get('elements', [])
 
-        print("[OVERPASS] Requête Overpass:\n{overpass_query}")
-
-        # Appeler l'API Overpass
-        url = "https://overpass-api.de/api/interpreter"
-        response = requests.post(url, data={'data': overpass_query}, timeout=30)
-
-        print("[OVERPASS] Statut réponse: {response.status_code}")
-
-        if response.status_code != 200:
-            print("[OVERPASS] Erreur HTTP: {response.text[:200]}")
-            return []
-
-        data = response.json()
-        print("[OVERPASS] Éléments trouvés: {len(data.get('elements', []))}")
         entreprises = []
 
         # Extraire les informations
-        for element in data.get('elements', []):
+        for element in elements:
             tags = element.get('tags', {})
             # Essayer 'name' puis 'brand' si name n'existe pas
             nom = tags.get('name') or tags.get('brand')
@@ -3908,16 +6153,7 @@ def rechercher_entreprises_overpass(query, latitude=None, longitude=None, rayon_
             if not nom:
                 continue
 
-            # Récupérer les coordonnées
-            if element.get('type') == 'node':
-                lat = element.get('lat')
-                lon = element.get('lon')
-            elif 'center' in element:
-                lat = element['center'].get('lat')
-                lon = element['center'].get('lon')
-            else:
-                lat = None
-                lon = None
+            lat, lon = _centre_element(element)
 
             # Construire l'adresse complète
             numero = tags.get('addr:housenumber', '')
@@ -3930,6 +6166,7 @@ def rechercher_entreprises_overpass(query, latitude=None, longitude=None, rayon_
                 adresse_complete = ''
 
             entreprise = {
+                'osm_id': f"{element.get('type')}/{element.get('id')}",
                 'nom': nom,
                 'adresse': adresse_complete,
                 'code_postal': tags.get('addr:postcode', ''),
@@ -3942,181 +6179,474 @@ def rechercher_entreprises_overpass(query, latitude=None, longitude=None, rayon_
                 'longitude': lon
             }
 
-            # Calculer la distance depuis l'adresse de l'entreprise si possible
-            if lat and lon and latitude and longitude:
-                # Formule de Haversine pour calculer la distance
-                from math import radians, sin, cos, sqrt, atan2
-                R = 6371  # Rayon de la Terre en km
-
-                lat1, lon1 = radians(latitude), radians(longitude)
-                lat2, lon2 = radians(lat), radians(lon)
-
-                dlat = lat2 - lat1
-                dlon = lon2 - lon1
-
-                a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-                c = 2 * atan2(sqrt(a), sqrt(1-a))
-                distance = R * c
-
-                entreprise['distance_km'] = round(distance, 1)
+            # Distance depuis le centre de recherche : les tuiles débordent du cercle, on filtre ici
+            if point:
+                if lat is None or lon is None:
+                    continue
+                entreprise['distance_km'] = _estimer_trajet(point, (lat, lon))[0]
+                if entreprise['distance_km'] > rayon_km:
+                    continue
 
             entreprises.append(entreprise)
 
         # Trier par distance si disponible
-        if latitude and longitude:
-            entreprises.sort(key=lambda x: x.get('distance_km', 999999))
+        if point:
+            entreprises.sort(key=lambda x: x['distance_km'])
 
-        return entreprises
+        return entreprises[:100]
 
     except Exception as e:
-        print("Erreur Overpass API: {e}")
+        print(f"Erreur Overpass API: {e}")
         return []
 
-def rechercher_par_zone(ville, secteur=None, rayon_km=20):
+def rechercher_par_zone(ville, secteur=None, rayon_km=20, rafraichir=False):
     """
     Rechercher des entreprises dans une zone géographique
+    Les réponses Overpass sont gardées par tuile geohash et par secteur : seules les tuiles manquantes sont demandées
 
     Args:
         ville: Nom de la ville
         secteur: Secteur d'activité (optionnel)
         rayon_km: Rayon de recherche
+        rafraichir: Redemander les tuiles à Overpass même si elles sont en cache
 
     Returns:
-        Liste des entreprises trouvées
+        Liste des entreprises trouvées (les 100 plus proches)
     """
-    import requests
+    try:
+        # D'abord géocoder la ville pour obtenir lat/lon (adresses BAN importées, sinon Nominatim)
+        point = point_referentiel(ville) or geocoder_point(ville)
+        if not point:
+            return []
+
+        locaux = rechercher_referentiel(None, point, rayon_km, source='osm', secteur=secteur, limite=100)
+        if locaux:
+            return locaux
+
+        # Sélecteurs selon le secteur
+        if secteur:
+            # Recherche par secteur spécifique
+            selecteurs = [f'node["shop"="{secteur}"]', f'way["shop"="{secteur}"]']
+        else:
+            # Recherche toutes les entreprises (shop, office, amenity)
+            selecteurs = ['node["shop"]', 'node["office"]', 'node["amenity"="restaurant"]',
+                          'node["amenity"="cafe"]', 'way["shop"]', 'way["office"]']
+
+        elements = elements_overpass(f"zone:{secteur or '*'}", selecteurs, point, rayon_km, rafraichir)
+        entreprises = []
+
+        for element in elements:
+            tags = element.get('tags', {})
+            nom = tags.get('name')
+
+            if not nom:
+                continue
+
+            # Récupérer les coordonnées (les tuiles débordent du cercle : filtre par distance)
+            elem_lat, elem_lon = _centre_element(element)
+            if elem_lat is None or elem_lon is None:
+                continue
+            distance_km = _estimer_trajet(point, (elem_lat, elem_lon))[0]
+            if distance_km > rayon_km:
+                continue
+
+            entreprise = {
+                'osm_id': f"{element.get('type')}/{element.get('id')}",
+                'nom': nom,
+                'adresse': tags.get('addr:street', ''),
+                'numero': tags.get('addr:housenumber', ''),
+                'code_postal': tags.get('addr:postcode', ''),
+                'ville': tags.get('addr:city', ville),
+                'telephone': tags.get('phone', ''),
+                'email': tags.get('email', ''),
+                'website': tags.get('website', ''),
+                'secteur': tags.get('shop') or tags.get('office') or tags.get('amenity', 'Autre'),
+                'latitude': elem_lat,
+                'longitude': elem_lon,
+                'distance_km': distance_km
+            }
+
+            if entreprise['numero'] and entreprise['adresse']:
+                entreprise['adresse_complete'] = f"{entreprise['numero']} {entreprise['adresse']}"
+            elif entreprise['adresse']:
+                entreprise['adresse_complete'] = entreprise['adresse']
+            else:
+                entreprise['adresse_complete'] = ''
+
+            entreprises.append(entreprise)
+
+        entreprises.sort(key=lambda x: x['distance_km'])
+        return entreprises[:100]
+
+    except Exception as e:
+        print("Erreur recherche par zone: {e}")
+        return []
+
+# Recherche d'entreprise multi-stratégies : pool borné partagé par toutes les requêtes du processus
+app.config.setdefault('RECHERCHE_ENTREPRISE_DELAI', 15)  # Secondes, délai global toutes stratégies confondues
+app.config.setdefault('RECHERCHE_ENTREPRISE_THREADS', 4)
 
+_pool_recherche = None
+_pool_recherche_lock = threading.Lock()
+
+
+def _pool_strategies():
+    """Pool de threads créé au premier usage (un par processus gunicorn)"""
+    global _pool_recherche
+    from concurrent.futures import ThreadPoolExecutor
+
+    with _pool_recherche_lock:
+        if _pool_recherche is None:
+            _pool_recherche = ThreadPoolExecutor(max_workers=app.config['RECHERCHE_ENTREPRISE_THREADS'],
+                                                 thread_name_prefix='recherche-entreprise')
+        return _pool_recherche
+
+
+def _strategie_nom_ville(nom, ville):
+    """Géocode la partie ville puis cherche le nom dans cette ville : (entreprises, séparation retenue ou None)"""
+    point = point_referentiel(ville) or geocoder_point(f"{ville}, France")
+    if not point:
+        return [], None
+    return rechercher_entreprises_nominatim(nom, ville), {'nom': nom, 'ville': ville, 'point': point}
+
+
+def _executer_strategie(nom, fonction, arguments, echeance):
+    """
+    Exécute une stratégie dans un thread du pool et mesure sa durée
+    Ses appels HTTP sont bornés par l'échéance : le thread est rendu au pool peu après, même si la stratégie est en retard
+    """
+    debut = time.perf_counter()
+    resultat = {'nom': nom, 'entreprises': [], 'separation': None, 'statut': 'ok'}
+    _echeance_http.valeur = echeance
     try:
-        # D'abord géocoder la ville pour obtenir lat/lon
-        geocode_url = f"https://nominatim.openstreetmap.org/search?q={ville}&format=json&limit=1"
-        response = requests.get(geocode_url, headers={'User-Agent': 'GestionEntreprise/1.0'}, timeout=10)
+        with app.app_context():
+            valeur = fonction(*arguments)
+        if isinstance(valeur, tuple):
+            valeur, resultat['separation'] = valeur
+        resultat['entreprises'] = valeur or []
+    except Exception as e:
+        resultat['statut'] = f"erreur: {e}"
+    finally:
+        _echeance_http.valeur = None
+    resultat['duree_ms'] = round((time.perf_counter() - debut) * 1000)
+    return resultat
 
-        if response.status_code != 200:
-            return []
 
-        data = response.json()
-        if not data:
-            return []
+def executer_strategies(strategies, echeance):
+    """
+    Lance les stratégies (nom, fonction, arguments) en parallèle et attend au plus jusqu'à l'échéance (time.monotonic)
+    Une stratégie en retard est marquée 'délai dépassé' : son résultat, s'il arrive, est ignoré, et ses appels
+    HTTP restants échouent aussitôt (requete_http ne dépasse pas l'échéance)
+    """
+    from concurrent.futures import wait
+
+    debut = time.perf_counter()
+    pool = _pool_strategies()
+    taches = [(nom, pool.submit(_executer_strategie, nom, fonction, arguments, echeance)) for nom, fonction, arguments in strategies]
+    wait([tache for _, tache in taches], timeout=max(0, echeance - time.monotonic()))
+
+    resultats = []
+    for nom, tache in taches:
+        if tache.done():
+            resultats.append(tache.result())
+        else:
+            tache.cancel()  # Libère la place si elle n'a pas encore démarré
+            resultats.append({'nom': nom, 'entreprises': [], 'separation': None, 'statut': 'délai dépassé',
+                              'duree_ms': round((time.perf_counter() - debut) * 1000)})
+    return resultats
+
+
+def fusionner_entreprises(listes):
+    """
+    Concatène les listes dans leur ordre de priorité avec un seul exemplaire par objet OSM
+    (à défaut d'identifiant : même nom au même endroit) ; les champs vides sont complétés par les doublons
+    """
+    fusion = OrderedDict()
+    for entreprises in listes:
+        for entreprise in entreprises:
+            cle = entreprise.get('osm_id') or (
+                normaliser_requete(entreprise.get('nom')),
+                round(entreprise.get('latitude') or 0, 4),
+                round(entreprise.get('longitude') or 0, 4)
+            )
+            existante = fusion.get(cle)
+            if existante is None:
+                fusion[cle] = dict(entreprise)
+                continue
+            for champ, valeur in entreprise.items():
+                if valeur and not existante.get(champ):
+                    existante[champ] = valeur
+    return list(fusion.values())
+
+
+# ============================================================================
+# CLIENT GOOGLE CALENDAR - identifiants en mémoire, document de découverte statique
+# ============================================================================
+
+# Rafraîchir le jeton d'accès quand il expire dans moins de N secondes (avant qu'un appel n'échoue)
+app.config.setdefault('GCAL_MARGE_RAFRAICHISSEMENT', 300)
+# Écritures groupées : 50 appels maximum par requête batch (limite Google), nouvel essai des appels en échec temporaire
+app.config.setdefault('GCAL_LOT_MAX', 50)
+app.config.setdefault('GCAL_LOT_REESSAIS', 2)
+app.config.setdefault('GCAL_LOT_REESSAI_DELAI', 1.0)
+# Racine de l'API (ex. http://127.0.0.1:8099/ pour un faux serveur Calendar en test), None = Google
+app.config.setdefault('GCAL_API_URL', os.environ.get('GCAL_API_URL'))
+# Quota Google : après un refus (429, 403 rateLimitExceeded) tous les threads espacent leurs lots,
+# pause doublée à chaque refus, divisée par deux à chaque lot accepté (secondes)
+app.config.setdefault('GCAL_QUOTA_PAUSE_MIN', 0.5)
+app.config.setdefault('GCAL_QUOTA_PAUSE_MAX', 60)
+
+_gcal_lock = threading.Lock()
+_gcal_etat = {'creds': None, 'generation': 0, 'document': None}
+_gcal_local = threading.local()  # Un service par thread : httplib2 n'est pas partageable entre threads
+_gcal_quota = {'pause': 0.0, 'reprise': 0.0, 'refus': 0}  # Pause commune entre deux lots (time.monotonic)
+
+
+def _document_calendrier():
+    """Document de découverte Calendar v3 livré avec googleapiclient, décodé une fois par processus"""
+    if _gcal_etat['document'] is None:
+        from googleapiclient.discovery_cache import get_static_doc
+        document = json.loads(get_static_doc('calendar', 'v3'))
+        if app.config['GCAL_API_URL']:
+            # rootUrl sert aussi à construire l'URL batch : tous les appels partent vers le même serveur
+            document['rootUrl'] = app.config['GCAL_API_URL'].rstrip('/') + '/'
+        _gcal_etat['document'] = document
+    return _gcal_etat['document']
+
+
+def _charger_identifiants():
+    """Lit token.json (priorité aux secrets persistants), None si absent ou illisible"""
+    for path in ['/etc/secrets/token.json', 'token.json', '/tmp/token.json']:
+        if os.path.exists(path):
+            try:
+                creds = Credentials.from_authorized_user_file(path, SCOPES)
+                print(f"✅ Token Google chargé depuis {path}")
+                return creds
+            except Exception as e:
+                print(f"⚠️ Erreur chargement token {path} : {e}")
+    return None
+
+
+def identifiants_calendrier():
+    """
+    Identifiants Google gardés en mémoire : token.json n'est relu que s'ils manquent ou ne sont plus utilisables,
+    le jeton d'accès est rafraîchi avant son expiration. Retourne (creds, génération) ou None si authentification requise
+    """
+    with _gcal_lock:
+        creds = _gcal_etat['creds']
+        if creds is None or (not creds.valid and not creds.refresh_token):
+            creds = _gcal_etat['creds'] = _charger_identifiants()
+            _gcal_etat['generation'] += 1
+        if creds is None:
+            print("⚠️ Authentification requise via /google-auth")
+            return None
+
+        marge = timedelta(seconds=app.config['GCAL_MARGE_RAFRAICHISSEMENT'])
+        expire_bientot = creds.expiry is not None and creds.expiry - datetime.utcnow() < marge
+        if (not creds.valid or expire_bientot) and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+                # Sauvegarder le token rafraîchi dans /tmp (Secret Files est read-only)
+                with open('/tmp/token.json', 'w') as token:
+                    token.write(creds.to_json())
+            except Exception as e:
+                print(f"❌ Erreur refresh token : {e}")
+        if not creds.valid:
+            print("⚠️ Authentification requise via /google-auth")
+            return None
+        return creds, _gcal_etat['generation']
+
+
+def reinitialiser_client_calendrier():
+    """Oublie les identifiants en mémoire (nouveau token.json après /oauth2callback)"""
+    with _gcal_lock:
+        _gcal_etat['creds'] = None
+        _gcal_etat['generation'] += 1
+
+
+def get_calendar_service():
+    """
+    Service Google Calendar (None si modules absents ou authentification requise)
+    Construit une fois par thread à partir du document de découverte statique, reconstruit si les identifiants changent
+    """
+    if not GOOGLE_CALENDAR_AVAILABLE:
+        return None
 
-        lat = float(data[0]['lat'])
-        lon = float(data[0]['lon'])
+    etat = identifiants_calendrier()
+    if etat is None:
+        return None
+    creds, generation = etat
 
-        # Construire la requête selon le secteur
-        rayon_m = rayon_km * 1000
+    if getattr(_gcal_local, 'generation', None) != generation:
+        _gcal_local.service = build_from_document(_document_calendrier(), credentials=creds)
+        _gcal_local.generation = generation
+    return _gcal_local.service
 
-        if secteur:
-            # Recherche par secteur spécifique
-            overpass_query = f"""
-            [out:json][timeout:25];
-            (
-              node["shop"="{secteur}"](around:{rayon_m},{lat},{lon});
-              way["shop"="{secteur}"](around:{rayon_m},{lat},{lon});
-            );
-            out body 100;
-            """
-        else:
-            # Recherche toutes les entreprises (shop, office, amenity)
-            overpass_query = f"""
-            [out:json][timeout:25];
-            (
-              node["shop"](around:{rayon_m},{lat},{lon});
-              node["office"](around:{rayon_m},{lat},{lon});
-              node["amenity"="restaurant"](around:{rayon_m},{lat},{lon});
-              node["amenity"="cafe"](around:{rayon_m},{lat},{lon});
-              way["shop"](around:{rayon_m},{lat},{lon});
-              way["office"](around:{rayon_m},{lat},{lon});
-            );
-            out body 100;
-            """
 
-        url = "https://overpass-api.de/api/interpreter"
-        response = requests.post(url, data={'data': overpass_query}, timeout=30)
+def statut_erreur_gcal(erreur):
+    """Code HTTP d'une erreur Google (HttpError), None pour une erreur réseau"""
+    return getattr(getattr(erreur, 'resp', None), 'status', None)
 
-        if response.status_code != 200:
-            return []
 
-        data = response.json()
-        entreprises = []
+def _erreur_gcal_quota(erreur):
+    """Refus pour quota : 429, ou 403 rateLimitExceeded / userRateLimitExceeded"""
+    statut = statut_erreur_gcal(erreur)
+    if statut == 429:
+        return True
+    contenu = getattr(erreur, 'content', b'') or b''
+    if isinstance(contenu, bytes):
+        contenu = contenu.decode('utf-8', 'replace')
+    return statut == 403 and 'ratelimitexceeded' in contenu.lower()
 
-        for element in data.get('elements', []):
-            tags = element.get('tags', {})
-            nom = tags.get('name')
 
-            if not nom:
-                continue
+def _erreur_gcal_temporaire(erreur):
+    """Quota, erreur serveur ou réseau : l'appel peut être rejoué"""
+    statut = statut_erreur_gcal(erreur)
+    return statut is None or statut >= 500 or _erreur_gcal_quota(erreur)
 
-            # Récupérer les coordonnées
-            if element.get('type') == 'node':
-                elem_lat = element.get('lat')
-                elem_lon = element.get('lon')
-            elif 'center' in element:
-                elem_lat = element['center'].get('lat')
-                elem_lon = element['center'].get('lon')
-            else:
-                elem_lat = None
-                elem_lon = None
 
-            entreprise = {
-                'nom': nom,
-                'adresse': tags.get('addr:street', ''),
-                'numero': tags.get('addr:housenumber', ''),
-                'code_postal': tags.get('addr:postcode', ''),
-                'ville': tags.get('addr:city', ville),
-                'telephone': tags.get('phone', ''),
-                'email': tags.get('email', ''),
-                'website': tags.get('website', ''),
-                'secteur': tags.get('shop') or tags.get('office') or tags.get('amenity', 'Autre'),
-                'latitude': elem_lat,
-                'longitude': elem_lon
-            }
+def requete_insertion_gcal(service, calendar_id, corps):
+    """
+    events().insert avec un identifiant choisi par le client : rejouée après une réponse perdue,
+    elle est refusée (409) au lieu de créer un doublon
+    """
+    return service.events().insert(calendarId=calendar_id, body=dict(corps, id=uuid.uuid4().hex))
 
-            if entreprise['numero'] and entreprise['adresse']:
-                entreprise['adresse_complete'] = f"{entreprise['numero']} {entreprise['adresse']}"
-            elif entreprise['adresse']:
-                entreprise['adresse_complete'] = entreprise['adresse']
-            else:
-                entreprise['adresse_complete'] = ''
 
-            entreprises.append(entreprise)
+def _id_insertion_gcal(requete):
+    """Identifiant fixé par le client dans une requête d'insertion (None si absent ou autre méthode)"""
+    if getattr(requete, 'method', None) != 'POST' or not getattr(requete, 'body', None):
+        return None
+    try:
+        return json.loads(requete.body).get('id')
+    except (TypeError, ValueError):
+        return None
 
-        return entreprises
 
-    except Exception as e:
-        print("Erreur recherche par zone: {e}")
-        return []
+def _rejouable_gcal(requete, erreur):
+    """
+    Un appel en échec temporaire est rejoué s'il est idempotent (patch, delete, insertion avec identifiant
+    client) ; une insertion sans identifiant ne l'est qu'après un refus pour quota (Google n'a rien créé)
+    """
+    if not _erreur_gcal_temporaire(erreur):
+        return False
+    return _erreur_gcal_quota(erreur) or getattr(requete, 'method', None) != 'POST' or _id_insertion_gcal(requete) is not None
+
+
+def attendre_quota_gcal():
+    """Attend la fin de la pause imposée par les derniers refus pour quota"""
+    with _gcal_lock:
+        attente = _gcal_quota['reprise'] - time.monotonic()
+    if attente > 0:
+        time.sleep(attente)
+
+
+def signaler_quota_gcal(refuse):
+    """Ajuste la pause commune après un lot : doublée si Google a refusé pour quota, divisée par deux sinon"""
+    with _gcal_lock:
+        pause = _gcal_quota['pause']
+        if refuse:
+            pause = min(max(pause * 2, app.config['GCAL_QUOTA_PAUSE_MIN']), app.config['GCAL_QUOTA_PAUSE_MAX'])
+            _gcal_quota['refus'] += 1
+            print(f"⚠️ Quota Google Calendar atteint : lots espacés de {pause:.1f} s")
+        else:
+            pause = pause / 2 if pause >= app.config['GCAL_QUOTA_PAUSE_MIN'] else 0.0
+        _gcal_quota['pause'] = pause
+        _gcal_quota['reprise'] = time.monotonic() + pause
 
-# ============================================================================
-# NOUVEAU SYSTÈME GOOGLE CALENDAR - SIMPLE ET PROPRE
-# ============================================================================
 
-def get_google_calendar_service():
+def executer_lot_gcal(service, appels):
     """
-    Connexion à Google Calendar
-    Retourne le service ou None si erreur
+    Exécute des requêtes Google Calendar non envoyées par requêtes batch de GCAL_LOT_MAX appels
+    appels : liste de (clé, requête), ex. (calendar_id, requete_insertion_gcal(...))
+    Les appels en échec temporaire sont rejoués dans un nouveau lot (attente exponentielle) s'ils sont
+    idempotents ; une insertion rejouée refusée en 409 a donc déjà abouti et compte comme réussie
+    Retourne {clé: (réponse, erreur)} dans l'ordre des appels
     """
-    print("🔄 Connexion à Google Calendar...")
-    creds = None
+    resultats = {}
+    en_attente = list(appels)
+    taille_lot = max(1, app.config['GCAL_LOT_MAX'])
+    for tentative in range(app.config['GCAL_LOT_REESSAIS'] + 1):
+        a_rejouer = []
+        for debut in range(0, len(en_attente), taille_lot):
+            lot = en_attente[debut:debut + taille_lot]
+            reponses = {}
+
+            def rappel(request_id, reponse, erreur, reponses=reponses):
+                reponses[int(request_id)] = (reponse, erreur)
+
+            batch = service.new_batch_http_request(callback=rappel)
+            for position, (cle, requete) in enumerate(lot):
+                batch.add(requete, request_id=str(position))
+            attendre_quota_gcal()
+            try:
+                batch.execute()
+            except Exception as e:
+                # Lot entier perdu (réseau, réponse illisible) : chaque appel sans réponse est à rejouer
+                for position in range(len(lot)):
+                    reponses.setdefault(position, (None, e))
+            signaler_quota_gcal(any(erreur is not None and _erreur_gcal_quota(erreur) for _, erreur in reponses.values()))
+
+            for position, (cle, requete) in enumerate(lot):
+                reponse, erreur = reponses.get(position, (None, RuntimeError("Réponse absente du lot")))
+                if tentative and statut_erreur_gcal(erreur) == 409 and _id_insertion_gcal(requete):
+                    reponse, erreur = {'id': _id_insertion_gcal(requete)}, None  # Créé lors d'un essai précédent
+                resultats[cle] = (reponse, erreur)
+                if erreur is not None and _rejouable_gcal(requete, erreur):
+                    a_rejouer.append((cle, requete))
+
+        if not a_rejouer or tentative == app.config['GCAL_LOT_REESSAIS']:
+            break
+        print(f"⚠️ Google Calendar : {len(a_rejouer)} appel(s) du lot rejoué(s)")
+        time.sleep(app.config['GCAL_LOT_REESSAI_DELAI'] * 2 ** tentative)
+        en_attente = a_rejouer
+    return {cle: resultats[cle] for cle, _ in appels}
+
 
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+def empreinte_gcal(corps):
+    """Empreinte SHA-256 d'un contenu d'événement(s) : inchangée tant que le corps envoyé à Google est identique"""
+    texte = json.dumps(corps, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(texte.encode('utf-8')).hexdigest()
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+
+def appliquer_operations_gcal(service, operations):
+    """
+    Envoie en lot des opérations (clé, action, calendar_id, event_id, corps), action : insert, patch ou delete
+    Événement à modifier disparu de Google (404/410) : recréé ; suppression d'un événement déjà absent : succès
+    Retourne {clé: (event_id, erreur)} (event_id None pour une suppression)
+    """
+    def requete(action, calendar_id, event_id, corps):
+        if action == 'insert':
+            return requete_insertion_gcal(service, calendar_id, corps)
+        if action == 'patch':
+            return service.events().patch(calendarId=calendar_id, eventId=event_id, body=corps)
+        return service.events().delete(calendarId=calendar_id, eventId=event_id)
+
+    details = {cle: (action, calendar_id, corps) for cle, action, calendar_id, event_id, corps in operations}
+    resultats = executer_lot_gcal(service, [(cle, requete(*operation)) for cle, *operation in operations])
+
+    sortie = {}
+    a_recreer = []
+    for cle, (reponse, erreur) in resultats.items():
+        action, calendar_id, corps = details[cle]
+        disparu = statut_erreur_gcal(erreur) in (404, 410)
+        if erreur is None:
+            sortie[cle] = (reponse['id'] if action != 'delete' else None, None)
+        elif disparu and action == 'delete':
+            sortie[cle] = (None, None)
+        elif disparu and action == 'patch':
+            a_recreer.append((cle, requete('insert', calendar_id, None, corps)))
         else:
-            if not os.path.exists('credentials.json'):
-                print("❌ Fichier credentials.json introuvable")
-                return None
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
+            sortie[cle] = (None, erreur)
 
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+    for cle, (reponse, erreur) in executer_lot_gcal(service, a_recreer).items():
+        sortie[cle] = (reponse['id'] if erreur is None else None, erreur)
+    return {cle: sortie[cle] for cle, *_ in operations}
 
-    service = build('calendar', 'v3', credentials=creds)
-    print("✅ Connecté à Google Calendar")
-    return service
 
+# ============================================================================
+# NOUVEAU SYSTÈME GOOGLE CALENDAR - SIMPLE ET PROPRE
+# ============================================================================
 
 def creer_evenement_avec_rappels_personnalises(prestation, client, calendar_id='primary'):
     """
@@ -4140,7 +6670,7 @@ def creer_evenement_avec_rappels_personnalises(prestation, client, calendar_id='
 
     try:
         # 1. Connexion à Google Calendar
-        service = get_google_calendar_service()
+        service = get_calendar_service()
         if not service:
             return False, "Impossible de se connecter à Google Calendar", None
 
@@ -4285,64 +6815,6 @@ def creer_evenement_avec_rappels_personnalises(prestation, client, calendar_id='
 # ============================================================================
 # ANCIENNES FONCTIONS GOOGLE CALENDAR (À CONSERVER POUR COMPATIBILITÉ)
 # ============================================================================
-def get_calendar_service():
-    """Retourne le service Google Calendar (avec authentification)"""
-    if not GOOGLE_CALENDAR_AVAILABLE:
-        return None
-
-    creds = None
-    
-    # Chercher credentials.json
-    credentials_path = None
-    for path in ['/etc/secrets/credentials.json', 'credentials.json']:
-        if os.path.exists(path):
-            credentials_path = path
-            print("✅ Credentials trouvés : {path}")
-            break
-    
-    if not credentials_path:
-        print("❌ Fichier credentials.json introuvable")
-        return None
-    
-    # Chercher token.json (priorité aux secrets persistants)
-    token_path = None
-    for path in ['/etc/secrets/token.json', 'token.json', '/tmp/token.json']:
-        if os.path.exists(path):
-            token_path = path
-            print("✅ Token trouvé : {path}")
-            break
-    
-    # Charger les credentials existants
-    if token_path:
-        try:
-            creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-            print("✅ Token chargé depuis {token_path}")
-        except Exception as e:
-            print("⚠️ Erreur chargement token : {e}")
-            creds = None
-
-# Si pas de credentials valides
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                print("🔄 Rafraîchissement du token...")
-                creds.refresh(Request())
-                
-                # Sauvegarder le token rafraîchi dans /tmp (Secret Files est read-only)
-                save_path = '/tmp/token.json'
-                with open(save_path, 'w') as token:
-                    token.write(creds.to_json())
-                print("✅ Token rafraîchi et sauvegardé : {save_path}")
-            except Exception as e:
-                print("❌ Erreur refresh token : {e}")
-                return None
-        else:
-            # Pas de token valide - authentification requise
-            print("⚠️ Authentification requise via /google-auth")
-            return None
-
-    return build('calendar', 'v3', credentials=creds)
-
 def get_filtered_calendars(service):
     """
     Récupère la liste des calendriers Google en excluant :
@@ -4354,84 +6826,387 @@ def get_filtered_calendars(service):
         return []
 
     try:
-        calendar_list = service.calendarList().list().execute()
-        all_calendars = calendar_list.get('items', [])
-
-        # Mots-clés à exclure (en minuscules)
-        excluded_keywords = [
-            'anniversaire', 'anniversaires',
-            'jour férié', 'jours fériés', 'jours feries', 'fériés en france',
-            'holiday', 'holidays', 'birthday', 'birthdays',
-            'task', 'tasks', 'tâche', 'tâches',
-            'sabine',
-            'personnel', 'personal',
-            'contact', 'contacts',
-            'week numbers', 'numéros de semaine',
-            'phases de la lune', 'moon phases'
-        ]
+        return _lister_calendriers_filtres(service)
+    except Exception as e:
+        print(f"Erreur lors de la récupération des calendriers: {e}")
+        return []
 
-        # Filtrer les calendriers
-        filtered = []
-        for cal in all_calendars:
-            summary = cal.get('summary', '').lower()
-            description = cal.get('description', '').lower()
-            calendar_id = cal.get('id', '').lower()
 
-            # Exclure les calendriers système de Google (contacts, etc.)
-            if '#contacts@' in calendar_id or 'addressbook#' in calendar_id:
+def _lister_calendriers_filtres(service):
+    """Appel calendarList + filtrage par mots-clés (lève une exception si Google ne répond pas)"""
+    calendar_list = service.calendarList().list().execute()
+    all_calendars = calendar_list.get('items', [])
+
+    # Mots-clés à exclure (en minuscules)
+    excluded_keywords = [
+        'anniversaire', 'anniversaires',
+        'jour férié', 'jours fériés', 'jours feries', 'fériés en france',
+        'holiday', 'holidays', 'birthday', 'birthdays',
+        'task', 'tasks', 'tâche', 'tâches',
+        'sabine',
+        'personnel', 'personal',
+        'contact', 'contacts',
+        'week numbers', 'numéros de semaine',
+        'phases de la lune', 'moon phases'
+    ]
+
+    # Filtrer les calendriers
+    filtered = []
+    for cal in all_calendars:
+        summary = cal.get('summary', '').lower()
+        description = cal.get('description', '').lower()
+        calendar_id = cal.get('id', '').lower()
+
+        # Exclure les calendriers système de Google (contacts, etc.)
+        if '#contacts@' in calendar_id or 'addressbook#' in calendar_id:
+            continue
+
+        # Exclure les calendriers de phases de lune, numéros de semaine, etc.
+        if calendar_id.startswith('en.') or calendar_id.startswith('fr.'):
+            # Ce sont souvent des calendriers de jours fériés régionaux
+            if any(keyword in calendar_id for keyword in ['holiday', 'ferie']):
                 continue
 
-            # Exclure les calendriers de phases de lune, numéros de semaine, etc.
-            if calendar_id.startswith('en.') or calendar_id.startswith('fr.'):
-                # Ce sont souvent des calendriers de jours fériés régionaux
-                if any(keyword in calendar_id for keyword in ['holiday', 'ferie']):
-                    continue
+        # Vérifier si le nom ou la description contient un mot-clé exclu
+        is_excluded = any(keyword in summary or keyword in description for keyword in excluded_keywords)
 
-            # Vérifier si le nom ou la description contient un mot-clé exclu
-            is_excluded = any(keyword in summary or keyword in description for keyword in excluded_keywords)
+        if not is_excluded:
+            filtered.append(cal)
 
-            if not is_excluded:
-                filtered.append(cal)
+    return filtered
 
-        return filtered
 
-    except Exception as e:
-        print("Erreur lors de la récupération des calendriers: {e}")
+# ============================================================================
+# LISTE DES CALENDRIERS GOOGLE - cache dans calendrier_config + rafraîchissement en arrière-plan
+# ============================================================================
+
+app.config.setdefault('GCAL_CALENDRIERS_TTL', int(os.environ.get('GCAL_CALENDRIERS_TTL', 3600)))  # Secondes avant péremption
+# Intervalle du thread de rafraîchissement en secondes (0 = désactivé, rafraîchissement à la demande seulement)
+app.config.setdefault('GCAL_CALENDRIERS_INTERVALLE', int(os.environ.get('GCAL_CALENDRIERS_INTERVALLE', 900)))
+
+CHAMPS_CALENDRIER = ('id', 'summary', 'primary', 'backgroundColor')
+
+_calendriers_lock = threading.Lock()  # Un seul appel calendarList à la fois dans le processus
+_calendriers_arret = threading.Event()
+
+
+def rafraichir_calendriers(forcer=False):
+    """
+    Relit la liste filtrée des calendriers chez Google et l'enregistre dans calendrier_config
+    Retourne la liste, ou None si Google est indisponible (la liste précédente est alors conservée)
+    Sans forcer, une liste déjà fraîche (rafraîchie par un autre thread pendant l'attente du verrou) est rendue telle quelle
+    """
+    with _calendriers_lock:
+        if not forcer:
+            config = CalendrierConfig.query.populate_existing().first()
+            if config is not None and config.calendriers_json is not None and not _calendriers_perimes(config):
+                return json.loads(config.calendriers_json)
+
+        service = get_calendar_service()
+        if not service:
+            return None
+        try:
+            calendriers = [
+                {champ: cal.get(champ) for champ in CHAMPS_CALENDRIER}
+                for cal in _lister_calendriers_filtres(service)
+            ]
+        except Exception as e:
+            print(f"⚠️ Liste des calendriers Google non rafraîchie : {e}")
+            return None
+
+        config = CalendrierConfig.query.first()
+        if config is None:
+            config = CalendrierConfig(config_json=json.dumps({}))
+            db.session.add(config)
+        config.calendriers_json = json.dumps(calendriers)
+        config.calendriers_maj = datetime.utcnow()
+        db.session.commit()
+        return calendriers
+
+
+def _calendriers_perimes(config):
+    return (config is None or config.calendriers_maj is None
+            or config.calendriers_maj + timedelta(seconds=app.config['GCAL_CALENDRIERS_TTL']) < datetime.utcnow())
+
+
+def _rafraichir_calendriers_en_fond():
+    """Rafraîchissement ponctuel dans un thread (ignoré si un rafraîchissement est déjà en cours)"""
+    if _calendriers_lock.locked():
+        return  # Raccourci seulement : rafraichir_calendriers revérifie la fraîcheur sous le verrou
+
+    def tache():
+        try:
+            with app.app_context():
+                rafraichir_calendriers()
+                db.session.remove()
+        except Exception as e:
+            print(f"⚠️ Erreur rafraîchissement des calendriers : {e}")
+
+    threading.Thread(target=tache, name='calendriers-google', daemon=True).start()
+
+
+def calendriers_google(bloquant=False):
+    """
+    Liste filtrée des calendriers Google lue dans calendrier_config (aucun appel réseau dans la requête)
+    Liste périmée : rendue telle quelle et rafraîchie en arrière-plan
+    bloquant=True : si aucune liste n'a jamais été enregistrée, l'obtenir tout de suite (synchronisation)
+    """
+    if not GOOGLE_CALENDAR_AVAILABLE:
+        return []
+    config = CalendrierConfig.query.first()
+    if config is None or config.calendriers_json is None:
+        if bloquant:
+            return rafraichir_calendriers() or []
+        _rafraichir_calendriers_en_fond()
         return []
+    if _calendriers_perimes(config):
+        _rafraichir_calendriers_en_fond()
+    return json.loads(config.calendriers_json)
+
+
+def _boucle_calendriers():
+    """Thread de fond : rafraîchit la liste dès qu'elle est périmée"""
+    while not _calendriers_arret.is_set():
+        try:
+            with app.app_context():
+                if _calendriers_perimes(CalendrierConfig.query.first()):
+                    rafraichir_calendriers()
+                db.session.remove()
+        except Exception as e:
+            print(f"⚠️ Erreur rafraîchissement des calendriers : {e}")
+        _calendriers_arret.wait(app.config['GCAL_CALENDRIERS_INTERVALLE'])
+
+
+def demarrer_rafraichissement_calendriers():
+    """Démarre le thread de rafraîchissement de la liste des calendriers (une seule fois par processus)"""
+    if not GOOGLE_CALENDAR_AVAILABLE or app.config['GCAL_CALENDRIERS_INTERVALLE'] <= 0:
+        return None
+    thread = threading.Thread(target=_boucle_calendriers, name='calendriers-google', daemon=True)
+    thread.start()
+    return thread
+
+
+
+def supprimer_blocages_gcal(service, blocages):
+    """
+    Supprime les événements "🚫 Indisponible" en une requête batch et les lignes GcalBlocage correspondantes
+    (sans commit). Retourne le nombre d'événements supprimés ; déjà absent (404) n'est pas une erreur
+    """
+    resultats = executer_lot_gcal(service, [
+        (blocage.id, service.events().delete(calendarId=blocage.calendar_id, eventId=blocage.event_id))
+        for blocage in blocages
+    ])
+    nb_supprimes = 0
+    for blocage in blocages:
+        reponse, erreur = resultats[blocage.id]
+        if erreur is None:
+            nb_supprimes += 1
+        elif statut_erreur_gcal(erreur) != 404:
+            print(f"Erreur suppression blocage {blocage.calendar_name}: {erreur}")
+        db.session.delete(blocage)
+    return nb_supprimes
+
+
+def supprimer_evenements_sessions_gcal(service, prestation, calendar_id, event_id_deja_supprime=None):
+    """
+    Supprime en une requête batch les événements de toutes les sessions (chaque jour des multi-jours)
+    et ceux des sessions retirées, puis oublie l'état de synchronisation des sessions (sans commit)
+    """
+    operations = []
+    for session in prestation.sessions:
+        operations.extend(
+            (('session', session.id, numero), 'delete', session.gcal_calendar_id or calendar_id, event_id, None)
+            for numero, event_id in enumerate(ids_evenements_session(session))
+            if event_id != event_id_deja_supprime
+        )
+    orphelins = GcalEvenementSupprime.query.filter_by(prestation_id=prestation.id).all()
+    operations.extend(
+        (('orphelin', orphelin.id), 'delete', orphelin.calendar_id or calendar_id, orphelin.event_id, None)
+        for orphelin in orphelins
+    )
+
+    for cle, (event_id, erreur) in appliquer_operations_gcal(service, operations).items():
+        if erreur is not None:
+            print(f"Erreur suppression événement session: {erreur}")
+
+    for session in prestation.sessions:
+        session.gcal_event_id = None
+        session.gcal_event_ids = None
+        session.gcal_calendar_id = None
+        session.gcal_hash = None
+        session.gcal_synced = False
+    for orphelin in orphelins:
+        db.session.delete(orphelin)
+
+
+def synchroniser_blocages_gcal(service, prestation_id, evenements, calendriers):
+    """
+    Met les événements "🚫 Indisponible" d'une prestation en conformité avec evenements × calendriers
+    (calendriers : liste de (calendar_id, nom)) sans renvoyer ceux dont l'empreinte n'a pas changé :
+    un blocage modifié est patché sur place, les blocages en trop supprimés, les manquants créés
+    Une seule requête batch, lignes GcalBlocage mises à jour sans commit. Retourne (appels envoyés, appels en erreur)
+    """
+    disponibles = {}
+    for blocage in GcalBlocage.query.filter_by(prestation_id=prestation_id).order_by(GcalBlocage.id).all():
+        disponibles.setdefault((blocage.calendar_id, blocage.gcal_hash), []).append(blocage)
+
+    # Blocages identiques déjà sur Google : rien à envoyer
+    a_envoyer = []
+    for evenement in evenements:
+        empreinte = empreinte_gcal(evenement)
+        for calendar_id, nom in calendriers:
+            if disponibles.get((calendar_id, empreinte)):
+                disponibles[(calendar_id, empreinte)].pop(0)
+            else:
+                a_envoyer.append((calendar_id, nom, evenement, empreinte))
+
+    # Les anciens blocages d'un même calendrier sont réutilisés (patch) avant d'en créer de nouveaux
+    restants = {}
+    for (calendar_id, _), blocages in disponibles.items():
+        restants.setdefault(calendar_id, []).extend(blocages)
+
+    operations = []
+    cibles = {}
+    for numero, (calendar_id, nom, evenement, empreinte) in enumerate(a_envoyer):
+        blocage = restants[calendar_id].pop(0) if restants.get(calendar_id) else None
+        if blocage is None:
+            blocage = GcalBlocage(prestation_id=prestation_id, calendar_id=calendar_id, calendar_name=nom)
+            operations.append((('envoi', numero), 'insert', calendar_id, None, evenement))
+        else:
+            operations.append((('envoi', numero), 'patch', calendar_id, blocage.event_id, evenement))
+        cibles[('envoi', numero)] = (blocage, empreinte)
+    for blocages in restants.values():
+        for blocage in blocages:
+            operations.append((('suppression', blocage.id), 'delete', blocage.calendar_id, blocage.event_id, None))
+            cibles[('suppression', blocage.id)] = (blocage, None)
+
+    nb_erreurs = 0
+    for cle, (event_id, erreur) in appliquer_operations_gcal(service, operations).items():
+        blocage, empreinte = cibles[cle]
+        if erreur is not None:
+            nb_erreurs += 1
+            print(f"Erreur blocage calendrier {blocage.calendar_name}: {erreur}")
+            if blocage.id is not None:
+                blocage.gcal_hash = None  # Contenu incertain : renvoyé à la prochaine synchronisation
+        elif cle[0] == 'suppression':
+            db.session.delete(blocage)
+        else:
+            blocage.event_id = event_id
+            blocage.gcal_hash = empreinte
+            if blocage.id is None:
+                db.session.add(blocage)
+    return len(operations), nb_erreurs
+
+
+def synchroniser_sessions_gcal(service, prestation, calendar_id, titre, description):
+    """
+    Envoie les événements des sessions dont le contenu a changé depuis la dernière synchronisation
+    (empreinte SessionPrestation.gcal_hash) : patch sur place, ou suppression + création si le calendrier
+    ou le nombre de jours a changé ; supprime aussi les événements des sessions retirées
+    Une seule requête batch, sans commit. Retourne (sessions envoyées, sessions inchangées, sessions en erreur)
+    """
+    sessions = prestation.sessions
+    operations = []
+    envoyees = []
+    nb_inchangees = 0
+
+    for idx, session in enumerate(sessions):
+        # Titre avec numéro de session si plusieurs sessions
+        titre_session = titre
+        if len(sessions) > 1:
+            titre_session = f"{titre} (Session {idx + 1}/{len(sessions)})"
+
+        # Utiliser les dates de la session
+        start_time = session.date_debut
+        end_time = session.date_fin if session.date_fin else start_time + timedelta(hours=session.duree_heures or 1)
+
+        evenements = corps_evenements_session(session, titre_session, description, start_time, end_time)
+        empreinte = empreinte_gcal(evenements)
+        ids = ids_evenements_session(session)
+        calendrier_actuel = session.gcal_calendar_id or calendar_id
+
+        if ids and session.gcal_hash == empreinte and calendrier_actuel == calendar_id:
+            nb_inchangees += 1
+            continue
+
+        if ids and calendrier_actuel == calendar_id and len(ids) == len(evenements):
+            precedents = ids  # Un patch en échec laisse l'événement existant en place
+            operations.extend(
+                (('session', idx, jour), 'patch', calendar_id, event_id, evenement)
+                for jour, (event_id, evenement) in enumerate(zip(ids, evenements))
+            )
+        else:
+            precedents = []
+            operations.extend(
+                (('ancien', idx, numero), 'delete', calendrier_actuel, event_id, None)
+                for numero, event_id in enumerate(ids)
+            )
+            operations.extend(
+                (('session', idx, jour), 'insert', calendar_id, None, evenement)
+                for jour, evenement in enumerate(evenements)
+            )
+        envoyees.append((idx, session, empreinte, len(evenements), precedents))
+
+    # Événements des sessions supprimées depuis la dernière synchronisation
+    orphelins = GcalEvenementSupprime.query.filter_by(prestation_id=prestation.id).all()
+    operations.extend(
+        (('orphelin', orphelin.id), 'delete', orphelin.calendar_id or calendar_id, orphelin.event_id, None)
+        for orphelin in orphelins
+    )
+
+    resultats = appliquer_operations_gcal(service, operations)
+
+    nb_erreurs = 0
+    for idx, session, empreinte, nb_jours, precedents in envoyees:
+        ids = []
+        complete = True
+        for jour in range(nb_jours):
+            event_id, erreur = resultats[('session', idx, jour)]
+            if erreur is not None:
+                print(f"Erreur envoi événement session: {erreur}")
+                complete = False
+                event_id = precedents[jour] if precedents else None
+            if event_id:
+                ids.append(event_id)
+        # Empreinte enregistrée seulement si tout est passé : sinon la session est renvoyée la prochaine fois
+        session.gcal_event_ids = json.dumps(ids) if ids else None
+        session.gcal_event_id = ids[0] if ids else None
+        session.gcal_calendar_id = calendar_id if ids else None
+        session.gcal_hash = empreinte if complete else None
+        session.gcal_synced = bool(ids)
+        nb_erreurs += 0 if complete else 1
+
+    for orphelin in orphelins:
+        event_id, erreur = resultats[('orphelin', orphelin.id)]
+        if erreur is None:
+            db.session.delete(orphelin)
+        else:
+            print(f"Erreur suppression événement de session retirée: {erreur}")
+
+    return len(envoyees) - nb_erreurs, nb_inchangees, nb_erreurs
 
 
 def creer_blocages_autres_calendriers(service, prestation, calendar_id_principal):
     """
     Créer des événements "🚫 Indisponible" sur tous les calendriers professionnels
     sauf celui où la prestation a été créée, pour chaque session
+    Retourne le nombre d'envois en erreur
     """
     try:
-        # Récupérer tous les calendriers professionnels
-        tous_calendriers = get_filtered_calendars(service)
+        # Récupérer tous les calendriers professionnels (cache calendrier_config)
+        tous_calendriers = calendriers_google(bloquant=True)
 
         # Filtrer pour ne garder que ceux qui ne sont PAS le calendrier principal de la prestation
         calendriers_a_bloquer = [cal for cal in tous_calendriers if cal['id'] != calendar_id_principal]
 
-        if not calendriers_a_bloquer:
-            return  # Aucun calendrier à bloquer
-
-        # Supprimer les anciens blocages de cette prestation
-        anciens_blocages = GcalBlocage.query.filter_by(prestation_id=prestation.id).all()
-        for blocage in anciens_blocages:
-            try:
-                service.events().delete(
-                    calendarId=blocage.calendar_id,
-                    eventId=blocage.event_id
-                ).execute()
-            except:
-                pass
-            db.session.delete(blocage)
-        db.session.commit()
+        if not tous_calendriers:
+            return 0  # Liste des calendriers inconnue : les blocages existants restent en place
 
-        # Créer un événement de blocage pour CHAQUE session sur CHAQUE calendrier
+        # Un événement de blocage pour CHAQUE session sur CHAQUE calendrier
         client = prestation.client
         client_nom = client.nom if client else "Client"
 
+        evenements = []
         if prestation.sessions and len(prestation.sessions) > 0:
             for session in prestation.sessions:
                 # Préparer l'événement de blocage pour cette session
@@ -4468,182 +7243,95 @@ def creer_blocages_autres_calendriers(service, prestation, calendar_id_principal
                         'transparency': 'opaque',
                         'visibility': 'private',
                     }
+                evenements.append(event_blocage)
 
-                # Créer le blocage sur chaque calendrier
-                for cal in calendriers_a_bloquer:
-                    try:
-                        print("!!! CREATION BLOCAGE - LIGNE 4144 !!!")
-                        print("event_blocage:", event_blocage)
-
-                        created_blocage = service.events().insert(
-                            calendarId=cal['id'],
-                            body=event_blocage
-                        ).execute()
-
-                        print("!!! BLOCAGE CREE - ID:", created_blocage['id'])
-
-                        # Enregistrer dans la BDD
-                        nouveau_blocage = GcalBlocage(
-                            prestation_id=prestation.id,
-                            calendar_id=cal['id'],
-                            event_id=created_blocage['id'],
-                            calendar_name=cal.get('summary', 'Inconnu')
-                        )
-                        db.session.add(nouveau_blocage)
-                    except HttpError as e:
-                        print("Erreur blocage calendrier {cal.get('summary', 'Inconnu')}: {e}")
-                        pass
-
-            db.session.commit()
+        # Seuls les blocages modifiés, manquants ou en trop partent vers Google (une requête batch)
+        nb_appels, nb_erreurs = synchroniser_blocages_gcal(
+            service, prestation.id, evenements,
+            [(cal['id'], cal.get('summary', 'Inconnu')) for cal in calendriers_a_bloquer]
+        )
+        db.session.commit()
+        return nb_erreurs
 
     except Exception as e:
-        print("Erreur création blocages: {e}")
-
-
-def creer_event_gcal_session(service, calendar_id, session, titre, description, start_time, end_time):
-    """
-    Créer un événement Google Calendar pour une session spécifique
-    Retourne l'event_id ou None en cas d'erreur
-    """
-    try:
-        print("========================================")
-        print("CREER_EVENT_GCAL_SESSION - DEBUT")
-        print("!!! session.JOURNEE_COMPLETE =", session.journee_complete, "!!!")
-        print("!!! TYPE:", type(session.journee_complete), "!!!")
-        print("start_time:", start_time)
-        print("start_time type:", type(start_time))
-
-        # === RAPPELS GOOGLE CALENDAR AUTOMATIQUES ===
-        reminders_list = []
-        try:
-            # datetime et timedelta sont déjà importés en haut du fichier
-            event_start_dt = None
-
-            # Convertir start_time en datetime si c'est un objet date
-            if isinstance(start_time, datetime):
-                event_start_dt = start_time
-                print("start_time est datetime")
-            elif hasattr(start_time, 'year'):  # C'est un objet date
-                # Pour les journées complètes, prendre 8h00 le jour de début
-                event_start_dt = datetime.combine(start_time, datetime.min.time().replace(hour=8))
-                print("start_time converti en datetime")
-
-            print("event_start_dt:", event_start_dt)
-
-            if event_start_dt:
-                # Rappel la veille à 19h00
-                reminder_veille = event_start_dt.replace(hour=19, minute=0, second=0) - timedelta(days=1)
-                minutes_veille = int((event_start_dt - reminder_veille).total_seconds() / 60)
-                print("Calcul rappel veille - minutes:", minutes_veille)
-                if minutes_veille > 0 and minutes_veille < 40320:
-                    reminders_list.append({'method': 'popup', 'minutes': minutes_veille})
-                    print("Rappel veille ajoute")
-
-                # Rappel le jour même à 7h00
-                reminder_jour = event_start_dt.replace(hour=7, minute=0, second=0)
-                minutes_jour = int((event_start_dt - reminder_jour).total_seconds() / 60)
-                print("Calcul rappel jour - minutes:", minutes_jour)
-                if minutes_jour > 0 and minutes_jour < 1440:
-                    reminders_list.append({'method': 'popup', 'minutes': minutes_jour})
-                    print("Rappel jour ajoute")
-        except Exception as e:
-            print("ERREUR calcul rappels:", str(e))
-
-        print("reminders_list FINAL:", reminders_list)
-        print("========================================")
-        # === FIN RAPPELS ===
-
-        # MODIFICATION : Gérer les prestations "Journée complète"
-        # Si multi-jours : créer 1 événement par jour (08:00-20:00)
-        # Si 1 jour : créer 1 événement (08:00-20:00)
-        if session.journee_complete:
-            print("🌞 JOURNÉE COMPLÈTE DÉTECTÉE")
-
-            # Extraire les dates
-            start_date = start_time.date() if hasattr(start_time, 'date') else start_time
-            end_date = end_time.date() if hasattr(end_time, 'date') else end_time
-
-            # Calculer le nombre de jours
-            nb_jours = (end_date - start_date).days + 1
-            print("📅 Nombre de jours : {nb_jours} (du {start_date} au {end_date})")
-
-            if nb_jours > 1:
-                # MULTI-JOURS : Créer un événement pour chaque jour
-                print("🔄 MULTI-JOURS : Création de {nb_jours} événements séparés")
-
-                event_ids = []
-                current_date = start_date
-
-                while current_date <= end_date:
-                    jour_num = (current_date - start_date).days + 1
-
-                    # Titre avec numéro de jour
-                    titre_jour = f"{titre} (Jour {jour_num}/{nb_jours})"
-
-                    # Horaires : 08:00 - 20:00 pour ce jour
-                    start_datetime = datetime.combine(current_date, datetime.min.time().replace(hour=8, minute=0))
-                    end_datetime = datetime.combine(current_date, datetime.min.time().replace(hour=20, minute=0))
-
-                    # Calculer les rappels pour CE jour spécifiquement
-                    rappels_jour = []
-
-                    # Rappel veille à 19h00
-                    veille_19h = datetime.combine(current_date, datetime.min.time().replace(hour=19, minute=0)) - timedelta(days=1)
-                    minutes_veille = int((start_datetime - veille_19h).total_seconds() / 60)
-                    if 0 < minutes_veille < 10080:  # Max 7 jours
-                        rappels_jour.append({'method': 'popup', 'minutes': minutes_veille})
-
-                    # Rappel jour à 07h00
-                    jour_7h = datetime.combine(current_date, datetime.min.time().replace(hour=7, minute=0))
-                    minutes_jour_rappel = int((start_datetime - jour_7h).total_seconds() / 60)
-                    if 0 < minutes_jour_rappel < 1440:  # Max 24h
-                        rappels_jour.append({'method': 'popup', 'minutes': minutes_jour_rappel})
-
-                    print("   📌 Jour {jour_num}/{nb_jours} : {current_date} avec {len(rappels_jour)} rappels")
-
-                    # Créer l'événement pour ce jour
-                    event_data = {
-                        'summary': titre_jour,
-                        'description': description,
-                        'start': {
-                            'dateTime': start_datetime.isoformat(),
-                            'timeZone': 'Europe/Paris',
-                        },
-                        'end': {
-                            'dateTime': end_datetime.isoformat(),
-                            'timeZone': 'Europe/Paris',
-                        },
-                        'transparency': 'opaque',
-                        'reminders': {
-                            'useDefault': False,
-                            'overrides': rappels_jour
-                        }
-                    }
-
-                    created_event = service.events().insert(
-                        calendarId=calendar_id,
-                        body=event_data
-                    ).execute()
-
-                    event_ids.append(created_event['id'])
-                    print("   ✅ Événement créé - ID: {created_event['id']}")
+        db.session.rollback()
+        print(f"Erreur création blocages: {e}")
+        return 1
 
-                    # Passer au jour suivant
-                    current_date += timedelta(days=1)
 
-                print("✅ {len(event_ids)} événements créés pour prestation multi-jours")
-                # Retourner le premier ID (pour compatibilité)
-                return event_ids[0] if event_ids else None
+def corps_evenements_session(session, titre, description, start_time, end_time):
+    """
+    Corps des événements Google Calendar d'une session (sans appel à l'API)
+    Journée complète : un événement 08:00-20:00 par jour, sinon un seul événement aux horaires de la session
+    """
+    # === RAPPELS GOOGLE CALENDAR AUTOMATIQUES ===
+    reminders_list = []
+    try:
+        event_start_dt = None
 
-            else:
-                # UN SEUL JOUR : Créer 1 événement 08:00-20:00
-                print("📅 UN SEUL JOUR : Création d'1 événement 08:00-20:00")
+        # Convertir start_time en datetime si c'est un objet date
+        if isinstance(start_time, datetime):
+            event_start_dt = start_time
+        elif hasattr(start_time, 'year'):  # C'est un objet date
+            # Pour les journées complètes, prendre 8h00 le jour de début
+            event_start_dt = datetime.combine(start_time, datetime.min.time().replace(hour=8))
 
-                start_datetime = datetime.combine(start_date, datetime.min.time().replace(hour=8, minute=0))
-                end_datetime = datetime.combine(start_date, datetime.min.time().replace(hour=20, minute=0))
+        if event_start_dt:
+            # Rappel la veille à 19h00
+            reminder_veille = event_start_dt.replace(hour=19, minute=0, second=0) - timedelta(days=1)
+            minutes_veille = int((event_start_dt - reminder_veille).total_seconds() / 60)
+            if minutes_veille > 0 and minutes_veille < 40320:
+                reminders_list.append({'method': 'popup', 'minutes': minutes_veille})
 
-                event_data = {
-                    'summary': titre,
+            # Rappel le jour même à 7h00
+            reminder_jour = event_start_dt.replace(hour=7, minute=0, second=0)
+            minutes_jour = int((event_start_dt - reminder_jour).total_seconds() / 60)
+            if minutes_jour > 0 and minutes_jour < 1440:
+                reminders_list.append({'method': 'popup', 'minutes': minutes_jour})
+    except Exception as e:
+        print("ERREUR calcul rappels:", str(e))
+    # === FIN RAPPELS ===
+
+    # MODIFICATION : Gérer les prestations "Journée complète"
+    # Si multi-jours : 1 événement par jour (08:00-20:00)
+    # Si 1 jour : 1 événement (08:00-20:00)
+    if session.journee_complete:
+        # Extraire les dates
+        start_date = start_time.date() if hasattr(start_time, 'date') else start_time
+        end_date = end_time.date() if hasattr(end_time, 'date') else end_time
+
+        # Calculer le nombre de jours
+        nb_jours = (end_date - start_date).days + 1
+
+        if nb_jours > 1:
+            # MULTI-JOURS : un événement pour chaque jour
+            evenements = []
+            current_date = start_date
+
+            while current_date <= end_date:
+                jour_num = (current_date - start_date).days + 1
+
+                # Horaires : 08:00 - 20:00 pour ce jour
+                start_datetime = datetime.combine(current_date, datetime.min.time().replace(hour=8, minute=0))
+                end_datetime = datetime.combine(current_date, datetime.min.time().replace(hour=20, minute=0))
+
+                # Calculer les rappels pour CE jour spécifiquement
+                rappels_jour = []
+
+                # Rappel veille à 19h00
+                veille_19h = datetime.combine(current_date, datetime.min.time().replace(hour=19, minute=0)) - timedelta(days=1)
+                minutes_veille = int((start_datetime - veille_19h).total_seconds() / 60)
+                if 0 < minutes_veille < 10080:  # Max 7 jours
+                    rappels_jour.append({'method': 'popup', 'minutes': minutes_veille})
+
+                # Rappel jour à 07h00
+                jour_7h = datetime.combine(current_date, datetime.min.time().replace(hour=7, minute=0))
+                minutes_jour_rappel = int((start_datetime - jour_7h).total_seconds() / 60)
+                if 0 < minutes_jour_rappel < 1440:  # Max 24h
+                    rappels_jour.append({'method': 'popup', 'minutes': minutes_jour_rappel})
+
+                evenements.append({
+                    'summary': f"{titre} (Jour {jour_num}/{nb_jours})",
                     'description': description,
                     'start': {
                         'dateTime': start_datetime.isoformat(),
@@ -4656,47 +7344,60 @@ def creer_event_gcal_session(service, calendar_id, session, titre, description,
                     'transparency': 'opaque',
                     'reminders': {
                         'useDefault': False,
-                        'overrides': reminders_list
+                        'overrides': rappels_jour
                     }
-                }
-        else:
-            # PAS "Journée complète" : événement normal avec horaires spécifiques
-            print("⏰ Événement avec horaires spécifiques (Matin/Après-midi/Personnalisé)")
-
-            event_data = {
-                'summary': titre,
-                'description': description,
-                'start': {
-                    'dateTime': start_time.isoformat(),
-                    'timeZone': 'Europe/Paris',
-                },
-                'end': {
-                    'dateTime': end_time.isoformat(),
-                    'timeZone': 'Europe/Paris',
-                },
-                'transparency': 'opaque',
-                'reminders': {
-                    'useDefault': False,
-                    'overrides': reminders_list
-                }
-            }
-
-        # Créer l'événement (pour les cas 1 jour ou horaires spécifiques)
-        print(">>> ENVOI À GOOGLE CALENDAR <<<")
-        print(">>> Rappels configurés:", len(event_data.get('reminders', {}).get('overrides', [])))
+                })
 
-        created_event = service.events().insert(
-            calendarId=calendar_id,
-            body=event_data
-        ).execute()
+                # Passer au jour suivant
+                current_date += timedelta(days=1)
+
+            return evenements
+
+        # UN SEUL JOUR : 1 événement 08:00-20:00
+        start_time = datetime.combine(start_date, datetime.min.time().replace(hour=8, minute=0))
+        end_time = datetime.combine(start_date, datetime.min.time().replace(hour=20, minute=0))
+
+    # Un seul événement (journée complète sur 1 jour ou horaires Matin/Après-midi/Personnalisé)
+    return [{
+        'summary': titre,
+        'description': description,
+        'start': {
+            'dateTime': start_time.isoformat(),
+            'timeZone': 'Europe/Paris',
+        },
+        'end': {
+            'dateTime': end_time.isoformat(),
+            'timeZone': 'Europe/Paris',
+        },
+        'transparency': 'opaque',
+        'reminders': {
+            'useDefault': False,
+            'overrides': reminders_list
+        }
+    }]
 
-        print(">>> ÉVÉNEMENT CRÉÉ - ID:", created_event['id'])
-        print(">>> Rappels enregistrés:", created_event.get('reminders'))
 
-        return created_event['id']
+def creer_event_gcal_session(service, calendar_id, session, titre, description, start_time, end_time):
+    """
+    Créer les événements Google Calendar d'une session (une requête batch pour les multi-jours)
+    Retourne l'event_id du premier événement créé ou None en cas d'erreur
+    """
+    try:
+        evenements = corps_evenements_session(session, titre, description, start_time, end_time)
+        resultats = executer_lot_gcal(service, [
+            (jour, requete_insertion_gcal(service, calendar_id, evenement))
+            for jour, evenement in enumerate(evenements)
+        ])
+        event_ids = []
+        for reponse, erreur in resultats.values():
+            if erreur is not None:
+                print(f"Erreur création événement session: {erreur}")
+            else:
+                event_ids.append(reponse['id'])
+        return event_ids[0] if event_ids else None
 
     except Exception as e:
-        print("Erreur création événement session: {e}")
+        print(f"Erreur création événement session: {e}")
         return None
 
 
@@ -4790,46 +7491,33 @@ def sync_prestation_to_gcal(prestation_id):
 
         description = "\n".join(description_parts)
 
-        # NOUVELLE LOGIQUE : Créer un événement Google Calendar PAR SESSION
-        # Au lieu de créer un seul événement basé sur date_debut/date_fin de la prestation
-        events_created = []
-
+        # NOUVELLE LOGIQUE : Un événement Google Calendar PAR SESSION
+        # Synchronisation différentielle : seules les sessions modifiées depuis le dernier envoi partent vers Google
         if prestation.sessions and len(prestation.sessions) > 0:
-            # Cas avec sessions multiples : créer un événement par session
-            for idx, session in enumerate(prestation.sessions):
-                # Titre avec numéro de session si plusieurs sessions
-                titre_session = titre
-                if len(prestation.sessions) > 1:
-                    titre_session = f"{titre} (Session {idx + 1}/{len(prestation.sessions)})"
-
-                # Utiliser les dates de la session
-                start_time = session.date_debut
-                end_time = session.date_fin if session.date_fin else start_time + timedelta(hours=session.duree_heures or 1)
-
-                # Créer l'événement pour cette session
-                event_id = creer_event_gcal_session(
-                    service, calendar_id, session, titre_session, description,
-                    start_time, end_time
-                )
-                if event_id:
-                    events_created.append(event_id)
-                    # Enregistrer l'ID de l'événement sur la session
-                    session.gcal_event_id = event_id
-                    session.gcal_synced = True
+            nb_envoyees, nb_inchangees, nb_erreurs = synchroniser_sessions_gcal(
+                service, prestation, calendar_id, titre, description
+            )
 
             # Mettre à jour la prestation principale
             prestation.gcal_synced = True
             prestation.gcal_last_sync = datetime.utcnow()
-            if events_created:
+            premier_event_id = next((s.gcal_event_id for s in prestation.sessions if s.gcal_event_id), None)
+            if premier_event_id:
                 # Stocker l'ID du premier événement (pour compatibilité)
-                prestation.gcal_event_id = events_created[0]
+                prestation.gcal_event_id = premier_event_id
             db.session.commit()
 
-            # Créer les événements "Indisponible" sur TOUS les autres calendriers professionnels
+            # Événements "Indisponible" sur TOUS les autres calendriers professionnels
             # pour bloquer ces créneaux (sauf le calendrier où la prestation est créée)
-            creer_blocages_autres_calendriers(service, prestation, calendar_id)
+            nb_erreurs_blocages = creer_blocages_autres_calendriers(service, prestation, calendar_id)
 
-            return True, f"{len(events_created)} événement(s) créé(s)", events_created[0] if events_created else None
+            message = f"{nb_envoyees} session(s) envoyée(s), {nb_inchangees} inchangée(s)"
+            if nb_erreurs:
+                message += f", {nb_erreurs} en erreur"
+            if nb_erreurs_blocages:
+                message += f", {nb_erreurs_blocages} blocage(s) en erreur"
+            # Envoi incomplet : échec signalé pour que la synchronisation soit refaite (le reste est déjà à jour)
+            return not (nb_erreurs or nb_erreurs_blocages), message, premier_event_id
 
         # FALLBACK : Ancien code pour les prestations sans sessions
         start_time = prestation.date_debut
@@ -5017,45 +7705,9 @@ def sync_prestation_to_gcal(prestation_id):
                             'visibility': 'private',
                         }
 
-                    # Supprimer les anciens événements de blocage si mis à jour
-                    if prestation.gcal_event_id:
-                        anciens_blocages = GcalBlocage.query.filter_by(prestation_id=prestation_id).all()
-                        for blocage in anciens_blocages:
-                            try:
-                                service.events().delete(
-                                    calendarId=blocage.calendar_id,
-                                    eventId=blocage.event_id
-                                ).execute()
-                            except:
-                                pass
-                            db.session.delete(blocage)
-                        db.session.commit()
-
-                    # Créer l'événement de blocage sur chaque calendrier
-                    for cal in tous_calendriers_a_bloquer:
-                        try:
-                            print("!!! CREATION BLOCAGE 2 - LIGNE 4602 !!!")
-                            print("event_blocage:", event_blocage)
-
-                            created_blocage = service.events().insert(
-                                calendarId=cal['id'],
-                                body=event_blocage
-                            ).execute()
-
-                            print("!!! BLOCAGE 2 CREE - ID:", created_blocage['id'])
-
-                            # Enregistrer le blocage dans la base de données
-                            nouveau_blocage = GcalBlocage(
-                                prestation_id=prestation_id,
-                                calendar_id=cal['id'],
-                                event_id=created_blocage['id'],
-                                calendar_name=cal['nom']
-                            )
-                            db.session.add(nouveau_blocage)
-                        except HttpError as e:
-                            # Ignorer les erreurs de calendriers individuels
-                            print("Erreur blocage calendrier {cal['nom']}: {e}")
-                            pass
+                    # Blocage sur chaque calendrier : seuls les blocages modifiés ou manquants sont envoyés
+                    synchroniser_blocages_gcal(service, prestation_id, [event_blocage],
+                                               [(cal['id'], cal['nom']) for cal in tous_calendriers_a_bloquer])
                     db.session.commit()
             except:
                 pass
@@ -5112,6 +7764,7 @@ def delete_gcal_event(prestation_id):
         print("🗑️ Suppression événement - calendar_id: {calendar_id}")
 
         # Supprimer l'événement
+        event_id_supprime = prestation.gcal_event_id
         try:
             service.events().delete(
                 calendarId=calendar_id,
@@ -5126,23 +7779,8 @@ def delete_gcal_event(prestation_id):
             nb_blocages_supprimes = 0
             try:
                 blocages = GcalBlocage.query.filter_by(prestation_id=prestation_id).all()
-
-                for blocage in blocages:
-                    try:
-                        service.events().delete(
-                            calendarId=blocage.calendar_id,
-                            eventId=blocage.event_id
-                        ).execute()
-                        nb_blocages_supprimes += 1
-                    except HttpError as e:
-                        if e.resp.status != 404:  # Ignorer si l'événement n'existe déjà plus
-                            print("Erreur suppression blocage {blocage.calendar_name}: {e}")
-                    except Exception as e:
-                        print("Erreur suppression blocage {blocage.calendar_name}: {e}")
-
-                    # Supprimer l'enregistrement du blocage de la base de données
-                    db.session.delete(blocage)
-
+                nb_blocages_supprimes = supprimer_blocages_gcal(service, blocages)
+                supprimer_evenements_sessions_gcal(service, prestation, calendar_id, event_id_supprime)
                 db.session.commit()
             except Exception as e:
                 # Si la table gcal_blocages n'existe pas encore (migration non faite), ignorer
@@ -5167,6 +7805,438 @@ def delete_gcal_event(prestation_id):
     except Exception as e:
         return False, f"Erreur: {str(e)}"
 
+# ============================================================================
+# FILE D'ATTENTE GOOGLE CALENDAR - les enregistrements n'attendent jamais l'API Google
+# ============================================================================
+
+# Threads qui vident la file (0 = aucun : les opérations restent en attente)
+app.config.setdefault('GCAL_FILE_THREADS', int(os.environ.get('GCAL_FILE_THREADS', 2)))
+# Attente maximale entre deux passages quand rien n'est dû (secondes)
+app.config.setdefault('GCAL_FILE_INTERVALLE', 30)
+# Échecs avant abandon (statut erreur) ; attente avant nouvel essai doublée à chaque échec, plafonnée
+app.config.setdefault('GCAL_FILE_TENTATIVES', 8)
+app.config.setdefault('GCAL_FILE_DELAI', 30)
+app.config.setdefault('GCAL_FILE_DELAI_MAX', 3600)
+# Opération en_cours depuis plus de N secondes (thread ou processus arrêté) : reprise par un autre thread
+app.config.setdefault('GCAL_FILE_VERROU', 600)
+
+_file_gcal_reveil = threading.Event()
+_file_gcal_arret = threading.Event()
+
+
+def calendrier_gcal_prestation(prestation):
+    """Calendrier de la prestation : prestation.calendrier_id, sinon celui du client, sinon le calendrier principal"""
+    if prestation.calendrier_id:
+        return prestation.calendrier_id
+    if prestation.client and prestation.client.calendrier_google:
+        return prestation.client.calendrier_google
+    config = CalendrierConfig.query.first()
+    if config and config.config_json:
+        try:
+            return json.loads(config.config_json).get('calendrier_principal', {}).get('id', 'primary')
+        except ValueError:
+            pass
+    return 'primary'
+
+
+def evenements_gcal_prestation(prestation):
+    """[calendar_id, event_id] de tous les événements Google d'une prestation (sessions, blocages, sessions retirées)"""
+    calendar_id = calendrier_gcal_prestation(prestation)
+    evenements = []
+    if prestation.gcal_event_id:
+        evenements.append([calendar_id, prestation.gcal_event_id])
+    for session in prestation.sessions:
+        evenements.extend([session.gcal_calendar_id or calendar_id, event_id] for event_id in ids_evenements_session(session))
+    evenements.extend([blocage.calendar_id, blocage.event_id] for blocage in prestation.gcal_blocages)
+    evenements.extend(
+        [orphelin.calendar_id or calendar_id, orphelin.event_id]
+        for orphelin in GcalEvenementSupprime.query.filter_by(prestation_id=prestation.id)
+    )
+    uniques = []
+    for evenement in evenements:
+        if evenement not in uniques:
+            uniques.append(evenement)
+    return uniques
+
+
+def planifier_sync_gcal(nature, objet_id, action='upsert', donnees=None, synchro_id=None, detacher=False):
+    """
+    Ajoute une opération à la file dans la transaction en cours (rien n'est envoyé à Google ici)
+    Une opération déjà en file pour le même objet est remplacée : seule la dernière action compte ;
+    une modification (synchro_id None) la rend prioritaire, "Synchroniser tout" ne retarde pas une modification
+    encore en file. Les threads de la file sont réveillés au commit
+    detacher : l'objet est supprimé de la base. SQLite peut redonner son identifiant au prochain objet créé :
+    l'opération est détachée (objet_id = -id) pour que la création de ce nouvel objet ne l'écrase pas
+    """
+    if not GOOGLE_CALENDAR_AVAILABLE:
+        return
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+    table = GcalFileAttente.__table__
+    maintenant = datetime.utcnow()
+    requete = sqlite_insert(table).values(
+        nature=nature, objet_id=objet_id, action=action,
+        donnees=json.dumps(donnees) if donnees is not None else None,
+        statut='en_attente', version=1, tentatives=0, prochain_essai=maintenant,
+        date_creation=maintenant, date_maj=maintenant, synchro_id=synchro_id
+    )
+    requete = requete.on_conflict_do_update(
+        index_elements=['nature', 'objet_id'],
+        set_={
+            'action': requete.excluded.action,
+            'donnees': requete.excluded.donnees,
+            # En cours d'envoi : le thread voit la nouvelle version en terminant et remet l'opération en attente
+            'statut': db.case((table.c.statut == 'en_cours', 'en_cours'), else_='en_attente'),
+            'version': table.c.version + 1,
+            'tentatives': 0,
+            'prochain_essai': maintenant,
+            'derniere_erreur': None,
+            'synchro_id': db.case(
+                (table.c.statut.in_(['en_attente', 'en_cours']) & table.c.synchro_id.is_(None), db.null()),
+                else_=requete.excluded.synchro_id
+            ),
+        }
+    )
+    db.session.execute(requete)
+    if detacher:
+        db.session.execute(table.update().where(
+            table.c.nature == nature, table.c.objet_id == objet_id
+        ).values(objet_id=-table.c.id))
+    db.session.info['file_gcal_modifiee'] = True
+
+
+def planifier_suppression_prestation_gcal(prestation):
+    """Suppression des événements Google d'une prestation : la liste est relevée avant que la prestation disparaisse"""
+    planifier_sync_gcal('prestation', prestation.id, 'delete', evenements_gcal_prestation(prestation))
+
+
+@sa_event.listens_for(SaSession, 'after_commit')
+def _reveiller_file_gcal(session):
+    """Opérations validées : les threads de la file n'attendent pas leur prochain passage"""
+    if session.info.pop('file_gcal_modifiee', False):
+        _file_gcal_reveil.set()
+
+
+@sa_event.listens_for(SaSession, 'after_rollback')
+def _oublier_file_gcal(session):
+    """Transaction annulée : les opérations planifiées le sont aussi"""
+    session.info.pop('file_gcal_modifiee', None)
+
+
+def supprimer_evenements_gcal(service, evenements):
+    """Supprime en lot des événements [calendar_id, event_id] ; lève la première erreur (déjà absent = succès)"""
+    resultats = appliquer_operations_gcal(service, [
+        (numero, 'delete', calendar_id, event_id, None)
+        for numero, (calendar_id, event_id) in enumerate(evenements)
+    ])
+    erreurs = [erreur for _, erreur in resultats.values() if erreur is not None]
+    if erreurs:
+        raise erreurs[0]
+
+
+def corps_evenement_indisponibilite(indispo):
+    """Événement Google Calendar d'une indisponibilité (journées entières)"""
+    return {
+        'summary': f'🚫 INDISPONIBLE - {indispo.motif}',
+        'description': indispo.note or f'Indisponibilité : {indispo.motif}',
+        'start': {
+            'date': indispo.date_debut.strftime('%Y-%m-%d'),
+        },
+        'end': {
+            'date': (indispo.date_fin + timedelta(days=1)).strftime('%Y-%m-%d'),
+        },
+        'transparency': 'opaque',
+        'colorId': '11',
+    }
+
+
+def synchroniser_indisponibilite_gcal(service, indispo):
+    """Crée ou met à jour l'événement de l'indisponibilité sur le calendrier principal"""
+    action = 'patch' if indispo.gcal_event_id else 'insert'
+    event_id, erreur = appliquer_operations_gcal(service, [
+        ('indisponibilite', action, 'primary', indispo.gcal_event_id, corps_evenement_indisponibilite(indispo))
+    ])['indisponibilite']
+    if erreur is not None:
+        raise erreur
+    evenements = json.loads(indispo.gcal_events or '{}')
+    evenements['primary'] = event_id
+    indispo.gcal_events = json.dumps(evenements)
+    db.session.commit()
+
+
+def executer_operation_gcal(operation):
+    """Exécute une opération de la file ; toute exception la fait retenter plus tard"""
+    objet = db.session.get(Prestation if operation.nature == 'prestation' else Indisponibilite, operation.objet_id)
+    if objet is None and not json.loads(operation.donnees or '[]'):
+        return  # Objet supprimé sans événement Google, ou création annulée avant envoi
+
+    service = get_calendar_service()
+    if not service:
+        raise RuntimeError("Service Google Calendar non disponible (authentification requise ?)")
+
+    if operation.nature == 'prestation':
+        prestation = objet
+        if operation.action == 'upsert':
+            if prestation is None:
+                return  # Supprimée entre-temps sans passer par la file : rien à envoyer
+            success, message, event_id = sync_prestation_to_gcal(operation.objet_id)
+            if not success:
+                raise RuntimeError(message)
+        elif prestation is not None:
+            # Prestation conservée (ex: annulée) : suppression complète, état de synchronisation remis à zéro
+            success, message = delete_gcal_event(operation.objet_id)
+            if not success:
+                raise RuntimeError(message)
+            # Restes éventuels (événement principal déjà absent de Google) : aucun appel s'il n'y a rien
+            supprimer_blocages_gcal(service, prestation.gcal_blocages)
+            supprimer_evenements_sessions_gcal(service, prestation, calendrier_gcal_prestation(prestation))
+            db.session.commit()
+        else:
+            supprimer_evenements_gcal(service, json.loads(operation.donnees or '[]'))
+            GcalEvenementSupprime.query.filter_by(prestation_id=operation.objet_id).delete()
+            db.session.commit()
+
+    elif operation.nature == 'indisponibilite':
+        indispo = objet
+        if operation.action == 'upsert':
+            if indispo is not None:
+                synchroniser_indisponibilite_gcal(service, indispo)
+        else:
+            supprimer_evenements_gcal(service, json.loads(operation.donnees or '[]'))
+
+
+def _operation_gcal_due(table, maintenant):
+    """Opération à traiter : en attente et due, ou réservée par un thread qui ne répond plus"""
+    perime = maintenant - timedelta(seconds=app.config['GCAL_FILE_VERROU'])
+    return db.or_(
+        db.and_(table.c.statut == 'en_attente', table.c.prochain_essai <= maintenant),
+        db.and_(table.c.statut == 'en_cours', table.c.verrouille_le < perime)
+    )
+
+
+@reessayer_si_verrouille
+def reserver_operation_gcal():
+    """
+    Réserve la prochaine opération due (UPDATE conditionnel : un seul thread l'obtient, même entre processus),
+    celles d'une synchronisation globale passent après les modifications faites dans l'application
+    Retourne (id, version) ou None si rien n'est dû
+    """
+    table = GcalFileAttente.__table__
+    maintenant = datetime.utcnow()
+    candidats = db.session.execute(
+        db.select(table.c.id, table.c.version)
+        .where(_operation_gcal_due(table, maintenant))
+        .order_by(table.c.synchro_id.isnot(None), table.c.prochain_essai)  # Modifications des utilisateurs d'abord
+        .limit(5)
+    ).all()
+    for operation_id, version in candidats:
+        resultat = db.session.execute(
+            table.update()
+            .where(table.c.id == operation_id, table.c.version == version, _operation_gcal_due(table, maintenant))
+            .values(statut='en_cours', verrouille_le=maintenant)
+        )
+        db.session.commit()
+        if resultat.rowcount:
+            return operation_id, version
+    return None
+
+
+@reessayer_si_verrouille
+def terminer_operation_gcal(operation_id, version, erreur=None):
+    """
+    Enregistre le résultat d'une opération réservée. Objet modifié pendant l'envoi (version changée) :
+    l'opération repart aussitôt avec la nouvelle version. Échec : nouvel essai différé, abandon après GCAL_FILE_TENTATIVES
+    """
+    table = GcalFileAttente.__table__
+    maintenant = datetime.utcnow()
+    operation = db.session.execute(
+        db.select(table.c.version, table.c.tentatives, table.c.nature, table.c.objet_id).where(table.c.id == operation_id)
+    ).first()
+    if operation is None:
+        return
+    valeurs = {'verrouille_le': None, 'date_maj': maintenant}
+    if operation.version != version:
+        valeurs.update(statut='en_attente', prochain_essai=maintenant)
+    elif erreur is None:
+        valeurs.update(statut='ok', tentatives=0, derniere_erreur=None)
+    else:
+        tentatives = operation.tentatives + 1
+        delai = min(app.config['GCAL_FILE_DELAI'] * 2 ** (tentatives - 1), app.config['GCAL_FILE_DELAI_MAX'])
+        valeurs.update(
+            statut='erreur' if tentatives >= app.config['GCAL_FILE_TENTATIVES'] else 'en_attente',
+            tentatives=tentatives,
+            prochain_essai=maintenant + timedelta(seconds=delai),
+            derniere_erreur=str(erreur)[:1000]
+        )
+    # La condition sur la version évite d'écraser une modification arrivée entre la lecture et l'écriture
+    resultat = db.session.execute(table.update().where(table.c.id == operation_id, table.c.version == operation.version).values(**valeurs))
+    if resultat.rowcount and operation.version == version and operation.nature == 'prestation':
+        noter_element_synchro(operation.objet_id, valeurs)
+    db.session.commit()
+    if not resultat.rowcount:
+        db.session.execute(table.update().where(table.c.id == operation_id).values(statut='en_attente', verrouille_le=None, prochain_essai=maintenant))
+        db.session.commit()
+
+
+def traiter_operation_gcal():
+    """Traite une opération de la file. Retourne False si rien n'était dû"""
+    reservation = reserver_operation_gcal()
+    if reservation is None:
+        return False
+    operation_id, version = reservation
+    operation = db.session.get(GcalFileAttente, operation_id)
+    erreur = None
+    try:
+        executer_operation_gcal(operation)
+    except Exception as e:
+        db.session.rollback()
+        erreur = e
+        print(f"⚠️ Google Calendar ({operation.nature} {operation.objet_id}, {operation.action}) : {e}")
+    terminer_operation_gcal(operation_id, version, erreur)
+    return True
+
+
+def _boucle_file_gcal():
+    """Thread de fond : vide la file, puis attend un commit qui la remplit (ou GCAL_FILE_INTERVALLE)"""
+    while not _file_gcal_arret.is_set():
+        traitee = False
+        try:
+            with app.app_context():
+                traitee = traiter_operation_gcal()
+                db.session.remove()
+        except Exception as e:
+            print(f"⚠️ Erreur file Google Calendar : {e}")
+        if not traitee and _file_gcal_reveil.wait(app.config['GCAL_FILE_INTERVALLE']):
+            _file_gcal_reveil.clear()
+
+
+def demarrer_file_gcal():
+    """Démarre les threads de la file Google Calendar (une seule fois par processus)"""
+    if not GOOGLE_CALENDAR_AVAILABLE:
+        return []
+    threads = []
+    for numero in range(app.config['GCAL_FILE_THREADS']):
+        thread = threading.Thread(target=_boucle_file_gcal, name=f'file-gcal-{numero + 1}', daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def stats_file_gcal():
+    """Nombre d'opérations par statut et dernières erreurs (page diagnostics)"""
+    compteurs = dict(db.session.query(GcalFileAttente.statut, func.count(GcalFileAttente.id)).group_by(GcalFileAttente.statut).all())
+    erreurs = GcalFileAttente.query.filter(GcalFileAttente.derniere_erreur.isnot(None)).order_by(GcalFileAttente.date_maj.desc()).limit(5).all()
+    return {'compteurs': compteurs, 'erreurs': erreurs, 'threads': app.config['GCAL_FILE_THREADS'],
+            'refus_quota': _gcal_quota['refus'], 'pause_quota': round(_gcal_quota['pause'], 1)}
+
+
+# ============================================================================
+# SYNCHRONISATION GLOBALE GOOGLE CALENDAR - tâche de fond reprise après redémarrage
+# ============================================================================
+
+STATUTS_SYNCHRO_GLOBALE = ['Planifiée', 'En cours']
+
+# Durée d'une connexion au flux de progression (secondes) avant reconnexion automatique du navigateur.
+# 0 : un seul message par connexion (conseillé avec un seul worker gunicorn synchrone, qu'un flux ouvert bloquerait)
+app.config.setdefault('GCAL_SYNC_FLUX_DUREE', int(os.environ.get('GCAL_SYNC_FLUX_DUREE', 0)))
+app.config.setdefault('GCAL_SYNC_FLUX_RECONNEXION_MS', 2000)
+
+
+def lancer_synchro_globale():
+    """
+    Planifie la synchronisation de toutes les prestations planifiées ou en cours (une opération de file chacune)
+    Une synchronisation déjà en cours est réutilisée. Chaque opération terminée sert de point de reprise :
+    après un redémarrage, les threads de la file reprennent là où ils en étaient
+    """
+    synchro = GcalSynchroGlobale.query.filter_by(statut='en_cours').first()
+    if synchro and avancement_synchro(synchro)['statut'] == 'en_cours':
+        return synchro
+
+    synchro = GcalSynchroGlobale(statut='en_cours')
+    db.session.add(synchro)
+    db.session.flush()
+    ids = [prestation_id for (prestation_id,) in db.session.query(Prestation.id).filter(
+        Prestation.statut.in_(STATUTS_SYNCHRO_GLOBALE)
+    ).order_by(Prestation.date_debut)]
+    for prestation_id in ids:
+        planifier_sync_gcal('prestation', prestation_id, synchro_id=synchro.id)
+    if ids:
+        db.session.execute(GcalSynchroElement.__table__.insert(), [
+            {'synchro_id': synchro.id, 'prestation_id': prestation_id, 'statut': 'en_attente',
+             'tentatives': 0, 'date_maj': synchro.date_debut} for prestation_id in ids
+        ])
+    synchro.total = len(ids)
+    db.session.commit()
+    return synchro
+
+
+def noter_element_synchro(prestation_id, valeurs):
+    """
+    Reporte le résultat d'une opération de la file sur la prestation dans les synchronisations globales en cours
+    (sans commit) : réussite, abandon, ou dernière erreur si un nouvel essai est prévu
+    """
+    table = GcalSynchroElement.__table__
+    resultat = {'date_maj': valeurs['date_maj']}
+    if valeurs['statut'] == 'ok':
+        resultat.update(statut='ok', derniere_erreur=None)
+    elif 'derniere_erreur' in valeurs:
+        resultat.update(statut=valeurs['statut'] if valeurs['statut'] == 'erreur' else 'en_attente',
+                        tentatives=valeurs['tentatives'], derniere_erreur=valeurs['derniere_erreur'])
+    else:
+        return
+    db.session.execute(table.update().where(
+        table.c.prestation_id == prestation_id, table.c.statut == 'en_attente'
+    ).values(**resultat))
+
+
+def avancement_synchro(synchro):
+    """Compteurs d'une synchronisation globale (terminée quand plus aucune prestation n'est en attente)"""
+    elements = GcalSynchroElement.__table__
+    if synchro.statut == 'en_cours':
+        # Prestation supprimée pendant la synchronisation : plus rien à envoyer
+        db.session.execute(elements.update().where(
+            elements.c.synchro_id == synchro.id, elements.c.statut == 'en_attente',
+            ~elements.c.prestation_id.in_(db.select(Prestation.id))
+        ).values(statut='ok', date_maj=datetime.utcnow()))
+
+    compteurs = dict(db.session.query(GcalSynchroElement.statut, func.count(GcalSynchroElement.id)).filter(
+        GcalSynchroElement.synchro_id == synchro.id
+    ).group_by(GcalSynchroElement.statut).all())
+    en_cours = db.session.query(func.count(GcalSynchroElement.id)).join(
+        GcalFileAttente, db.and_(GcalFileAttente.nature == 'prestation',
+                                 GcalFileAttente.objet_id == GcalSynchroElement.prestation_id)
+    ).filter(
+        GcalSynchroElement.synchro_id == synchro.id,
+        GcalSynchroElement.statut == 'en_attente',
+        GcalFileAttente.statut == 'en_cours'
+    ).scalar()
+    if synchro.statut == 'en_cours' and not compteurs.get('en_attente', 0):
+        synchro.statut = 'terminee'
+        synchro.date_fin = datetime.utcnow()
+    db.session.commit()
+
+    erreurs = GcalSynchroElement.query.filter(
+        GcalSynchroElement.synchro_id == synchro.id,
+        GcalSynchroElement.derniere_erreur.isnot(None)
+    ).order_by(GcalSynchroElement.date_maj.desc()).limit(5).all()
+    traitees = compteurs.get('ok', 0) + compteurs.get('erreur', 0)
+    return {
+        'id': synchro.id,
+        'statut': synchro.statut,
+        'total': synchro.total,
+        'ok': compteurs.get('ok', 0),
+        'erreur': compteurs.get('erreur', 0),
+        'en_attente': compteurs.get('en_attente', 0) - en_cours,
+        'en_cours': en_cours,
+        'pourcentage': round(100 * traitees / synchro.total) if synchro.total else 100,
+        'pause_quota': round(_gcal_quota['pause'], 1),
+        'erreurs': [{'prestation_id': element.prestation_id, 'tentatives': element.tentatives,
+                     'message': element.derniere_erreur} for element in erreurs],
+    }
+
+
+
+
 # ============================================================================
 # ROUTES OAUTH GOOGLE CALENDAR (pour le web)
 # ============================================================================
@@ -5239,6 +8309,7 @@ def oauth2callback():
         token_path = '/tmp/token.json' if os.environ.get('RENDER') else 'token.json'
         with open(token_path, 'w') as token:
             token.write(creds.to_json())
+        reinitialiser_client_calendrier()
         
         flash('✅ Authentification Google Calendar réussie !', 'success')
         return redirect(url_for('gcal_config'))
@@ -5322,14 +8393,8 @@ def gcal_config():
 
         return redirect(url_for('gcal_config'))
 
-    # Récupérer les calendriers disponibles
-    calendars = []
-    try:
-        service = get_calendar_service()
-        if service:
-            calendars = get_filtered_calendars(service)
-    except Exception as e:
-        flash(f'⚠️ Erreur lors de la récupération des calendriers: {str(e)}', 'warning')
+    # Calendriers disponibles (cache calendrier_config, obtenu tout de suite à la première visite)
+    calendars = calendriers_google(bloquant=True)
 
     # Charger la configuration actuelle
     config = CalendrierConfig.query.first()
@@ -5340,36 +8405,61 @@ def gcal_config():
         except:
             pass
 
-    return render_template('gcal_config.html', calendars=calendars, current_config=current_config)
+    return render_template('gcal_config.html', calendars=calendars, current_config=current_config,
+                           calendriers_maj=config.calendriers_maj if config else None)
+
+
+@app.route('/gcal/calendriers/rafraichir', methods=['POST'])
+def gcal_rafraichir_calendriers():
+    """Relire tout de suite la liste des calendriers chez Google"""
+    calendriers = rafraichir_calendriers(forcer=True)
+    if calendriers is None:
+        flash('❌ Google Calendar indisponible : liste des calendriers inchangée', 'error')
+    else:
+        flash(f'✓ {len(calendriers)} calendrier(s) trouvé(s)', 'success')
+    return redirect(request.referrer or url_for('gcal_config'))
 
 
 @app.route('/gcal/sync-all', methods=['POST'])
 def gcal_sync_all():
-    """Synchroniser toutes les prestations planifiées vers Google Calendar"""
+    """Synchroniser toutes les prestations planifiées vers Google Calendar (en tâche de fond)"""
     if not GOOGLE_CALENDAR_AVAILABLE:
         flash('❌ Modules Google Calendar non installés', 'error')
         return redirect(url_for('index'))
 
-    prestations = Prestation.query.filter(
-        Prestation.statut.in_(['Planifiée', 'En cours'])
-    ).all()
+    synchro = lancer_synchro_globale()
+    return redirect(url_for('gcal_sync_all_suivi', synchro_id=synchro.id))
 
-    success_count = 0
-    error_count = 0
 
-    for prestation in prestations:
-        success, message, event_id = sync_prestation_to_gcal(prestation.id)
-        if success:
-            success_count += 1
-        else:
-            error_count += 1
+@app.route('/gcal/sync-all/<int:synchro_id>')
+def gcal_sync_all_suivi(synchro_id):
+    """Page de suivi d'une synchronisation globale (progression reçue par server-sent events)"""
+    synchro = GcalSynchroGlobale.query.get_or_404(synchro_id)
+    return render_template('gcal_sync_progression.html', synchro=synchro, avancement=avancement_synchro(synchro))
 
-    if error_count == 0:
-        flash(f'✓ {success_count} prestation(s) synchronisée(s) avec Google Calendar', 'success')
-    else:
-        flash(f'⚠️ {success_count} succès, {error_count} erreur(s)', 'warning')
 
-    return redirect(url_for('prestations'))
+@app.route('/gcal/sync-all/<int:synchro_id>/progression')
+def gcal_sync_all_progression(synchro_id):
+    """Flux server-sent events : un message à chaque changement de la progression"""
+    GcalSynchroGlobale.query.get_or_404(synchro_id)
+    duree = app.config['GCAL_SYNC_FLUX_DUREE']
+
+    def flux():
+        fin = time.monotonic() + duree
+        dernier = None
+        yield f"retry: {app.config['GCAL_SYNC_FLUX_RECONNEXION_MS']}\n\n"
+        while True:
+            avancement = avancement_synchro(db.session.get(GcalSynchroGlobale, synchro_id))
+            db.session.rollback()  # Termine la lecture : la suivante voit les opérations traitées entre-temps
+            if avancement != dernier:
+                yield f"data: {json.dumps(avancement)}\n\n"
+                dernier = avancement
+            if avancement['statut'] != 'en_cours' or time.monotonic() >= fin:
+                break
+            time.sleep(1)
+
+    return app.response_class(stream_with_context(flux()), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/quitter', methods=['POST'])
@@ -5393,7 +8483,7 @@ def quitter():
             # Copier la base de données locale
             db_source = os.path.join(os.getcwd(), 'instance', 'gestion_entreprise.db')
             if os.path.exists(db_source):
-                shutil.copy2(db_source, chemin_local)
+                copier_base_sqlite(db_source, chemin_local)
                 taille = os.path.getsize(chemin_local)
 
                 # Tenter la copie vers Google Drive
@@ -5441,6 +8531,275 @@ def quitter():
     })
 
 
+# ============================================================================
+# DIAGNOSTICS BASE DE DONNÉES (profil SQLite, balayage)
+# ============================================================================
+
+@app.errorhandler(OperationalError)
+def gerer_base_verrouillee(e):
+    """Base verrouillée malgré busy_timeout : réponse 503 au lieu d'une erreur 500"""
+    if not est_erreur_verrou(e):
+        raise e
+    db.session.rollback()
+    message = 'Base de données occupée, veuillez réessayer dans quelques secondes.'
+    if request.is_json or request.headers.get('Accept') == 'application/json':
+        reponse = jsonify({'success': False, 'message': message})
+    else:
+        reponse = app.response_class(message, mimetype='text/plain')
+    reponse.status_code = 503
+    reponse.headers['Retry-After'] = '2'
+    return reponse
+
+
+def lire_pragmas_actifs():
+    """Lit les valeurs PRAGMA réellement actives sur une connexion du pool"""
+    actifs = {}
+    if db.engine.dialect.name != 'sqlite':
+        return actifs
+    with db.engine.connect() as conn:
+        for pragma in app.config['SQLITE_PRAGMAS']:
+            actifs[pragma] = conn.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+    return actifs
+
+
+@app.route('/diagnostics')
+@login_required
+def diagnostics():
+    """Page de diagnostic : profil SQLite actif, balayage des statuts et cache de géocodage"""
+    noms_temp_store = {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}
+    noms_synchronous = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+
+    pragmas = []
+    try:
+        actifs = lire_pragmas_actifs()
+    except Exception as e:
+        actifs = {}
+        flash(f'⚠️ Lecture des PRAGMA impossible : {str(e)}', 'warning')
+
+    for pragma, configure in app.config['SQLITE_PRAGMAS'].items():
+        actif = actifs.get(pragma)
+        if pragma == 'temp_store':
+            actif = noms_temp_store.get(actif, actif)
+        elif pragma == 'synchronous':
+            actif = noms_synchronous.get(actif, actif)
+        pragmas.append({
+            'nom': pragma,
+            'configure': configure,
+            'actif': actif,
+            'conforme': str(actif).lower() == str(configure).lower()
+        })
+
+    return render_template('diagnostics.html',
+                         pragmas=pragmas,
+                         url_base=db.engine.url.render_as_string(hide_password=True),
+                         reessais_verrou=app.config['SQLITE_REESSAIS_VERROU'],
+                         balayage=balayage_statuts_info,
+                         balayage_intervalle=app.config['BALAYAGE_STATUTS_INTERVALLE'],
+                         geocodage=stats_geocodage(),
+                         referentiel=stats_referentiel(),
+                         overpass=stats_overpass(),
+                         http=stats_http(),
+                         file_gcal=stats_file_gcal(),
+                         overpass_jours=app.config['OVERPASS_CACHE_JOURS'],
+                         overpass_max_mo=app.config['OVERPASS_CACHE_MAX_OCTETS'] // (1024 * 1024),
+                         overpass_elements_max=app.config['OVERPASS_ELEMENTS_MAX'],
+                         geocodage_jours=app.config['GEOCODAGE_CACHE_JOURS'])
+
+
+# ============================================================================
+# COLONNES AJOUTÉES AUX MODÈLES (bases existantes)
+# ============================================================================
+
+def migrer_colonnes():
+    """
+    Ajoute aux tables existantes les colonnes déclarées sur les modèles mais absentes en base
+    (db.create_all() ne modifie pas les tables déjà créées). Colonnes ajoutées sans valeur. Idempotent.
+    Retourne la liste des colonnes ajoutées ("table.colonne")
+    """
+    from sqlalchemy import inspect
+
+    inspecteur = inspect(db.engine)
+    tables_existantes = set(inspecteur.get_table_names())
+    colonnes_ajoutees = []
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables_existantes:
+                continue
+            existantes = {colonne['name'] for colonne in inspecteur.get_columns(table.name)}
+            for colonne in table.columns:
+                if colonne.name in existantes or colonne.primary_key or not colonne.nullable:
+                    continue
+                type_sql = colonne.type.compile(dialect=conn.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{colonne.name}" {type_sql}')
+                colonnes_ajoutees.append(f"{table.name}.{colonne.name}")
+
+    if colonnes_ajoutees:
+        print(f"✅ {len(colonnes_ajoutees)} colonne(s) ajoutée(s) : {', '.join(colonnes_ajoutees)}")
+    return colonnes_ajoutees
+
+
+# ============================================================================
+# MIGRATION DES MONTANTS (REAL en euros -> INTEGER en centimes)
+# ============================================================================
+
+def migrer_montants_centimes():
+    """
+    Convertit les colonnes de montants des bases existantes (REAL en euros) en centimes entiers.
+    SQLite ne sait pas changer le type d'une colonne : chaque table concernée est recréée
+    (nouvelle table, copie convertie, suppression de l'ancienne, renommage) dans une seule transaction.
+    Les colonnes présentes en base mais absentes du modèle sont conservées. Idempotent.
+    Retourne la liste des tables converties
+    """
+    from sqlalchemy.schema import CreateTable
+
+    tables_converties = []
+    with db.engine.begin() as conn:
+        # pysqlite n'ouvre pas de transaction avant un CREATE TABLE : on la démarre nous-mêmes
+        # (IMMEDIATE : un seul processus gunicorn fait la migration, les autres attendent puis ne trouvent plus rien)
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+        for table in db.metadata.sorted_tables:
+            montants = {colonne.name for colonne in table.columns if isinstance(colonne.type, Montant)}
+            if not montants:
+                continue
+            colonnes_base = {ligne[1]: (ligne[2] or '') for ligne in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+            a_convertir = {nom for nom in montants if nom in colonnes_base and colonnes_base[nom].upper() != 'INTEGER'}
+            if not a_convertir:
+                continue
+
+            # Même DDL que le modèle (clés étrangères comprises), sous un nom temporaire
+            temporaire = f'{table.name}__centimes'
+            ddl = str(CreateTable(table).compile(dialect=conn.dialect)).replace(
+                f'CREATE TABLE {conn.dialect.identifier_preparer.format_table(table)} ', f'CREATE TABLE "{temporaire}" ', 1
+            )
+            conn.exec_driver_sql(ddl)
+            for nom, type_sql in colonnes_base.items():
+                if nom not in table.columns:
+                    conn.exec_driver_sql(f'ALTER TABLE "{temporaire}" ADD COLUMN "{nom}" {type_sql}')
+
+            colonnes = ', '.join(f'"{nom}"' for nom in colonnes_base)
+            selection = ', '.join(
+                f'CAST(ROUND("{nom}" * 100) AS INTEGER)' if nom in a_convertir else f'"{nom}"'
+                for nom in colonnes_base
+            )
+            conn.exec_driver_sql(f'INSERT INTO "{temporaire}" ({colonnes}) SELECT {selection} FROM "{table.name}"')
+            conn.exec_driver_sql(f'DROP TABLE "{table.name}"')
+            conn.exec_driver_sql(f'ALTER TABLE "{temporaire}" RENAME TO "{table.name}"')
+            for index in table.indexes:
+                index.create(bind=conn)
+            tables_converties.append(table.name)
+
+    if tables_converties:
+        print(f"✅ Montants convertis en centimes : {', '.join(tables_converties)}")
+    return tables_converties
+
+
+# ============================================================================
+# INDEX DE LA BASE DE DONNÉES (migration + vérification des plans de requête)
+# ============================================================================
+
+def migrer_index():
+    """
+    Ajoute les index déclarés sur les modèles aux bases existantes
+    (db.create_all() ne les crée que pour les nouvelles tables). Idempotent.
+    Retourne la liste des index créés
+    """
+    from sqlalchemy import inspect
+
+    inspecteur = inspect(db.engine)
+    tables_existantes = set(inspecteur.get_table_names())
+    index_crees = []
+    # Noms lus dans sqlite_master : la réflexion SQLAlchemy ignore les index sur expression (coalesce(...))
+    with db.engine.connect() as conn:
+        index_existants = {nom for (nom,) in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables_existantes:
+            continue
+        for index in table.indexes:
+            if index.name in index_existants:
+                continue
+            try:
+                index.create(bind=db.engine)
+                index_crees.append(index.name)
+            except Exception as e:
+                # Ancienne base sans la colonne indexée : on ignore cet index
+                print(f"⚠️ Index {index.name} non créé : {e}")
+
+    if index_crees:
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('ANALYZE')
+        print(f"✅ {len(index_crees)} index ajouté(s) : {', '.join(index_crees)}")
+
+    return index_crees
+
+
+def requetes_chaudes():
+    """Requêtes représentatives des routes les plus consultées (pour EXPLAIN QUERY PLAN)"""
+    maintenant = datetime.now()
+    aujourd_hui = maintenant.date()
+    debut_annee = datetime(maintenant.year, 1, 1)
+    debut_fenetre, fin_fenetre = maintenant - timedelta(days=31), maintenant + timedelta(days=93)  # Fenêtre par défaut du calendrier
+
+    return [
+        ('Tableau de bord - prestations de l\'année', Prestation.query.filter(
+            Prestation.date_debut >= debut_annee,
+            Prestation.date_debut < datetime(maintenant.year + 1, 1, 1))),
+        ('Tableau de bord - prestations en cours', Prestation.query.filter_by(statut='En cours')),
+        ('Balayage des statuts', Prestation.query.filter(
+            Prestation.statut.in_(STATUTS_A_TERMINER), Prestation.date_fin < maintenant)),
+        ('Badges - tâches urgentes', Prestation.query.filter(
+            Prestation.date_echeance_tache < maintenant + timedelta(days=8))),
+        ('Badges - paiements en retard', Paiement.query.filter(
+            Paiement.statut.in_(['En attente', 'Partiel']), Paiement.date_butoir < aujourd_hui)),
+        ('Badges - paiement complet d\'une facture', Paiement.query.filter_by(facture_id=1, statut='Payé')),
+        ('Factures en cours', Facture.query.filter(Facture.date_envoi.isnot(None))),
+        ('Détail client - prestations', Prestation.query.filter_by(client_id=1).order_by(Prestation.date_debut.desc())),
+        ('Saisie facture - facture de la prestation', Facture.query.filter_by(prestation_id=1)),
+        ('Calendrier - sessions d\'une prestation', SessionPrestation.query.filter_by(prestation_id=1)),
+        ('Calendrier - sessions de la fenêtre', db.session.query(SessionPrestation.prestation_id).filter(chevauche_fenetre(
+            SessionPrestation.date_debut, SessionPrestation.date_fin, debut_fenetre, fin_fenetre))),
+        ('Calendrier - prestations sans session de la fenêtre', Prestation.query.filter(
+            ~Prestation.sessions.any(),
+            chevauche_fenetre(Prestation.date_debut, Prestation.date_fin, debut_fenetre, fin_fenetre))),
+        ('Notifications - rappel déjà envoyé', Notification.query.filter_by(
+            type_notif='rappel_prestation', prestation_id=1, statut='sent')),
+        ('Facture - toutes les lignes', LigneDocument.query.filter_by(
+            nature_document='facture', document_id=1).order_by(LigneDocument.section, LigneDocument.id)),
+    ]
+
+
+def expliquer_requetes_chaudes():
+    """
+    Exécute EXPLAIN QUERY PLAN sur chaque requête chaude
+    Retourne une liste de (nom, [lignes du plan], utilise_index: bool)
+    (sur une base presque vide, SQLite peut préférer un SCAN à l'index)
+    """
+    from sqlalchemy import text
+    from sqlalchemy.dialects import sqlite
+
+    dialecte = sqlite.dialect(paramstyle='named')
+    resultats = []
+    for nom, query in requetes_chaudes():
+        compiled = query.statement.compile(dialect=dialecte, compile_kwargs={'render_postcompile': True})
+        lignes = db.session.execute(text('EXPLAIN QUERY PLAN ' + str(compiled)), compiled.params).fetchall()
+        plan = [ligne[-1] for ligne in lignes]
+        utilise_index = any('USING' in etape for etape in plan)
+        resultats.append((nom, plan, utilise_index))
+    return resultats
+
+
+@app.cli.command('verifier-index')
+def verifier_index_commande():
+    """Affiche le plan d'exécution (EXPLAIN QUERY PLAN) des requêtes chaudes"""
+    migrer_index()
+    for nom, plan, utilise_index in expliquer_requetes_chaudes():
+        print(f"{'✅' if utilise_index else '⚠️'} {nom}")
+        for etape in plan:
+            print(f"     {etape}")
+
+
 # ============================================================================
 # INITIALISATION
 # ============================================================================
@@ -5499,6 +8858,40 @@ with app.app_context():
             db.session.commit()
     except:
         pass
+
+    # Ajouter les colonnes puis les index aux bases existantes
+    try:
+        migrer_colonnes()
+    except Exception as e:
+        print(f"⚠️ Migration des colonnes : {e}")
+
+    try:
+        migrer_index()
+    except Exception as e:
+        print(f"⚠️ Migration des index : {e}")
+
+    # Montants en centimes puis lignes de documents (la seconde suppose la première faite)
+    try:
+        migrer_montants_centimes()
+        migrer_lignes_document()
+    except Exception as e:
+        print(f"⚠️ Migration des montants et des lignes de documents : {e}")
+
+    try:
+        initialiser_stats_mensuelles()
+    except Exception as e:
+        print(f"⚠️ Initialisation des statistiques mensuelles : {e}")
+
+    try:
+        initialiser_sequences()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ Initialisation des compteurs de numérotation : {e}")
+
+# Balayage périodique des statuts (les pages ne modifient plus la base en lecture)
+demarrer_balayage_statuts()
+demarrer_rafraichissement_calendriers()
+demarrer_file_gcal()
         
 
 if __name__ == '__main__':
@@ -5515,25 +8908,14 @@ def api_rechercher_lieu():
     if not query or len(query) < 3:
         return jsonify({'success': False, 'message': 'Requête trop courte'})
     
-    import requests
-    
+    # Référentiel hors ligne (adresses BAN + lieux OSM) avant Nominatim
+    locaux = rechercher_referentiel(query, limite=10)
+    if locaux:
+        return jsonify({'success': True, 'resultats': locaux})
+
     try:
-        # Recherche directe Nominatim
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {
-            'q': f"{query}, France",
-            'format': 'json',
-            'limit': 10,
-            'addressdetails': 1
-        }
-        headers = {'User-Agent': 'GestionEntreprise/1.0'}
-        
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        
-        if response.status_code != 200:
-            return jsonify({'success': False})
-        
-        data = response.json()
+        # Recherche directe Nominatim (via le cache de géocodage)
+        data = geocoder(f"{query}, France", limite=10, details=True)
         resultats = []
         
         for result in data:
@@ -5572,50 +8954,23 @@ def api_calcul_distance():
     if not depart or not arrivee:
         return jsonify({'success': False})
     
-    import requests
-    from math import radians, cos, sin, asin, sqrt
-    
     try:
-        headers = {'User-Agent': 'GestionEntreprise/1.0'}
-        
-        # Géocoder départ
-        url_dep = f"https://nominatim.openstreetmap.org/search?q={depart}&format=json&limit=1"
-        resp_dep = requests.get(url_dep, headers=headers, timeout=10)
-        data_dep = resp_dep.json()
-        
-        if not data_dep:
+        # Géocoder départ et arrivée (via le cache de géocodage)
+        point_dep = geocoder_point(depart)
+        if not point_dep:
             return jsonify({'success': False})
         
-        lat1 = float(data_dep[0]['lat'])
-        lon1 = float(data_dep[0]['lon'])
-        
-        # Géocoder arrivée
-        url_arr = f"https://nominatim.openstreetmap.org/search?q={arrivee}&format=json&limit=1"
-        resp_arr = requests.get(url_arr, headers=headers, timeout=10)
-        data_arr = resp_arr.json()
-        
-        if not data_arr:
+        point_arr = geocoder_point(arrivee)
+        if not point_arr:
             return jsonify({'success': False})
         
-        lat2 = float(data_arr[0]['lat'])
-        lon2 = float(data_arr[0]['lon'])
-        
-        # Haversine
-        def haversine(lon1, lat1, lon2, lat2):
-            lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-            dlon = lon2 - lon1
-            dlat = lat2 - lat1
-            a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-            c = 2 * asin(sqrt(a))
-            return c * 6371
-        
-        distance_km = round(haversine(lon1, lat1, lon2, lat2), 1)
-        duree_minutes = round((distance_km / 80) * 60)  # 80 km/h moyenne
+        # Trajet via le cache des distances (OSRM si configuré, sinon vol d'oiseau à vitesse moyenne)
+        trajet = calculer_trajet(point_dep, point_arr)
         
         return jsonify({
             'success': True,
-            'distance_km': distance_km,
-            'duree_minutes': duree_minutes
+            'distance_km': trajet['distance_km'],
+            'duree_minutes': trajet['duree_minutes']
         })
     
     except Exception as e:
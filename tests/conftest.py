@@ -0,0 +1,29 @@
+"""
+Configuration commune des tests : base SQLite temporaire, threads de fond désactivés
+Les variables d'environnement doivent être posées avant l'import de app.py
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_dossier = tempfile.mkdtemp(prefix='gestion_ets_tests_')
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + os.path.join(_dossier, 'tests.db'))
+os.environ.setdefault('REFERENTIEL_DB', os.path.join(_dossier, 'referentiel.db'))
+os.environ.setdefault('BALAYAGE_STATUTS_INTERVALLE', '0')
+os.environ.setdefault('GCAL_CALENDRIERS_INTERVALLE', '0')
+os.environ.setdefault('GCAL_FILE_THREADS', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as application  # noqa: E402
+
+
+@pytest.fixture
+def app_ctx():
+    """Contexte applicatif ; la session est annulée puis libérée après le test"""
+    with application.app.app_context():
+        yield application
+        application.db.session.rollback()
+        application.db.session.remove()
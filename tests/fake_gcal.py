@@ -0,0 +1,106 @@
+"""
+Faux serveur Google Calendar pour les tests : requêtes batch (multipart/mixed) sur /batch/calendar/v3
+Les événements sont gardés en mémoire ; des échecs peuvent être injectés sur les prochains appels
+"""
+import json
+import re
+import threading
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FauxGoogleCalendar:
+    """
+    Serveur HTTP local qui répond aux lots comme l'API Calendar v3 :
+    - POST .../events : création (identifiant du corps si fourni, 409 s'il existe déjà)
+    - PATCH .../events/<id> : modification (404 si absent)
+    - DELETE .../events/<id> : suppression (404 si absent)
+    echecs : liste de (statut, applique) consommée appel par appel ; applique=True exécute l'appel
+    avant de renvoyer l'erreur (réponse perdue alors que Google a agi)
+    """
+
+    def __init__(self):
+        self.evenements = {}  # event_id -> (calendar_id, corps)
+        self.lots = []  # Un élément par lot reçu : liste de (méthode, calendar_id)
+        self.echecs = []
+        self._lock = threading.Lock()
+        self._serveur = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._serveur.server_address[1]}/"
+
+    def demarrer(self):
+        faux = self
+
+        class Gestionnaire(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                corps = self.rfile.read(int(self.headers['Content-Length']))
+                reponse = faux._traiter_lot(self.headers['Content-Type'], corps)
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/mixed; boundary=LOT')
+                self.send_header('Content-Length', str(len(reponse)))
+                self.end_headers()
+                self.wfile.write(reponse)
+
+        self._serveur = ThreadingHTTPServer(('127.0.0.1', 0), Gestionnaire)
+        threading.Thread(target=self._serveur.serve_forever, daemon=True).start()
+        return self
+
+    def arreter(self):
+        self._serveur.shutdown()
+        self._serveur.server_close()
+
+    def _traiter_lot(self, content_type, corps):
+        message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + corps)
+        parties = []
+        appels = []
+        with self._lock:
+            for partie in message.get_payload():
+                contenu = partie.get_payload()
+                contenu = contenu if isinstance(contenu, str) else contenu.as_string()
+                entete, _, reste = contenu.partition('\n')
+                methode, chemin, _ = entete.strip().split(' ', 2)
+                donnees = re.split(r'\r?\n\r?\n', reste, maxsplit=1)[-1].strip()
+                calendar_id = re.search(r'/calendars/([^/]+)/events', chemin).group(1)
+                event_id = re.search(r'/events/([^/?]+)', chemin)
+                appels.append((methode, calendar_id))
+
+                statut, reponse = self._appliquer(methode, calendar_id, event_id and event_id.group(1),
+                                                  json.loads(donnees) if donnees else None)
+                parties.append(
+                    f"--LOT\r\nContent-Type: application/http\r\nContent-ID: <response-{partie['Content-ID'].strip('<>')}>\r\n\r\n"
+                    f"HTTP/1.1 {statut}\r\nContent-Type: application/json\r\n\r\n"
+                    f"{json.dumps(reponse) if reponse is not None else ''}\r\n"
+                )
+            self.lots.append(appels)
+        return (''.join(parties) + '--LOT--\r\n').encode()
+
+    def _appliquer(self, methode, calendar_id, event_id, corps):
+        echec = self.echecs.pop(0) if self.echecs else None
+        if echec and not echec[1]:
+            return echec[0], {'error': {'code': int(echec[0].split()[0])}}
+
+        if methode == 'POST':
+            event_id = corps.get('id') or uuid.uuid4().hex
+            if event_id in self.evenements:
+                resultat = '409 Conflict', {'error': {'code': 409, 'message': 'The requested identifier already exists.'}}
+            else:
+                self.evenements[event_id] = (calendar_id, dict(corps, id=event_id))
+                resultat = '200 OK', {'id': event_id}
+        elif event_id not in self.evenements:
+            resultat = '404 Not Found', {'error': {'code': 404}}
+        elif methode == 'PATCH':
+            self.evenements[event_id] = (calendar_id, dict(self.evenements[event_id][1], **corps))
+            resultat = '200 OK', {'id': event_id}
+        else:
+            del self.evenements[event_id]
+            resultat = '204 No Content', None
+
+        if echec:
+            return echec[0], {'error': {'code': int(echec[0].split()[0])}}
+        return resultat
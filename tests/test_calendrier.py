@@ -0,0 +1,77 @@
+"""
+Fenêtre du calendrier (evenements_calendrier) : chevauchement et index de la borne basse
+Liste des calendriers Google (rafraichir_calendriers) : un seul appel pour des rafraîchissements concurrents
+"""
+import threading
+import time
+from datetime import datetime
+
+
+def test_sessions_et_prestations_qui_chevauchent_la_fenetre(app_ctx):
+    application = app_ctx
+    client = application.Client(nom='ACME', entreprise='ACME')
+    application.db.session.add(client)
+    application.db.session.flush()
+
+    def prestation(titre, debut, fin, sessions=()):
+        ligne = application.Prestation(client_id=client.id, theme_prestation='Formation', titre=titre,
+                                       date_debut=debut, date_fin=fin)
+        application.db.session.add(ligne)
+        application.db.session.flush()
+        for ordre, (session_debut, session_fin) in enumerate(sessions):
+            application.db.session.add(application.SessionPrestation(
+                prestation_id=ligne.id, date_debut=session_debut, date_fin=session_fin, ordre=ordre))
+        return ligne
+
+    debut, fin = datetime(2030, 3, 1), datetime(2030, 4, 1)
+    prestation('Longue', datetime(2030, 2, 20), datetime(2030, 3, 5))  # Commencée avant la fenêtre
+    prestation('Terminée avant', datetime(2030, 1, 10), None)
+    prestation('Sessions', datetime(2030, 2, 1), datetime(2030, 3, 10),
+               [(datetime(2030, 2, 1), datetime(2030, 2, 2)), (datetime(2030, 2, 27), datetime(2030, 3, 2))])
+    application.db.session.flush()
+
+    titres = sorted(evenement['title'] for evenement in application.evenements_calendrier(debut, fin))
+    assert titres == ['ACME - Longue', 'ACME - Sessions (Session 2/2)']
+
+
+def test_borne_basse_servie_par_l_index_fin_effective(app_ctx):
+    plans = {nom: plan for nom, plan, _ in app_ctx.expliquer_requetes_chaudes()}
+
+    assert any('ix_sessions_prestation_fin_effective' in etape for etape in plans['Calendrier - sessions de la fenêtre'])
+    assert any('ix_prestations_fin_effective' in etape
+               for etape in plans['Calendrier - prestations sans session de la fenêtre'])
+
+
+def test_rafraichissements_concurrents_un_seul_appel_google(app_ctx, monkeypatch):
+    application = app_ctx
+    appels = []
+
+    def lister(service):
+        appels.append(service)
+        time.sleep(0.2)  # Laisse les autres threads attendre le verrou
+        return [{'id': 'agenda@example.com', 'summary': 'Agenda'}]
+
+    monkeypatch.setattr(application, 'get_calendar_service', lambda: 'service')
+    monkeypatch.setattr(application, '_lister_calendriers_filtres', lister)
+    application.CalendrierConfig.query.delete()
+    application.db.session.commit()
+
+    resultats = []
+
+    def rafraichir():
+        with application.app.app_context():
+            resultats.append(application.rafraichir_calendriers())
+            application.db.session.remove()
+
+    threads = [threading.Thread(target=rafraichir) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(appels) == 1
+    assert all(calendriers and calendriers[0]['id'] == 'agenda@example.com' for calendriers in resultats)
+
+    # Le rafraîchissement manuel passe outre une liste fraîche
+    application.rafraichir_calendriers(forcer=True)
+    assert len(appels) == 2
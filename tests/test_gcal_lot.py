@@ -0,0 +1,115 @@
+"""
+Écritures Google Calendar par lots (executer_lot_gcal, synchroniser_blocages_gcal) contre un faux serveur local
+"""
+from datetime import datetime
+
+import httplib2
+import pytest
+from googleapiclient.discovery import build_from_document
+
+from fake_gcal import FauxGoogleCalendar
+
+
+@pytest.fixture
+def faux_gcal(app_ctx):
+    """Faux serveur démarré, client Calendar dirigé vers lui via GCAL_API_URL"""
+    application = app_ctx
+    faux = FauxGoogleCalendar().demarrer()
+    config = application.app.config
+    anciens = {cle: config[cle] for cle in ('GCAL_API_URL', 'GCAL_LOT_REESSAI_DELAI', 'GCAL_QUOTA_PAUSE_MIN')}
+    config.update(GCAL_API_URL=faux.url, GCAL_LOT_REESSAI_DELAI=0, GCAL_QUOTA_PAUSE_MIN=0)
+    application._gcal_etat['document'] = None
+    application._gcal_quota.update(pause=0.0, reprise=0.0)
+    faux.service = build_from_document(application._document_calendrier(), http=httplib2.Http())
+    yield faux
+    config.update(anciens)
+    application._gcal_etat['document'] = None
+    faux.arreter()
+
+
+def evenement(titre):
+    return {
+        'summary': titre,
+        'start': {'dateTime': '2030-03-04T09:00:00', 'timeZone': 'Europe/Paris'},
+        'end': {'dateTime': '2030-03-04T12:00:00', 'timeZone': 'Europe/Paris'}
+    }
+
+
+def insertions(application, service, nombre, calendar_id='primary'):
+    return [(numero, application.requete_insertion_gcal(service, calendar_id, evenement(f"Événement {numero}")))
+            for numero in range(nombre)]
+
+
+def test_lot_decoupe_en_requetes_de_50(app_ctx, faux_gcal):
+    resultats = app_ctx.executer_lot_gcal(faux_gcal.service, insertions(app_ctx, faux_gcal.service, 120))
+
+    assert [len(lot) for lot in faux_gcal.lots] == [50, 50, 20]
+    assert list(resultats) == list(range(120))
+    assert all(erreur is None for _, erreur in resultats.values())
+    assert {reponse['id'] for reponse, _ in resultats.values()} == set(faux_gcal.evenements)
+
+
+def test_appels_en_echec_temporaire_rejoues(app_ctx, faux_gcal):
+    faux_gcal.echecs = [('503 Service Unavailable', False)]  # Seul le premier appel échoue
+    resultats = app_ctx.executer_lot_gcal(faux_gcal.service, insertions(app_ctx, faux_gcal.service, 3))
+
+    assert [len(lot) for lot in faux_gcal.lots] == [3, 1]
+    assert all(erreur is None for _, erreur in resultats.values())
+    assert len(faux_gcal.evenements) == 3
+
+
+def test_insertion_rejouee_sans_doublon(app_ctx, faux_gcal):
+    # Google a créé l'événement mais la réponse est perdue : le rejeu reçoit un 409, compté comme réussi
+    faux_gcal.echecs = [('503 Service Unavailable', True)]
+    resultats = app_ctx.executer_lot_gcal(faux_gcal.service, insertions(app_ctx, faux_gcal.service, 1))
+
+    reponse, erreur = resultats[0]
+    assert erreur is None
+    assert [len(lot) for lot in faux_gcal.lots] == [1, 1]
+    assert list(faux_gcal.evenements) == [reponse['id']]
+
+
+def test_insertion_sans_identifiant_non_rejouee(app_ctx, faux_gcal):
+    requete = faux_gcal.service.events().insert(calendarId='primary', body=evenement("Sans identifiant"))
+    faux_gcal.echecs = [('503 Service Unavailable', True)]
+    resultats = app_ctx.executer_lot_gcal(faux_gcal.service, [('seul', requete)])
+
+    assert app_ctx.statut_erreur_gcal(resultats['seul'][1]) == 503
+    assert len(faux_gcal.lots) == 1
+    assert len(faux_gcal.evenements) == 1
+
+
+def test_erreur_definitive_non_rejouee(app_ctx, faux_gcal):
+    faux_gcal.echecs = [('400 Bad Request', False)]
+    resultats = app_ctx.executer_lot_gcal(faux_gcal.service, insertions(app_ctx, faux_gcal.service, 2))
+
+    assert app_ctx.statut_erreur_gcal(resultats[0][1]) == 400
+    assert resultats[1][1] is None
+    assert len(faux_gcal.lots) == 1
+
+
+def test_blocages_associes_aux_evenements_crees(app_ctx, faux_gcal):
+    application = app_ctx
+    client = application.Client(nom='ACME', entreprise='ACME')
+    application.db.session.add(client)
+    application.db.session.flush()
+    prestation = application.Prestation(client_id=client.id, theme_prestation='Formation', titre='Formation',
+                                        date_debut=datetime(2030, 3, 4, 9), date_fin=datetime(2030, 3, 4, 12))
+    application.db.session.add(prestation)
+    application.db.session.flush()
+
+    evenements = [evenement('🚫 Indisponible'), dict(evenement('🚫 Indisponible'), description='Jour 2')]
+    calendriers = [('c2', 'Formations'), ('c3', 'Autre')]
+    assert application.synchroniser_blocages_gcal(faux_gcal.service, prestation.id, evenements, calendriers) == (4, 0)
+
+    blocages = application.GcalBlocage.query.filter_by(prestation_id=prestation.id).all()
+    assert len(faux_gcal.lots) == 1
+    assert sorted(blocage.calendar_id for blocage in blocages) == ['c2', 'c2', 'c3', 'c3']
+    for blocage in blocages:
+        calendar_id, corps = faux_gcal.evenements[blocage.event_id]
+        assert calendar_id == blocage.calendar_id
+        assert blocage.gcal_hash == application.empreinte_gcal({k: v for k, v in corps.items() if k != 'id'})
+
+    # Contenu inchangé : aucun appel
+    assert application.synchroniser_blocages_gcal(faux_gcal.service, prestation.id, evenements, calendriers) == (0, 0)
+    assert len(faux_gcal.lots) == 1
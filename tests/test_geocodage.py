@@ -0,0 +1,103 @@
+"""
+Cache de géocodage (geocoder) avec un transport bouchon à la place de Nominatim (GEOCODAGE_TRANSPORT)
+"""
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+
+class TransportBouchon:
+    """Transport (url, params, headers, timeout) -> JSON qui enregistre les appels ; lève `erreur` si fournie"""
+
+    def __init__(self):
+        self.appels = []
+        self.reponses = {}
+        self.erreur = None
+
+    def __call__(self, url, params, headers, timeout):
+        self.appels.append(params['q'])
+        if self.erreur is not None:
+            raise self.erreur
+        return self.reponses.get(params['q'], [])
+
+
+@pytest.fixture
+def transport(app_ctx):
+    application = app_ctx
+    bouchon = TransportBouchon()
+    application.app.config['GEOCODAGE_TRANSPORT'] = bouchon
+    application.purger_cache_geocodage(tout=True)
+    application.geocodage_compteurs.update(lru=0, base=0, reseau=0, erreurs=0)
+    yield bouchon
+    application.app.config['GEOCODAGE_TRANSPORT'] = None
+    application.purger_cache_geocodage(tout=True)
+
+
+def compteurs(application):
+    return {cle: application.geocodage_compteurs[cle] for cle in ('lru', 'base', 'reseau', 'erreurs')}
+
+
+def test_ordre_lru_puis_base_puis_reseau(app_ctx, transport):
+    transport.reponses['Carcassonne'] = [{'lat': '43.21', 'lon': '2.35'}]
+
+    assert app_ctx.geocoder_point('Carcassonne') == (43.21, 2.35)
+    assert compteurs(app_ctx) == {'lru': 0, 'base': 0, 'reseau': 1, 'erreurs': 0}
+
+    # Même requête normalisée : servie par le LRU, sans appel réseau
+    assert app_ctx.geocoder_point('  CARCASSONNE ') == (43.21, 2.35)
+    assert compteurs(app_ctx)['lru'] == 1
+
+    # LRU vidé (autre processus, redémarrage) : servie par la table geocode_cache, puis remise dans le LRU
+    app_ctx._geocodage_lru.clear()
+    assert app_ctx.geocoder_point('Carcassonne') == (43.21, 2.35)
+    assert app_ctx.geocoder_point('Carcassonne') == (43.21, 2.35)
+    assert compteurs(app_ctx) == {'lru': 2, 'base': 1, 'reseau': 1, 'erreurs': 0}
+    assert transport.appels == ['Carcassonne']
+
+
+def test_reponse_vide_gardee_en_cache(app_ctx, transport):
+    assert app_ctx.geocoder_point('Lieu inconnu') is None
+    assert app_ctx.geocoder_point('Lieu inconnu') is None
+    assert transport.appels == ['Lieu inconnu']
+
+
+def test_expiration_lru_et_base(app_ctx, transport):
+    transport.reponses['Narbonne'] = [{'lat': '43.18', 'lon': '3.00'}]
+    app_ctx.geocoder('Narbonne')
+    cle = next(iter(app_ctx._geocodage_lru))
+
+    # Entrée du LRU expirée : relue en base
+    app_ctx._geocodage_lru[cle] = (time.time() - 1, app_ctx._geocodage_lru[cle][1])
+    app_ctx.geocoder('Narbonne')
+    assert compteurs(app_ctx)['base'] == 1
+
+    # Ligne en base plus vieille que GEOCODAGE_CACHE_JOURS : redemandée au réseau
+    app_ctx._geocodage_lru.clear()
+    table = app_ctx.GeocodeCache.__table__
+    perimee = datetime.utcnow() - timedelta(days=app_ctx.app.config['GEOCODAGE_CACHE_JOURS'] + 1)
+    with app_ctx.db.engine.begin() as conn:
+        conn.execute(table.update().values(date_maj=perimee))
+    app_ctx.geocoder('Narbonne')
+    assert transport.appels == ['Narbonne', 'Narbonne']
+    assert compteurs(app_ctx)['reseau'] == 2
+
+    # Purge : seules les lignes expirées sont supprimées (la ligne vient d'être rafraîchie)
+    assert app_ctx.purger_cache_geocodage() == 0
+
+
+def test_erreur_reseau_comptee_et_non_cachee(app_ctx, transport):
+    transport.erreur = ConnectionError('Nominatim injoignable')
+    with pytest.raises(ConnectionError):
+        app_ctx.geocoder('Béziers')
+    assert compteurs(app_ctx) == {'lru': 0, 'base': 0, 'reseau': 0, 'erreurs': 1}
+
+    transport.erreur = None
+    transport.reponses['Béziers'] = [{'lat': '43.34', 'lon': '3.21'}]
+    assert app_ctx.geocoder_point('Béziers') == (43.34, 3.21)
+    assert transport.appels == ['Béziers', 'Béziers']
+    assert compteurs(app_ctx)['reseau'] == 1
+
+    stats = app_ctx.stats_geocodage()
+    assert stats['taille_base'] == 1
+    assert stats['taux_succes'] == 0.0
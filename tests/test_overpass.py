@@ -0,0 +1,82 @@
+"""
+Cache Overpass par tuiles geohash (elements_overpass) avec un faux Overpass à la place du réseau
+"""
+import re
+import time
+
+import pytest
+import requests
+
+CENTRE = (43.2130, 2.3491)
+
+
+class OverpassBouchon:
+    """Remplace _appeler_overpass : pour chaque tuile demandée, un élément "count" puis les nœuds plafonnés"""
+
+    def __init__(self, noeuds):
+        self.noeuds = noeuds
+        self.appels = []
+
+    def __call__(self, corps):
+        self.appels.append(corps)
+        reponse = []
+        for emprise, plafond in re.findall(r'\(([-\d.,]+)\);\)->\.t;\.t out count;\.t out body center (\d+);', corps):
+            sud, ouest, nord, est = map(float, emprise.split(','))
+            dedans = [noeud for noeud in self.noeuds if sud <= noeud['lat'] <= nord and ouest <= noeud['lon'] <= est]
+            reponse.append({'type': 'count', 'id': 0, 'tags': {'total': str(len(dedans))}})
+            reponse.extend(dedans[:int(plafond)])
+        return reponse
+
+
+@pytest.fixture
+def overpass(app_ctx, monkeypatch):
+    application = app_ctx
+    # 36 nœuds sur ~400 m : bien plus que le plafond de 10 éléments par tuile
+    noeuds = [{'type': 'node', 'id': ligne * 6 + colonne + 1,
+               'lat': CENTRE[0] + (ligne - 3) * 0.0007, 'lon': CENTRE[1] + (colonne - 3) * 0.0009}
+              for ligne in range(6) for colonne in range(6)]
+    bouchon = OverpassBouchon(noeuds)
+    monkeypatch.setattr(application, '_appeler_overpass', bouchon)
+    monkeypatch.setitem(application.app.config, 'OVERPASS_ELEMENTS_MAX', 10)
+    application.purger_cache_overpass(tout=True)
+    yield bouchon
+    application.purger_cache_overpass(tout=True)
+
+
+def test_tuile_tronquee_subdivisee_et_jamais_en_cache_tronquee(app_ctx, overpass):
+    elements = app_ctx.elements_overpass('test:*', ['node["shop"]'], CENTRE, 1)
+
+    assert sorted(element['id'] for element in elements) == list(range(1, 37))
+    tuiles = app_ctx.OverpassTuile.query.filter_by(filtre='test:*').all()
+    assert any(tuile.subdivisee for tuile in tuiles)
+    for tuile in tuiles:
+        if not tuile.subdivisee:
+            assert len(app_ctx.json.loads(tuile.elements)) <= 10
+    assert app_ctx.stats_overpass()['tuiles_subdivisees'] > 0
+
+    # Deuxième recherche : tuiles et tuiles filles servies par le cache, sans appel
+    nb_appels = len(overpass.appels)
+    assert len(app_ctx.elements_overpass('test:*', ['node["shop"]'], CENTRE, 1)) == 36
+    assert len(overpass.appels) == nb_appels
+
+
+def test_tronquee_a_la_precision_maximale_non_mise_en_cache(app_ctx, overpass, monkeypatch):
+    monkeypatch.setitem(app_ctx.app.config, 'OVERPASS_PRECISION_MAX', 0)  # Aucune subdivision possible
+    overpass.noeuds = [dict(noeud, lat=CENTRE[0], lon=CENTRE[1]) for noeud in overpass.noeuds]  # Tous au même point
+
+    assert len(app_ctx.elements_overpass('test:*', ['node["shop"]'], CENTRE, 1)) == 10
+
+    tuile = next(tuile for tuile in app_ctx.tuiles_couvrant(CENTRE, 1)
+                 if tuile == app_ctx.encoder_geohash(CENTRE[0], CENTRE[1], len(tuile)))
+    assert app_ctx.OverpassTuile.query.filter_by(filtre='test:*', geohash=tuile).first() is None
+    assert app_ctx.OverpassTuile.query.filter_by(filtre='test:*').count() == len(app_ctx.tuiles_couvrant(CENTRE, 1)) - 1
+
+
+def test_echeance_atteinte_aucun_appel(app_ctx, overpass):
+    app_ctx._echeance_http.valeur = time.monotonic() - 1
+    try:
+        with pytest.raises(requests.Timeout):
+            app_ctx.elements_overpass('test:*', ['node["shop"]'], CENTRE, 1)
+    finally:
+        app_ctx._echeance_http.valeur = None
+    assert overpass.appels == []
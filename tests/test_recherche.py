@@ -0,0 +1,51 @@
+"""
+Recherche d'entreprise bornée par une échéance : les appels HTTP des stratégies ne la dépassent pas
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+
+class ServeurLent(BaseHTTPRequestHandler):
+    """Répond en 3 s : bien au-delà de l'échéance des tests"""
+
+    def do_GET(self):
+        time.sleep(3)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'[]')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url_lente():
+    serveur = ThreadingHTTPServer(('127.0.0.1', 0), ServeurLent)
+    serveur.daemon_threads = True
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{serveur.server_address[1]}/"
+    serveur.shutdown()
+    serveur.server_close()
+
+
+def test_appel_refuse_apres_echeance(app_ctx):
+    avant = dict(app_ctx.http_compteurs.get('127.0.0.1', {}))
+    with pytest.raises(requests.Timeout):
+        app_ctx.requete_http('GET', 'http://127.0.0.1:9/', echeance=time.monotonic() - 1)
+    assert app_ctx.http_compteurs.get('127.0.0.1', {}) == avant  # Aucun appel parti
+
+
+def test_strategie_en_retard_rend_son_thread(app_ctx, url_lente):
+    debut = time.monotonic()
+    resultat = app_ctx._executer_strategie(
+        'lente', lambda: app_ctx.requete_http('GET', url_lente).json(), (), time.monotonic() + 0.5
+    )
+
+    # Timeout réduit au temps restant, pas de reprise au-delà de l'échéance
+    assert resultat['statut'].startswith('erreur')
+    assert time.monotonic() - debut < 2
+    assert not app_ctx.echeance_http_depassee()  # Échéance oubliée une fois la stratégie terminée